@@ -0,0 +1,240 @@
+"""
+Stage-by-stage benchmark of the geolocation pipeline (geolocation_main) on the bundled and synthetic datasets.
+
+Stages, timed separately on every dataset:
+    parse                           parse_input_files, from the CSV files (no compiled cache)
+    closest_probes                  closest probe of every front-end, 1-party and 3-party
+    delays/<rtt method>             1-party second-hop delays
+    rates/<rtt method>              continent-pair and general rate fit
+    apply/<rtt method>              3-party second-hop delays from the calibration
+    geolocation/<rtt>/<geolocation> all targets, without maps
+    output/<map mode>               maps of the results (first RTT method, first geolocation method)
+Every stage runs --repeat times; the JSON report has every run and their min/median/mean, in seconds, with the
+size of every dataset so runs on growing synthetic datasets show how each stage scales.
+Without --output the report is written to stdout, and progress to stderr.
+
+Example usage (from the repository root):
+    python benchmarks/bench_pipeline.py --output bench.json
+    python benchmarks/bench_pipeline.py --datasets --synthetic 10x10x10 20x20x40 40x40x80x40 --maps none
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import datetime
+import platform
+import statistics
+
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..', 'cdg_server'))
+
+from cdg_core.main import METHOD_SUBTRACTION, METHOD_OPTIMIZATION, METHOD_LEAST_SQUARES, METHOD_MULTILATERATION, \
+    METHOD_FINGERPRINTING, parse_input_files, validate_inputs, apply_calibration, geolocate_from_data, save_maps
+from cdg_core.aggregation import DEFAULT_AGGREGATION
+from cdg_core.calibration_artifact import CalibrationArtifact
+from cdg_core.parsers import MEASUREMENT_SAMPLES_COUNT, is_testing_mode
+from cdg_core.plot_map import MAPS_NONE, MAPS_GEOJSON, MAPS_HTML
+from cdg_core.service import capture_stdout
+from cdg_core.synthetic import SyntheticConfig, generate_dataset
+
+REPORT_FORMAT = 'cdg-benchmark'
+REPORT_VERSION = 1
+
+DATASETS_DIR = os.path.join(BENCHMARKS_DIR, '..', 'Datasets')
+BUNDLED_DATASETS = ['DS-B1', 'DS-F1', 'DS-F2', 'DS-F3', 'DS-F4']
+RTT_METHODS = [METHOD_SUBTRACTION, METHOD_OPTIMIZATION, METHOD_LEAST_SQUARES]
+GEOLOCATION_METHODS = [METHOD_MULTILATERATION, METHOD_FINGERPRINTING]
+
+
+class StageTimer:
+    """
+    Wall-clock times of named stages, over repeated runs.
+    """
+
+    def __init__(self):
+        self.runs = dict()
+
+    def time(self, stage, function, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.runs.setdefault(stage, list()).append(time.perf_counter() - start_time)
+        return result
+
+    def to_dict(self) -> dict:
+        return {stage: {'runs': runs, 'min': min(runs), 'median': statistics.median(runs),
+                        'mean': statistics.fmean(runs)}
+                for stage, runs in self.runs.items()}
+
+
+def _calibrate(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, timer):
+    """
+    The steps of main.calibrate_csp and apply_calibration, timed one by one.
+    """
+    if rtt_method == METHOD_SUBTRACTION:
+        delays = cdgeb_utils_1party.compute_csp_delays_subtraction
+    elif rtt_method == METHOD_OPTIMIZATION:
+        delays = cdgeb_utils_1party.compute_csp_delays_optimizer
+    else:
+        # rtt_method == METHOD_LEAST_SQUARES
+        delays = cdgeb_utils_1party.compute_csp_delays_least_squares
+    timer.time(f'delays/{rtt_method}', delays)
+
+    def fit_rates():
+        cdgeb_utils_1party.evaluate_csp_general_rate()
+        return cdgeb_utils_1party.evaluate_csp_rates()
+    timer.time(f'rates/{rtt_method}', fit_rates)
+
+    baselines = cdgeb_utils_1party.subtraction_baselines() if rtt_method == METHOD_SUBTRACTION else None
+    calibration = CalibrationArtifact.from_dataset(cdgeb_utils_1party, rtt_method, baselines=baselines)
+    timer.time(f'apply/{rtt_method}', apply_calibration, calibration, cdgeb_utils_3party)
+    return calibration
+
+
+def benchmark_dataset(input_dir, rtt_methods, geolocation_methods, maps, repeat=3,
+                      aggregation=DEFAULT_AGGREGATION) -> dict:
+    """
+    Time every stage of the pipeline on a dataset, repeat times.
+    return: the dataset's entry of the report. Stages that fail (e.g. invalid inputs) are reported as errors.
+    """
+    timer = StageTimer()
+    testing_mode = is_testing_mode(input_dir)
+    errors = dict()
+    size = None
+
+    for _ in range(repeat):
+        with capture_stdout():
+            cdgeb_utils_1party, cdgeb_utils_3party = timer.time('parse', parse_input_files, input_dir, testing_mode,
+                                                                aggregation)
+
+            def closest_probes():
+                cdgeb_utils_1party.determine_closest_probes()
+                cdgeb_utils_3party.determine_closest_probes()
+            timer.time('closest_probes', closest_probes)
+
+            size = {
+                'datacenters': len(cdgeb_utils_3party.datacenters),
+                'probes': len(cdgeb_utils_1party.probe_clients),
+                'frontends': len(cdgeb_utils_1party.frontend_servers),
+                'files': len(cdgeb_utils_1party.data_files),
+                'targets': len(cdgeb_utils_3party.data_files),
+                'measurements_1party': len(cdgeb_utils_1party.measurements.rtts),
+                'measurements_3party': len(cdgeb_utils_3party.measurements.rtts),
+            }
+
+            output_results = None
+            for rtt_method in rtt_methods:
+                if not validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, METHOD_MULTILATERATION,
+                                       testing_mode):
+                    errors[rtt_method] = "Invalid inputs"
+                    continue
+                calibration = _calibrate(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, timer)
+
+                for geolocation_method in geolocation_methods:
+                    results = timer.time(f'geolocation/{rtt_method}/{geolocation_method}', geolocate_from_data,
+                                         None, calibration, cdgeb_utils_3party, geolocation_method, testing_mode,
+                                         maps=MAPS_NONE)
+                    output_results = output_results or results
+
+            if output_results is not None:
+                output_dir = tempfile.mkdtemp(prefix='cdg-bench-')
+                try:
+                    for mode in maps:
+                        timer.time(f'output/{mode}', save_maps, output_results.target_maps, cdgeb_utils_3party,
+                                   output_dir, mode)
+                finally:
+                    shutil.rmtree(output_dir)
+
+    return {'path': os.path.abspath(input_dir), 'size': size, 'errors': errors, 'stages': timer.to_dict()}
+
+
+def parse_synthetic_spec(spec) -> dict:
+    """
+    <probes>x<frontends>x<files>[x<samples>], e.g. 20x20x40 or 20x20x40x40. One datacenter per front-end.
+    """
+    try:
+        values = [int(value) for value in spec.lower().split('x')]
+    except ValueError:
+        values = list()
+    if len(values) not in (3, 4):
+        raise argparse.ArgumentTypeError(f"Invalid synthetic dataset size: {spec}")
+    return dict(zip(['probes', 'frontends', 'files', 'samples'], values + [MEASUREMENT_SAMPLES_COUNT]))
+
+
+def run_benchmarks(datasets, synthetic, rtt_methods, geolocation_methods, maps, repeat=3, seed=0) -> dict:
+    report = {
+        'format': REPORT_FORMAT,
+        'version': REPORT_VERSION,
+        'created_utc': datetime.datetime.now(datetime.UTC).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'parameters': {'repeat': repeat, 'rtt_methods': rtt_methods, 'geolocation_methods': geolocation_methods,
+                       'maps': maps, 'seed': seed},
+        'datasets': dict(),
+    }
+
+    for name in datasets:
+        print(f"[DEBUG] Benchmarking {name}", file=sys.stderr)
+        report['datasets'][name] = benchmark_dataset(os.path.join(DATASETS_DIR, name), rtt_methods,
+                                                     geolocation_methods, maps, repeat)
+
+    for spec in synthetic:
+        name = 'synthetic-{probes}x{frontends}x{files}x{samples}'.format(**spec)
+        print(f"[DEBUG] Benchmarking {name}", file=sys.stderr)
+        input_dir = tempfile.mkdtemp(prefix='cdg-synthetic-')
+        try:
+            start_time = time.perf_counter()
+            generate_dataset(input_dir, SyntheticConfig(datacenters=spec['frontends'], seed=seed, **spec))
+            generation_time = time.perf_counter() - start_time
+            report['datasets'][name] = benchmark_dataset(input_dir, rtt_methods, geolocation_methods, maps, repeat)
+            report['datasets'][name].update(path=None, synthetic=spec, generation_time=generation_time)
+        finally:
+            shutil.rmtree(input_dir)
+
+    return report
+
+
+def print_summary(report):
+    for name, dataset in report['datasets'].items():
+        print(f"{name}: {dataset['size']}")
+        for stage, timing in dataset['stages'].items():
+            print(f"    {stage:<45} {timing['median'] * 1000:10.2f} ms")
+        for method, error in dataset['errors'].items():
+            print(f"    [WARNING] {method}: {error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time every stage of the CDG pipeline.")
+    parser.add_argument('--datasets', nargs='*', default=BUNDLED_DATASETS,
+                        help="Bundled datasets (folders of Datasets/). Empty: none")
+    parser.add_argument('--synthetic', nargs='*', type=parse_synthetic_spec, default=list(),
+                        help="Synthetic dataset sizes: <probes>x<frontends>x<files>[x<samples>]")
+    parser.add_argument('--rtt-methods', nargs='+', default=RTT_METHODS, choices=RTT_METHODS)
+    parser.add_argument('--geolocation-methods', nargs='+', default=GEOLOCATION_METHODS, choices=GEOLOCATION_METHODS)
+    parser.add_argument('--maps', nargs='+', default=[MAPS_GEOJSON, MAPS_HTML],
+                        choices=[MAPS_NONE, MAPS_GEOJSON, MAPS_HTML], help="Map output modes to time")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic datasets")
+    parser.add_argument('--output', default=None, help="JSON report path. Default: stdout")
+    args = parser.parse_args()
+
+    maps = [mode for mode in args.maps if mode != MAPS_NONE]
+    report = run_benchmarks(args.datasets, args.synthetic, args.rtt_methods, args.geolocation_methods, maps,
+                            args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print_summary(report)
+        print("[DEBUG] Saved benchmark report:", args.output)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,13 +1,39 @@
 import os
-import sys
 import tempfile
-import zipfile
 import json
 import datetime
 from multiprocessing import freeze_support
-from flask import Flask, request, render_template, send_from_directory
-
-from cdg_core.main import geolocation_main as CDG_main
+from flask import Flask, Response, request, render_template, send_from_directory, url_for
+
+from cdg_core.main import save_maps
+from cdg_core.aggregation import AGGREGATIONS, DEFAULT_AGGREGATION, is_valid_aggregation
+from cdg_core.plot_map import MAPS_NONE, MAPS_GEOJSON, MAPS_HTML
+from cdg_core.parsers import FILE_MEASUREMENTS_1PARTY, FILE_SERVERS_1PARTY, FILE_MEASUREMENTS_3PARTY, \
+    FILE_SERVERS_3PARTY, FILE_DATACENTERS, FILE_SOLUTION
+from cdg_core.calibration_artifact import CalibrationArtifact
+from cdg_core.registry import UnknownEntityError
+from cdg_core.service import SolverService
+from cdg_core.instrumentation import PROFILERS
+from cdg_core.jobs import JOB_DONE, QueueFullError, JobQueue
+from cdg_core.packaging import COMPRESSION_DEFAULT, COMPRESSION_LEVELS, Package, PackageStore, map_entries, \
+    stream_zip
+
+# Maps must be complete before the outputs are listed or zipped, so background rendering is not offered here
+WEB_MAP_MODES = [MAPS_HTML, MAPS_GEOJSON, MAPS_NONE]
+
+CALIBRATION_FILE = 'calibration.json'
+RESULTS_FILE = 'results.txt'
+ZIP_FILE = 'CDG_results.zip'
+
+# Upload form field -> input file name
+UPLOAD_FIELDS = {
+    'measurements-1party': FILE_MEASUREMENTS_1PARTY,
+    'servers-1party': FILE_SERVERS_1PARTY,
+    'measurements-3party': FILE_MEASUREMENTS_3PARTY,
+    'servers-3party': FILE_SERVERS_3PARTY,
+    'datacenters': FILE_DATACENTERS,
+    'solution': FILE_SOLUTION,
+}
 
 ROOT_DIR = os.path.join(os.path.dirname(__file__), 'webappstorage')
 SESSIONS_DIR = os.path.join(ROOT_DIR, 'sessions')
@@ -17,6 +43,107 @@ os.makedirs(SESSIONS_DIR, exist_ok=True)
 
 application = Flask(__name__)
 
+# Keeps the calibrations of the 1-party datasets warm between requests
+solver_service = SolverService()
+
+# Asynchronous jobs: solves running at once, and jobs waiting for a worker before submissions are refused
+JOB_WORKERS = 2
+JOB_QUEUE_SIZE = 16
+# Seconds a client should wait before resubmitting when the job queue is full
+JOB_RETRY_AFTER = 10
+
+job_queue = JobQueue(solver_service, max_workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE)
+
+# Web GUI results, kept in memory until they are downloaded as a streamed ZIP
+package_store = PackageStore()
+
+
+def read_uploads():
+    """
+    The uploaded input files as a {file name: content} mapping, and the uploaded calibration artifact (or None).
+    Raises ValueError on an invalid calibration artifact.
+    """
+    files = dict()
+    for field, filename in UPLOAD_FIELDS.items():
+        upload = request.files.get(field)
+        if upload:
+            files[filename] = upload.read()
+
+    calibration = None
+    calibration_file = request.files.get('calibration')
+    if calibration_file:
+        try:
+            calibration = CalibrationArtifact.from_dict(json.loads(calibration_file.read()))
+        except (KeyError, TypeError, AttributeError, UnknownEntityError) as e:
+            raise ValueError(e)
+    return files, calibration
+
+
+def has_required_uploads(files, calibration) -> bool:
+    """
+    Whether the uploads hold the 3-party files and datacenters.csv, and the 1-party files unless a calibration
+    artifact replaces them.
+
+    @param files: the {file name: content} mapping of read_uploads.
+    """
+    required = [FILE_MEASUREMENTS_3PARTY, FILE_SERVERS_3PARTY, FILE_DATACENTERS]
+    if calibration is None:
+        required += [FILE_MEASUREMENTS_1PARTY, FILE_SERVERS_1PARTY]
+    return all(filename in files for filename in required)
+
+
+def results_text(result, rtt_method, geolocation_method, aggregation) -> str:
+    return ("Running CDG with the following parameters:\n"
+            f"2-hop RTT extraction method: {rtt_method}\n"
+            f"Geolocation method: {geolocation_method}\n"
+            f"RTT aggregation: {aggregation}\n"
+            "\n" + result.output)
+
+
+def package_entries(files, calibration, result, rtt_method, geolocation_method, aggregation, maps, echo_inputs):
+    """
+    The ZIP entries of a Web GUI request, laid out like a session directory: output/ and, optionally, input/.
+    Maps are rendered while the ZIP is streamed.
+    """
+    entries = [('output/' + RESULTS_FILE, results_text(result, rtt_method, geolocation_method, aggregation))]
+    if result.success:
+        if calibration is None:
+            entries.append(('output/' + CALIBRATION_FILE, json.dumps(result.calibration.to_dict())))
+        dataset = result.dataset
+        entries += map_entries(result.results.target_maps, dataset.probe_clients, dataset.datacenters,
+                               dataset.possible_file_datacenters, maps, 'output/')
+
+    if echo_inputs:
+        entries += [('input/' + filename, content) for filename, content in files.items()]
+        if calibration is not None:
+            entries.append(('input/' + CALIBRATION_FILE, json.dumps(calibration.to_dict())))
+    return entries
+
+
+def solve_session(files, calibration, rtt_method, geolocation_method, aggregation, maps, input_path, output_path,
+                  profile=None):
+    """
+    Solve the uploaded files with the solver service and write the session files: the inputs, results.txt,
+    the calibration artifact (when it was not uploaded) and the maps.
+    return: the SolveResult.
+    """
+    for filename, content in files.items():
+        with open(os.path.join(input_path, filename), 'wb') as f:
+            f.write(content)
+    if calibration is not None:
+        calibration.save(os.path.join(input_path, CALIBRATION_FILE))
+
+    result = solver_service.solve(files, rtt_method, geolocation_method, aggregation, calibration, profile=profile)
+
+    with open(os.path.join(output_path, RESULTS_FILE), 'w') as f:
+        f.write(results_text(result, rtt_method, geolocation_method, aggregation))
+
+    if result.success:
+        if calibration is None:
+            result.calibration.save(os.path.join(output_path, CALIBRATION_FILE))
+        save_maps(result.results.target_maps, result.dataset, output_path, maps)
+    return result
+
 
 # Web GUI
 @application.route('/')
@@ -24,93 +151,63 @@ def upload_file():
     return render_template('upload.html')
 
 
-@application.route('/download/<path:filepath>', methods=['GET'])
-def download_zip(filepath):
-    if filepath.lower().endswith('.zip'):
-        return send_from_directory(ROOT_DIR, filepath, as_attachment=True)
-    else:
+@application.route('/download/<token>/<filename>', methods=['GET'])
+def download_zip(token, filename):
+    package = package_store.get(token)
+    if package is None or filename != package.filename:
         return 'Invalid file path'
 
+    # Generated while it is sent (chunked transfer), never written to disk
+    return Response(stream_zip(package.entries, package.compression), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={package.filename}'})
+
 
 @application.route('/uploader', methods=['POST'])
 def upload_files():
     if request.method == 'POST':
-        # Ensure all three files are present
-        file1 = request.files.get('measurements-1party')
-        file2 = request.files.get('servers-1party')
-        file3 = request.files.get('measurements-3party')
-        file4 = request.files.get('servers-3party')
-        file5 = request.files.get('datacenters')
-        file6 = request.files.get('solution')
-
-        if not (file1 and file2 and file3 and file4 and file5):
+        try:
+            files, calibration = read_uploads()
+        except ValueError as e:
+            return f'Invalid calibration artifact: {e}'
+
+        if not has_required_uploads(files, calibration):
             return 'Missing files. Please ensure all files are uploaded.'
 
         rtt_method = request.form['rtt_method']
         geolocation_method = request.form['geolocation_method']
+        aggregation = request.form.get('aggregation') or DEFAULT_AGGREGATION
+        maps = request.form.get('maps') or MAPS_HTML
+        compression = request.form.get('compression') or COMPRESSION_DEFAULT
+        echo_inputs = request.form.get('echo_inputs') or 'yes'
 
-        if rtt_method not in ['Subtraction', 'Optimization']:
-            return 'Invalid 2-hop RTT extraction method. Please select either Subtraction or Optimization.'
+        if rtt_method not in ['Subtraction', 'Optimization', 'LeastSquares']:
+            return ('Invalid 2-hop RTT extraction method. '
+                    'Please select either Subtraction, Optimization or LeastSquares.')
 
         if geolocation_method not in ['Multilateration', 'Fingerprinting']:
             return 'Invalid geolocation method. Please select either Multilateration or Fingerprinting.'
 
-        # Make new folder with uniquely generated name inside session directory
-        session_dir = tempfile.mkdtemp(dir=SESSIONS_DIR)
-
-        input_path = os.path.join(session_dir, 'input')
-        output_path = os.path.join(session_dir, 'output')
-
-        os.makedirs(input_path, exist_ok=True)
-        os.makedirs(output_path, exist_ok=True)
-
-        file1.save(os.path.join(input_path, 'measurements-1party.csv'))
-        file2.save(os.path.join(input_path, 'servers-1party.csv'))
-        file3.save(os.path.join(input_path, 'measurements-3party.csv'))
-        file4.save(os.path.join(input_path, 'servers-3party.csv'))
-        file5.save(os.path.join(input_path, 'datacenters.csv'))
-
-        if file6:
-            file6.save(os.path.join(input_path, 'solution.csv'))
-
-        # Create a temporary file for the CDG output
-        temp_output_path = os.path.join(output_path, "results.txt")
-
-        # Redirect sys.stdout hack
-        original_stdout = sys.stdout
-        with open(temp_output_path, 'w') as f:
-            sys.stdout = f
-            print("Running CDG with the following parameters:")
-            print(f"2-hop RTT extraction method: {rtt_method}")
-            print(f"Geolocation method: {geolocation_method}")
-            print()
-
-            try:
-                success = CDG_main(input_path, output_path, rtt_method, geolocation_method)
-            finally:
-                # Reset sys.stdout to its original value
-                sys.stdout = original_stdout
-
-        # Create a temporary file for the ZIP to be sent in response
-        zip_output_fd, zip_output_path = tempfile.mkstemp(dir=session_dir, prefix='CDG_', suffix='.zip')
-        relative_zip_output_path = os.path.relpath(zip_output_path, start=ROOT_DIR)
-        os.close(zip_output_fd)
-
-        # Create a ZIP file to include the output folder
-        with zipfile.ZipFile(zip_output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(output_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, start=os.path.dirname(output_path))
-                    zipf.write(file_path, arcname=arcname)
-            for root, _, files in os.walk(input_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, start=os.path.dirname(input_path))
-                    zipf.write(file_path, arcname=arcname)
-
-        return (render_template('download.html', output_file_path=relative_zip_output_path),
-                400 if not success else 200)
+        if not is_valid_aggregation(aggregation):
+            return 'Invalid RTT aggregation. Please select one of: ' + ', '.join(AGGREGATIONS) + '.'
+
+        if maps not in WEB_MAP_MODES:
+            return 'Invalid map output. Please select one of: ' + ', '.join(WEB_MAP_MODES) + '.'
+
+        if compression not in COMPRESSION_LEVELS:
+            return 'Invalid ZIP compression. Please select one of: ' + ', '.join(COMPRESSION_LEVELS) + '.'
+
+        if echo_inputs not in ['yes', 'no']:
+            return 'Invalid input echo option. Please select either yes or no.'
+
+        result = solver_service.solve(files, rtt_method, geolocation_method, aggregation, calibration)
+
+        # The ZIP is streamed from memory when it is downloaded
+        entries = package_entries(files, calibration, result, rtt_method, geolocation_method, aggregation, maps,
+                                  echo_inputs == 'yes')
+        token = package_store.add(Package(entries, ZIP_FILE, compression))
+
+        return (render_template('download.html', output_file_path=f'{token}/{ZIP_FILE}'),
+                400 if not result.success else 200)
     else:
         return 'Invalid request'
 
@@ -118,26 +215,35 @@ def upload_files():
 # REST API
 @application.route('/rest', methods=['POST'])
 def rest_api():
-    # Ensure all three files are present
-    file1 = request.files.get('measurements-1party')
-    file2 = request.files.get('servers-1party')
-    file3 = request.files.get('measurements-3party')
-    file4 = request.files.get('servers-3party')
-    file5 = request.files.get('datacenters')
-    file6 = request.files.get('solution')
-
-    if not (file1 and file2 and file3 and file4 and file5):
+    try:
+        files, calibration = read_uploads()
+    except ValueError as e:
+        return f'Invalid calibration artifact: {e}'
+
+    if not has_required_uploads(files, calibration):
         return 'Missing files. Please ensure all files are uploaded.'
 
     rtt_method = request.form['rtt_method']
     geolocation_method = request.form['geolocation_method']
+    aggregation = request.form.get('aggregation') or DEFAULT_AGGREGATION
+    maps = request.form.get('maps') or MAPS_HTML
+    profile = request.form.get('profile') or None
 
-    if rtt_method not in ['Subtraction', 'Optimization']:
-        return 'Invalid 2-hop RTT extraction method. Please select either Subtraction or Optimization.'
+    if rtt_method not in ['Subtraction', 'Optimization', 'LeastSquares']:
+        return 'Invalid 2-hop RTT extraction method. Please select either Subtraction, Optimization or LeastSquares.'
 
     if geolocation_method not in ['Multilateration', 'Fingerprinting']:
         return 'Invalid geolocation method. Please select either Multilateration or Fingerprinting.'
 
+    if not is_valid_aggregation(aggregation):
+        return 'Invalid RTT aggregation. Please select one of: ' + ', '.join(AGGREGATIONS) + '.'
+
+    if maps not in WEB_MAP_MODES:
+        return 'Invalid map output. Please select one of: ' + ', '.join(WEB_MAP_MODES) + '.'
+
+    if profile is not None and profile not in PROFILERS:
+        return 'Invalid profiler. Please select one of: ' + ', '.join(PROFILERS) + '.'
+
     domain_name = request.headers.get('Host')
     if domain_name is None:
         return 'Invalid request. Host header is expected.'
@@ -152,31 +258,9 @@ def rest_api():
     os.makedirs(input_path, exist_ok=True)
     os.makedirs(output_path, exist_ok=True)
 
-    file1.save(os.path.join(input_path, 'measurements-1party.csv'))
-    file2.save(os.path.join(input_path, 'servers-1party.csv'))
-    file3.save(os.path.join(input_path, 'measurements-3party.csv'))
-    file4.save(os.path.join(input_path, 'servers-3party.csv'))
-    file5.save(os.path.join(input_path, 'datacenters.csv'))
-    if (file6):
-        file6.save(os.path.join(input_path, 'solution.csv'))
-
-    # Create a temporary file for the CDG output
-    temp_output_path = os.path.join(output_path, "results.txt")
-
-    # Redirect sys.stdout hack
-    original_stdout = sys.stdout
-    with open(temp_output_path, 'w') as f:
-        sys.stdout = f
-        print("Running CDG with the following parameters:")
-        print(f"2-hop RTT extraction method: {rtt_method}")
-        print(f"Geolocation method: {geolocation_method}")
-        print()
-
-        try:
-            success = CDG_main(input_path, output_path, rtt_method, geolocation_method)
-        finally:
-            # Reset sys.stdout to its original value
-            sys.stdout = original_stdout
+    result = solve_session(files, calibration, rtt_method, geolocation_method, aggregation, maps,
+                           input_path, output_path, profile)
+    success = result.success
 
     outputAsDict = {}
     outputAsDict['Meta'] = {}
@@ -196,14 +280,110 @@ def rest_api():
             outputAsDict['Assets'][file] = "http://" + domain_name + arcname.replace('\\', '/').replace('sessions',
                                                                                                         '/GetFile')
 
+    outputAsDict['Results'] = result.to_dict()
+
     return json.dumps(outputAsDict, indent=4), 400 if not success else 200
 
 
+def read_solve_form():
+    """
+    The solver parameters of a /solve or /jobs request.
+    return: (error message or None, rtt_method, geolocation_method, aggregation, profile)
+    """
+    rtt_method = request.form['rtt_method']
+    geolocation_method = request.form['geolocation_method']
+    aggregation = request.form.get('aggregation') or DEFAULT_AGGREGATION
+    profile = request.form.get('profile') or None
+
+    error = None
+    if rtt_method not in ['Subtraction', 'Optimization', 'LeastSquares']:
+        error = 'Invalid 2-hop RTT extraction method. Please select either Subtraction, Optimization or LeastSquares.'
+    elif geolocation_method not in ['Multilateration', 'Fingerprinting']:
+        error = 'Invalid geolocation method. Please select either Multilateration or Fingerprinting.'
+    elif not is_valid_aggregation(aggregation):
+        error = 'Invalid RTT aggregation. Please select one of: ' + ', '.join(AGGREGATIONS) + '.'
+    elif profile is not None and profile not in PROFILERS:
+        error = 'Invalid profiler. Please select one of: ' + ', '.join(PROFILERS) + '.'
+    return error, rtt_method, geolocation_method, aggregation, profile
+
+
+# In-memory REST API: structured results only, nothing is written to the session storage
+@application.route('/solve', methods=['POST'])
+def solve_api():
+    error, rtt_method, geolocation_method, aggregation, profile = read_solve_form()
+    if error:
+        return error
+
+    try:
+        files, calibration = read_uploads()
+    except ValueError as e:
+        return f'Invalid calibration artifact: {e}'
+
+    # Missing files are reported in the output
+    result = solver_service.solve(files, rtt_method, geolocation_method, aggregation, calibration, profile=profile)
+
+    outputAsDict = result.to_dict()
+    outputAsDict['Meta'] = {'date_utc': datetime.datetime.now(datetime.UTC).isoformat()}
+    outputAsDict['output'] = result.output
+    return json.dumps(outputAsDict, indent=4), 400 if not result.success else 200
+
+
+# Asynchronous REST API: submit a job, poll its status, then fetch its results
+@application.route('/jobs', methods=['POST'])
+def submit_job():
+    error, rtt_method, geolocation_method, aggregation, profile = read_solve_form()
+    if error:
+        return error
+
+    try:
+        files, calibration = read_uploads()
+    except ValueError as e:
+        return f'Invalid calibration artifact: {e}'
+
+    try:
+        job = job_queue.submit(files, rtt_method, geolocation_method, aggregation, calibration, profile)
+    except QueueFullError as e:
+        return json.dumps({'error': str(e)}, indent=4), 503, {'Retry-After': str(JOB_RETRY_AFTER)}
+
+    outputAsDict = job.status_dict()
+    outputAsDict['status_url'] = url_for('job_status', job_id=job.job_id)
+    outputAsDict['result_url'] = url_for('job_result', job_id=job.job_id)
+    return json.dumps(outputAsDict, indent=4), 202, {'Location': outputAsDict['status_url']}
+
+
+@application.route('/jobs', methods=['GET'])
+def job_queue_status():
+    return json.dumps(job_queue.counts(), indent=4)
+
+
+@application.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    return json.dumps(job.status_dict(), indent=4)
+
+
+@application.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return 'Unknown job', 404
+    if not job.finished:
+        # Not ready yet: same body as the status endpoint
+        return json.dumps(job.status_dict(), indent=4), 202
+
+    outputAsDict = job.result.to_dict() if job.result is not None else {'success': False}
+    outputAsDict['Meta'] = job.status_dict()
+    outputAsDict['output'] = job.result.output if job.result is not None else job.error
+    return json.dumps(outputAsDict, indent=4), 200 if job.status == JOB_DONE else 400
+
+
 @application.route('/GetFile/<path:filepath>', methods=['GET'])
 def download_file(filepath):
     if filepath.lower().endswith('.csv'):
         return send_from_directory(SESSIONS_DIR, filepath, as_attachment=True)
-    elif filepath.lower().endswith(('.html', '.txt')):
+    elif filepath.lower().endswith(('.html', '.txt', '.geojson', '.json')):
         return send_from_directory(SESSIONS_DIR, filepath, as_attachment=False)
     else:
         return 'Invalid file path'
@@ -1,17 +1,14 @@
 import numpy as np
 from .data_classes import *
-import warnings
-from scipy.optimize import minimize
-from numpy import square
-
-warnings.filterwarnings("ignore", "divide by zero encountered in scalar divide", category=RuntimeWarning)
-
-__all__ = ["haversine", "pretty_print_rates", "DatasetUtils1Party", "DatasetUtils3Party"]
-
-MEASUREMENT_PROBES = 0
-MEASUREMENT_FRONTENDS = 1
-MEASUREMENT_FILES = 2
+from .spatial_index import SpatialIndex
+from .dataset_arrays import EntityIndex, PairMatrix, MeasurementArrays
+from .instrumentation import record
+from scipy.optimize import minimize, lsq_linear
+from scipy.sparse import csr_matrix
 
+__all__ = ["haversine", "haversine_matrix", "pretty_print_rates", "pretty_print_rate_fit", "continent_indices",
+           "RateStatistics",
+           "DatasetUtils1Party", "DatasetUtils3Party"]
 
 def haversine(coord1: tuple[float, float], coord2: tuple[float, float]) -> float:
     """
@@ -28,6 +25,25 @@ def haversine(coord1: tuple[float, float], coord2: tuple[float, float]) -> float
     return distance
 
 
+def haversine_matrix(coords_a, coords_b) -> np.ndarray:
+    """
+    Computes the pairwise Haversine distances between two sets of coordinates.
+
+    @param coords_a: (N, 2) array-like of (lat, lon) pairs. A single pair is treated as N=1.
+    @param coords_b: (M, 2) array-like of (lat, lon) pairs. A single pair is treated as M=1.
+    return: (N, M) array of distances in kilometers.
+    """
+    coords_a = np.radians(np.asarray(coords_a, dtype=float).reshape(-1, 2))
+    coords_b = np.radians(np.asarray(coords_b, dtype=float).reshape(-1, 2))
+    lat1, lon1 = coords_a[:, 0, np.newaxis], coords_a[:, 1, np.newaxis]
+    lat2, lon2 = coords_b[np.newaxis, :, 0], coords_b[np.newaxis, :, 1]
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return 6371.0 * c  # Radius of Earth in kilometers
+
+
 def pretty_print_rates(rates: dict[tuple[Continent, Continent], float]):
     """
     Uses Rich to pretty-print the rates between each continent.
@@ -59,6 +75,151 @@ def pretty_print_rates(rates: dict[tuple[Continent, Continent], float]):
     console.print(table)
 
 
+def pretty_print_rate_fit(statistics):
+    """
+    Uses Rich to pretty-print the sample count and R^2 of the rate fit between each continent.
+
+    @param statistics: RateStatistics, e.g. DatasetUtils1Party.csp_rate_statistics.
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    counts = statistics.counts()
+    r_squared = statistics.r_squared()
+    rows = sorted(set(str(key[0]) for key in counts))
+    columns = sorted(set(str(key[1]) for key in counts))
+
+    table = Table(title="Rate Fit within CSP Network (samples / R\u00b2)")
+    table.add_column("", justify="right", style="cyan", no_wrap=True)
+    for column in columns:
+        table.add_column(column, justify="center")
+
+    for row in rows:
+        row_data = [f"{counts[(row, column)]} / {r_squared[(row, column)]:.3f}" if counts[(row, column)] else "-"
+                    for column in columns]
+        table.add_row(row, *row_data)
+
+    console = Console()
+    console.print(table)
+
+
+def _raise_for_missing_measurements(cdgeb_utils, rtts, probe_ids, frontend_ids, file_ids):
+    """
+    Raise a KeyError naming the first missing (probe, frontend, file) measurement of a (frontends x files) lookup.
+    """
+    missing = np.argwhere(np.isnan(rtts))
+    if len(missing) == 0:
+        return
+    frontend_row, file_column = missing[0]
+    probe_ids, frontend_ids, file_ids = np.broadcast_arrays(np.reshape(probe_ids, (-1, 1)),
+                                                            np.reshape(frontend_ids, (-1, 1)), file_ids)
+    raise KeyError((cdgeb_utils.probe_clients[probe_ids[frontend_row, file_column]].name,
+                    cdgeb_utils.frontend_servers[frontend_ids[frontend_row, file_column]].name,
+                    cdgeb_utils.data_files[file_ids[frontend_row, file_column]].name))
+
+
+def continent_indices(entities) -> np.ndarray:
+    """
+    Index of the continent of every entity, in the order of the Continent enum.
+
+    @param entities: a list of entities, or an EntityIndex (its cached array is returned).
+    """
+    if isinstance(entities, EntityIndex):
+        return entities.continent_ids
+    continents = list(Continent)
+    return np.array([continents.index(entity.continent) for entity in entities], dtype=np.intp)
+
+
+class RateStatistics:
+    """
+    Sufficient statistics of the through-origin least-squares fit delay = distance / rate, per continent pair.
+
+    The fitted slope is sum(distance * delay) / sum(distance ** 2), exactly what np.linalg.lstsq computes on a single
+    column, so samples can be added or removed in O(1) each without revisiting the others.
+    Rows are source (front-end) continents, columns target (file) continents, in the order of the Continent enum.
+    """
+
+    def __init__(self):
+        num_continents = len(Continent)
+        self.count = np.zeros((num_continents, num_continents), dtype=np.int64)
+        self.sum_xy = np.zeros((num_continents, num_continents))
+        self.sum_xx = np.zeros((num_continents, num_continents))
+        self.sum_yy = np.zeros((num_continents, num_continents))
+
+    @classmethod
+    def from_samples(cls, src_continents, dst_continents, distances, delays) -> 'RateStatistics':
+        """
+        Statistics of all continent pairs in a single pass: samples are binned by continent-pair index.
+        """
+        statistics = cls()
+        num_continents = len(Continent)
+        shape = (num_continents, num_continents)
+        pairs = np.asarray(src_continents) * num_continents + np.asarray(dst_continents)
+        distances = np.asarray(distances, dtype=float)
+        delays = np.asarray(delays, dtype=float)
+
+        statistics.count = np.bincount(pairs, minlength=num_continents ** 2).reshape(shape)
+        statistics.sum_xy = np.bincount(pairs, weights=distances * delays, minlength=num_continents ** 2).reshape(shape)
+        statistics.sum_xx = np.bincount(pairs, weights=distances ** 2, minlength=num_continents ** 2).reshape(shape)
+        statistics.sum_yy = np.bincount(pairs, weights=delays ** 2, minlength=num_continents ** 2).reshape(shape)
+        return statistics
+
+    def update(self, src_continents, dst_continents, distances, delays, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) samples.
+
+        @param src_continents: continent index of every sample's front-end (see continent_indices).
+        @param dst_continents: continent index of every sample's file.
+        """
+        distances = np.asarray(distances, dtype=float)
+        delays = np.asarray(delays, dtype=float)
+        pairs = (np.asarray(src_continents), np.asarray(dst_continents))
+        np.add.at(self.count, pairs, sign)
+        np.add.at(self.sum_xy, pairs, sign * distances * delays)
+        np.add.at(self.sum_xx, pairs, sign * distances ** 2)
+        np.add.at(self.sum_yy, pairs, sign * delays ** 2)
+
+    @staticmethod
+    def _rate(sum_xy, sum_xx):
+        slope = sum_xy / sum_xx if sum_xx > 0 else 0.0
+        if slope == 0:
+            # No samples (or no signal): nothing limits the distance
+            return np.inf
+        return round(1 / slope, 2)
+
+    def rates(self) -> dict[tuple[Continent, Continent], float]:
+        """
+        Rate [km/s] of every continent pair. Pairs without samples get an infinite rate.
+        """
+        return {(continent_a, continent_b): self._rate(self.sum_xy[a, b], self.sum_xx[a, b])
+                for a, continent_a in enumerate(Continent) for b, continent_b in enumerate(Continent)}
+
+    def general_rate(self) -> float:
+        """
+        Rate [km/s] fitted on the samples of all continent pairs.
+        """
+        return self._rate(self.sum_xy.sum(), self.sum_xx.sum())
+
+    def counts(self) -> dict[tuple[Continent, Continent], int]:
+        """
+        Number of samples of every continent pair.
+        """
+        return {(continent_a, continent_b): int(self.count[a, b])
+                for a, continent_a in enumerate(Continent) for b, continent_b in enumerate(Continent)}
+
+    def r_squared(self) -> dict[tuple[Continent, Continent], float]:
+        """
+        Coefficient of determination of every continent pair's fit. The fit has no intercept, so this is the
+        uncentered R^2: 1 - residual sum of squares / sum(delay ** 2). NaN for pairs without samples.
+        """
+        residuals = self.sum_yy - np.divide(self.sum_xy ** 2, self.sum_xx, out=np.zeros_like(self.sum_xy),
+                                            where=self.sum_xx > 0)
+        r_squared = np.divide(residuals, self.sum_yy, out=np.full(self.sum_yy.shape, np.nan),
+                              where=(self.count > 0) & (self.sum_yy > 0))
+        return {(continent_a, continent_b): float(1 - r_squared[a, b])
+                for a, continent_a in enumerate(Continent) for b, continent_b in enumerate(Continent)}
+
+
 class DatasetUtils:
     def __init__(self,
                  # Common:
@@ -78,82 +239,133 @@ class DatasetUtils:
                  csp_delays: dict[tuple[FrontEnd, DataFile], float] = None,
                  csp_rates: dict[tuple[Continent, Continent], float] = None,
                  ):
-        # Common:
-        self.measurements = measurements
+        # Common (setting an entity list also builds its EntityIndex, see below):
         self.datacenters = datacenters
         self.probe_clients = probe_clients
         self.frontend_servers = frontend_servers
         self.data_files = data_files
+        # Array-backed measurements, still readable as a dict keyed by (probe, frontend, file) names
+        self.measurements = MeasurementArrays.from_mapping(measurements, self.probe_ids, self.frontend_ids,
+                                                           self.file_ids) if measurements else measurements
         # 3-party:
         self.possible_file_datacenters = possible_file_datacenters
         self.solutions = solutions
         # 1-party:
         self.closest_probe_to_frontend = closest_probe_to_frontend
         self.closest_file_for_frontend = closest_file_for_frontend
-        # Optionals:
-        self.csp_distances = csp_distances
-        self.csp_delays = csp_delays
+        # Optionals (stored as (frontends x files) PairMatrix):
+        self.csp_distances = PairMatrix.from_mapping(csp_distances, self.frontend_ids, self.file_ids) \
+            if csp_distances is not None else None
+        self.csp_delays = PairMatrix.from_mapping(csp_delays, self.frontend_ids, self.file_ids) \
+            if csp_delays is not None else None
         self.csp_rates = csp_rates
+        self.csp_delays_residuals = None
+
+        # Spatial indexes, built once per dataset
+        self.probe_index = SpatialIndex(self.probe_clients)
+        self.possible_datacenter_index = SpatialIndex(self.possible_file_datacenters) \
+            if self.possible_file_datacenters else None
 
         self.determine_closest_probes()
 
+    # Entity lists. Each one has an EntityIndex (dense integer IDs, name -> ID map and cached per-entity arrays),
+    # rebuilt when the list is set: a list must be set again, not modified in place, for the index to follow.
+
+    @property
+    def datacenters(self) -> list[DataCenter]:
+        return self._datacenters
+
+    @datacenters.setter
+    def datacenters(self, datacenters: list[DataCenter]):
+        self._datacenters = datacenters
+        self.datacenter_ids = EntityIndex(datacenters)
+
+    @property
+    def probe_clients(self) -> list[ProbeClient]:
+        return self._probe_clients
+
+    @probe_clients.setter
+    def probe_clients(self, probe_clients: list[ProbeClient]):
+        self._probe_clients = probe_clients
+        self.probe_ids = EntityIndex(probe_clients)
+
     @property
-    def datacenter_locations(self):
-        return [datacenter.coordinates for datacenter in self.datacenters]
+    def frontend_servers(self) -> list[FrontEnd]:
+        return self._frontend_servers
+
+    @frontend_servers.setter
+    def frontend_servers(self, frontend_servers: list[FrontEnd]):
+        self._frontend_servers = frontend_servers
+        self.frontend_ids = EntityIndex(frontend_servers)
+
+    @property
+    def data_files(self) -> list[DataFile]:
+        return self._data_files
+
+    @data_files.setter
+    def data_files(self, data_files: list[DataFile]):
+        self._data_files = data_files
+        self.file_ids = EntityIndex(data_files)
+
+    # Cached read-only arrays of the entities, in the order of the entity lists.
+    # Names map to IDs with e.g. self.frontend_ids.name_ids.
+
+    @property
+    def datacenter_locations(self) -> np.ndarray:
+        return self.datacenter_ids.locations
 
     @property
-    def probe_locations(self):
-        return [probe.coordinates for probe in self.probe_clients]
+    def probe_locations(self) -> np.ndarray:
+        return self.probe_ids.locations
 
     @property
-    def frontend_locations(self):
-        return [frontend.coordinates for frontend in self.frontend_servers]
+    def frontend_locations(self) -> np.ndarray:
+        return self.frontend_ids.locations
 
     @property
-    def file_locations(self):
-        return [datafile.coordinates for datafile in self.data_files]
+    def file_locations(self) -> np.ndarray:
+        return self.file_ids.locations
 
     @property
-    def datacenter_continents(self):
-        return [datacenter.continent for datacenter in self.datacenters]
+    def datacenter_continents(self) -> np.ndarray:
+        return self.datacenter_ids.continents
 
     @property
-    def probe_continents(self):
-        return [probe.continent for probe in self.probe_clients]
+    def probe_continents(self) -> np.ndarray:
+        return self.probe_ids.continents
 
     @property
-    def frontend_continents(self):
-        return [frontend.datacenter.continent for frontend in self.frontend_servers]
+    def frontend_continents(self) -> np.ndarray:
+        return self.frontend_ids.continents
 
     @property
-    def file_continents(self):
-        return [datafile.datacenter.continent for datafile in self.data_files]
+    def file_continents(self) -> np.ndarray:
+        return self.file_ids.continents
 
     @property
-    def datacenter_names(self):
-        return [datacenter.name for datacenter in self.datacenters]
+    def datacenter_names(self) -> np.ndarray:
+        return self.datacenter_ids.names
 
     @property
-    def probe_names(self):
-        return [probe.name for probe in self.probe_clients]
+    def probe_names(self) -> np.ndarray:
+        return self.probe_ids.names
 
     @property
-    def frontend_names(self):
-        return [frontend.name for frontend in self.frontend_servers]
+    def frontend_names(self) -> np.ndarray:
+        return self.frontend_ids.names
 
     @property
-    def file_names(self):
-        return [datafile.name for datafile in self.data_files]
+    def file_names(self) -> np.ndarray:
+        return self.file_ids.names
 
     def determine_closest_probes(self):
         """
         Determine the closest probe to each front-end server.
         """
-        closest_probes = dict()
-        for frontend in self.frontend_servers:
-            closest_probes[frontend] = min(self.probe_clients,
-                                           key=lambda probe: haversine(frontend.coordinates,
-                                                                       probe.coordinates))
+        self.closest_probe_ids = self.probe_index.nearest_indices(self.frontend_locations) \
+            if self.frontend_servers else np.empty(0, dtype=np.intp)
+        closest_probes = {frontend: self.probe_clients[probe_id]
+                          for frontend, probe_id in zip(self.frontend_servers, self.closest_probe_ids)}
 
         self.closest_probe_to_frontend = closest_probes
         return closest_probes
@@ -184,66 +396,117 @@ class DatasetUtils:
         #
         # return closest_file_for_frontend
 
-    def compute_csp_delays_optimizer(self):
-        mode_closest_probes_only = True
+    def _build_delay_design(self, mode_closest_probes_only=True):
+        """
+        Translate the 2-hop measurements into the integer index arrays of the linear RTT model:
+        rtt(probe, frontend, file) = delay_1hop[probe, frontend] + delay_2hop[frontend, file].
 
-        frontend_names = self.frontend_names
-        num_frontends = len(frontend_names)
-        file_names = self.file_names
-        num_files = len(file_names)
+        The arrays are built once, so that solvers can evaluate the model with NumPy only.
 
-        if mode_closest_probes_only:
-            probe_names = [probe.name for probe in self.closest_probe_to_frontend.values()]
-            num_probes = len(probe_names)
+        return: (measured_rtts, index_1hop, index_2hop, count_rtts_1hop, count_rtts_2hop),
+                where index_1hop/index_2hop are the flat parameter indices of each measurement.
+        """
+        num_frontends = len(self.frontend_servers)
+        num_files = len(self.data_files)
+        measurements = self.measurements
+        probe_index, frontend_index, file_index = \
+            measurements.probe_ids, measurements.frontend_ids, measurements.file_ids
 
-            closest_probe_to_frontend_names = {frontend.name: probe.name for frontend, probe in
-                                               self.closest_probe_to_frontend.items()}
-            measurements = {k: v for k, v in self.measurements.items()
-                            if k[MEASUREMENT_PROBES] == closest_probe_to_frontend_names[k[MEASUREMENT_FRONTENDS]]}
+        if mode_closest_probes_only:
+            # One 1-hop parameter row per front-end's closest probe (a probe shared by several front-ends
+            # uses the row of the first of them).
+            num_probes = num_frontends
+            probe_slots = np.full(len(self.probe_clients), -1)
+            unique_probe_ids, first_frontends = np.unique(self.closest_probe_ids, return_index=True)
+            probe_slots[unique_probe_ids] = first_frontends
+
+            relevant = probe_index == self.closest_probe_ids[frontend_index]
+            probe_index, frontend_index, file_index = \
+                probe_slots[probe_index[relevant]], frontend_index[relevant], file_index[relevant]
+            measured_rtts = measurements.rtts[relevant]
         else:
-            probe_names = self.probe_names
-            num_probes = len(probe_names)
-
-            measurements = self.measurements
+            num_probes = len(self.probe_clients)
+            measured_rtts = measurements.rtts
 
-        # Initial guess for the delays
         count_rtts_1hop = num_probes * num_frontends
         count_rtts_2hop = num_frontends * num_files
 
-        average_rtt = np.mean(list(measurements.values()))
+        index_1hop = probe_index * num_frontends + frontend_index
+        index_2hop = count_rtts_1hop + frontend_index * num_files + file_index
 
-        initial_guess = np.array([average_rtt/2] * (count_rtts_1hop + count_rtts_2hop))
+        return measured_rtts, index_1hop, index_2hop, count_rtts_1hop, count_rtts_2hop
+
+    def compute_csp_delays_optimizer(self):
+        measured_rtts, index_1hop, index_2hop, count_rtts_1hop, count_rtts_2hop = self._build_delay_design()
+        num_params = count_rtts_1hop + count_rtts_2hop
+
+        # Initial guess for the delays
+        average_rtt = np.mean(measured_rtts)
+
+        initial_guess = np.full(num_params, average_rtt / 2)
         param_bounds = (
                 [(0, None)] * len(initial_guess)
         )
 
         def loss_function(x):
-            probe_server_delays = x[:count_rtts_1hop].reshape((num_probes, num_frontends))
-            server_file_delays = x[count_rtts_1hop:].reshape((num_frontends, num_files))
+            residuals = x[index_1hop] + x[index_2hop] - measured_rtts
+            total_loss = np.dot(residuals, residuals)
 
-            total_loss = 0
-            for (probe_name, frontend_name, file_name), measured_rtt in measurements.items():
-                probe_index = probe_names.index(probe_name)
-                frontend_index = frontend_names.index(frontend_name)
-                file_index = file_names.index(file_name)
+            # d(loss)/dx is 2*residual for both parameters of each measurement
+            gradient = np.bincount(index_1hop, weights=2 * residuals, minlength=num_params) + \
+                np.bincount(index_2hop, weights=2 * residuals, minlength=num_params)
+            return total_loss, gradient
 
-                estimated_rtt = probe_server_delays[probe_index, frontend_index] + server_file_delays[
-                    frontend_index, file_index]
-                total_loss += square(measured_rtt - estimated_rtt)
-            return total_loss
+        result = minimize(loss_function, initial_guess, jac=True, method='L-BFGS-B', bounds=param_bounds)
+        record('optimizer_iterations', int(result.nit))
+        record('optimizer_evaluations', int(result.nfev))
 
-        result = minimize(loss_function, initial_guess, method='L-BFGS-B', bounds=param_bounds)
+        num_frontends, num_files = len(self.frontend_servers), len(self.data_files)
+        rtts_2hop = result.x[count_rtts_1hop:].reshape((num_frontends, num_files))
 
-        optimized_params = result.x
-        rtts_1hop = optimized_params[:count_rtts_1hop].reshape((num_probes, num_frontends))
-        rtts_2hop = optimized_params[count_rtts_1hop:].reshape((num_frontends, num_files))
+        self.csp_delays = PairMatrix(self.frontend_ids, self.file_ids, rtts_2hop / 2)
+        return self.csp_delays
 
-        rtts_within_csp = {
-            (frontend, data_file): rtts_2hop[frontend_names.index(frontend.name), file_names.index(data_file.name)]
-            for frontend in self.frontend_servers
-            for data_file in self.data_files}
+    def compute_csp_delays_least_squares(self):
+        """
+        Compute the delays of the second hop (front-end to file) by solving the 2-hop RTT model
+        as a sparse bounded linear least-squares problem (non-negative delays).
 
-        self.csp_delays = {k: (v / 2) for k, v in rtts_within_csp.items()}
+        Only parameters that appear in at least one measurement become columns of the CSR design matrix,
+        so both memory and work scale linearly with the number of measurements.
+        """
+        measured_rtts, index_1hop, index_2hop, count_rtts_1hop, count_rtts_2hop = self._build_delay_design()
+        num_measurements = len(measured_rtts)
+
+        # Compress the parameter space to the observed parameters only
+        observed_params, columns = np.unique(np.concatenate((index_1hop, index_2hop)), return_inverse=True)
+        rows = np.tile(np.arange(num_measurements), 2)
+        design_matrix = csr_matrix((np.ones(2 * num_measurements), (rows, columns)),
+                                   shape=(num_measurements, len(observed_params)))
+
+        result = lsq_linear(design_matrix, measured_rtts, bounds=(0, np.inf), method='trf', lsmr_tol='auto')
+        record('optimizer_iterations', int(result.nit))
+
+        # Unobserved parameters keep the neutral guess used by the optimizer method
+        params = np.full(count_rtts_1hop + count_rtts_2hop, np.mean(measured_rtts) / 2)
+        params[observed_params] = result.x
+
+        residuals = design_matrix @ result.x - measured_rtts
+        self.csp_delays_residuals = {
+            'measurements': num_measurements,
+            'parameters': len(observed_params),
+            'rmse': float(np.sqrt(np.mean(np.square(residuals)))),
+            'mean_abs': float(np.mean(np.abs(residuals))),
+            'max_abs': float(np.max(np.abs(residuals))),
+            'iterations': int(result.nit),
+        }
+        print("[DEBUG] Least-squares 2-hop fit residuals:",
+              ", ".join(f"{k}={v:.4g}" for k, v in self.csp_delays_residuals.items()))
+
+        num_frontends, num_files = len(self.frontend_servers), len(self.data_files)
+        rtts_2hop = params[count_rtts_1hop:].reshape((num_frontends, num_files))
+
+        self.csp_delays = PairMatrix(self.frontend_ids, self.file_ids, rtts_2hop / 2)
         return self.csp_delays
 
 
@@ -256,21 +519,22 @@ class DatasetUtils1Party(DatasetUtils):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.build_distance_map()
+        distances = self.build_distance_map().values_matrix
 
-        self.closest_file_for_frontend = {frontend: min(self.data_files,
-                                                        key=lambda data_file: haversine(frontend.coordinates,
-                                                                                        data_file.coordinates))
-                                          for frontend in self.frontend_servers}
+        self.closest_file_ids = np.argmin(distances, axis=1) if self.data_files else np.empty(0, dtype=np.intp)
+        self.closest_file_for_frontend = {frontend: self.data_files[file_id]
+                                          for frontend, file_id in zip(self.frontend_servers, self.closest_file_ids)}
+        self.csp_rate_statistics = None
 
     def build_distance_map(self):
-        distances = dict()
-        for frontend in self.frontend_servers:
-            for data_file in self.data_files:
-                distances[(frontend, data_file)] = haversine(frontend.coordinates,
-                                                             data_file.coordinates)
+        """
+        Computes the distance between every front-end server and every file.
 
-        self.csp_distances = distances
+        return: (frontends x files) PairMatrix of distances, also kept in self.csp_distances.
+        """
+        distances = haversine_matrix(self.frontend_locations, self.file_locations)
+        self.csp_distances = PairMatrix(self.frontend_ids, self.file_ids,
+                                        distances.reshape(len(self.frontend_servers), len(self.data_files)))
         return self.csp_distances
 
     def compute_csp_delays_subtraction(self):
@@ -278,65 +542,65 @@ class DatasetUtils1Party(DatasetUtils):
         Compute the round-trip times of the second hop (front-end to file)
         Using the subtraction method.
         """
+        frontend_ids = np.arange(len(self.frontend_servers))
+        file_ids = np.arange(len(self.data_files))
 
-        rtts_within_csp = dict()
-        for frontend in self.frontend_servers:
-            closest_file = self.closest_file_for_frontend[frontend]
-            closest_probe = self.closest_probe_to_frontend[frontend]
+        rtts_to_files = self.measurements.lookup(self.closest_probe_ids[:, np.newaxis], frontend_ids[:, np.newaxis],
+                                                 file_ids[np.newaxis, :])
+        rtts_to_closest_file = self.measurements.lookup(self.closest_probe_ids, frontend_ids, self.closest_file_ids)
+        _raise_for_missing_measurements(self, rtts_to_files, self.closest_probe_ids, frontend_ids, file_ids)
+        _raise_for_missing_measurements(self, rtts_to_closest_file[:, np.newaxis], self.closest_probe_ids,
+                                        frontend_ids, self.closest_file_ids[:, np.newaxis])
 
-            for data_file in self.data_files:
-                rtts_within_csp[(frontend, data_file)] = \
-                    self.measurements[(closest_probe.name, frontend.name, data_file.name)] - \
-                    self.measurements[(closest_probe.name, frontend.name, closest_file.name)]
+        rtts_within_csp = rtts_to_files - rtts_to_closest_file[:, np.newaxis]
 
-        self.csp_delays = {k: (v / 2) for k, v in rtts_within_csp.items()}
+        self.csp_delays = PairMatrix(self.frontend_ids, self.file_ids, rtts_within_csp / 2)
         return self.csp_delays
 
-    def _evaluate_rates_inner(self, continent_a=None, continent_b=None):
-        """ Evaluate the communication rates within CSP network.
-        Given every frontent->file delay and distance.
-        If continents are not specified - all continents will be considered.
-
-        return: rate [km/s]
+    def subtraction_baselines(self) -> dict[DataCenter, tuple[ProbeClient, float]]:
         """
-
-        Xs, Ys = list(), list()
-        for frontend in self.frontend_servers:
-            for data_file in self.data_files:
-                # Filter the relevant measurements
-                if continent_a and continent_b:
-                    if continent_a != frontend.continent or \
-                            continent_b != data_file.continent:
-                        continue
-
-                distance = self.csp_distances[(frontend, data_file)]
-                delay = self.csp_delays[(frontend, data_file)]
-
-                Xs.append(distance)
-                Ys.append(delay)
-
-        slope = np.linalg.lstsq(np.array(Xs)[:, np.newaxis], np.array(Ys), rcond=None)[0][0]
-
-        return round(1 / slope, 2)
+        What the subtraction method needs from the 1-party dataset, per front-end datacenter:
+        the closest probe of the datacenter's (first) front-end, and the RTT from that probe through the front-end
+        to the closest file.
+        """
+        # For every datacenter, the first 1-party frontend in it
+        frontends_by_datacenter = dict()
+        for frontend_id, frontend in enumerate(self.frontend_servers):
+            frontends_by_datacenter.setdefault(frontend.datacenter, frontend_id)
+        frontend_ids = np.array(list(frontends_by_datacenter.values()), dtype=np.intp)
+
+        closest_probe_ids = self.closest_probe_ids[frontend_ids]
+        closest_file_ids = self.closest_file_ids[frontend_ids]
+        rtts_to_closest_file = self.measurements.lookup(closest_probe_ids, frontend_ids, closest_file_ids)
+        _raise_for_missing_measurements(self, rtts_to_closest_file[:, np.newaxis], closest_probe_ids, frontend_ids,
+                                        closest_file_ids[:, np.newaxis])
+
+        return {datacenter: (self.probe_clients[probe_id], float(rtt))
+                for datacenter, probe_id, rtt in zip(frontends_by_datacenter, closest_probe_ids, rtts_to_closest_file)}
+
+    def evaluate_rate_statistics(self) -> RateStatistics:
+        """
+        Fit statistics of the communication rates within CSP network, for all continent pairs in a single pass
+        over every frontend->file delay and distance.
+        """
+        rows, columns = np.indices(self.csp_delays.values_matrix.shape)
+        self.csp_rate_statistics = RateStatistics.from_samples(
+            continent_indices(self.frontend_ids)[rows.ravel()], continent_indices(self.file_ids)[columns.ravel()],
+            self.csp_distances.values_matrix.ravel(), self.csp_delays.values_matrix.ravel())
+        return self.csp_rate_statistics
 
     def evaluate_csp_general_rate(self):
         """
         Computes the general transmission rate within the CSP's network.
         """
-        general_rate = self._evaluate_rates_inner()
-        return general_rate
+        return self.evaluate_rate_statistics().general_rate()
 
     def evaluate_csp_rates(self):
         """
         Computes the transmission rates within the CSP's network, considering the continents.
+        Continent pairs without any front-end -> file delay get an infinite rate.
         """
-        rates = dict()
-        for continent_a in Continent:
-            for continent_b in Continent:
-                rate = self._evaluate_rates_inner(continent_a, continent_b)
-                rates[(continent_a, continent_b)] = rate
-
-        self.csp_rates = rates
+        self.csp_rates = self.evaluate_rate_statistics().rates()
         return self.csp_rates
 
 
@@ -352,30 +616,33 @@ class DatasetUtils3Party(DatasetUtils):
         Compute the round-trip times of the second hop (front-end to file)
         Using the subtraction method.
         """
-        rtts_within_csp = dict()
-        for frontend in self.frontend_servers:
+        return self.compute_csp_delays_from_baselines(cdgeb_utils_1party.subtraction_baselines())
 
-            # frontend and frontend_1party have the same data center
-            frontend_1party = [frontend_1party for frontend_1party in cdgeb_utils_1party.frontend_servers
-                               if frontend.datacenter == frontend_1party.datacenter][0] or None
-
-            closest_probe_in_1party = cdgeb_utils_1party.closest_probe_to_frontend[frontend_1party]
-            closest_probe = self.closest_probe_to_frontend[frontend]
+    def compute_csp_delays_from_baselines(self, baselines: dict[DataCenter, tuple[ProbeClient, float]]):
+        """
+        Subtraction method, given the 1-party baselines (see DatasetUtils1Party.subtraction_baselines)
+        instead of the 1-party dataset itself.
+        Raises ValueError when the closest probe of a front-end is not the one of its datacenter's baseline.
+        """
+        closest_probes_in_1party = [baselines[frontend.datacenter][0] for frontend in self.frontend_servers]
+        closest_probes = [self.probe_clients[probe_id] for probe_id in self.closest_probe_ids]
+        if closest_probes_in_1party != closest_probes:
+            # Rejected by main.validate_inputs
+            raise ValueError("Closest probes are not the same for 1-party and 3-party")
 
-            if closest_probe_in_1party != closest_probe:
-                print("[ERROR] Closest probes are not the same for 1-party and 3-party!")
-                # TODO make sure that this scenario is handled in input validation function and not here.
-                exit(0)
+        # Base RTT: closest probe -> frontend -> file in the same datacenter, measured in the 1-party dataset
+        rtts_to_closest_file = np.array([baselines[frontend.datacenter][1] for frontend in self.frontend_servers],
+                                        dtype=float)
 
-            closest_file_in_1party = cdgeb_utils_1party.closest_file_for_frontend[frontend]
+        frontend_ids = np.arange(len(self.frontend_servers))
+        file_ids = np.arange(len(self.data_files))
+        rtts_to_files = self.measurements.lookup(self.closest_probe_ids[:, np.newaxis], frontend_ids[:, np.newaxis],
+                                                 file_ids[np.newaxis, :])
+        _raise_for_missing_measurements(self, rtts_to_files, self.closest_probe_ids, frontend_ids, file_ids)
 
-            for data_file in self.data_files:
-                rtts_within_csp[(frontend, data_file)] = \
-                    self.measurements[(closest_probe.name, frontend.name, data_file.name)] - \
-                    cdgeb_utils_1party.measurements[
-                        (closest_probe_in_1party.name, frontend_1party.name, closest_file_in_1party.name)]
+        rtts_within_csp = rtts_to_files - rtts_to_closest_file[:, np.newaxis]
 
-        self.csp_delays = {k: (v / 2) for k, v in rtts_within_csp.items()}
+        self.csp_delays = PairMatrix(self.frontend_ids, self.file_ids, rtts_within_csp / 2)
         return self.csp_delays
 
     def position_correction(self, coordinates: tuple[float, float]) -> DataCenter:
@@ -384,7 +651,12 @@ class DatasetUtils3Party(DatasetUtils):
 
         @param coordinates: Target's coordinates.
         """
-        closest_possible_dc = min(self.possible_file_datacenters,
-                                  key=lambda elem: haversine(coordinates, elem.coordinates))
+        return self.position_correction_batch([coordinates])[0]
 
-        return closest_possible_dc
+    def position_correction_batch(self, coordinates) -> list[DataCenter]:
+        """
+        Batch version of position_correction.
+
+        @param coordinates: (N, 2) array-like of targets' coordinates.
+        """
+        return self.possible_datacenter_index.nearest(coordinates)
@@ -1,13 +1,61 @@
 import numpy as np
 from scipy.optimize import minimize
 from .data_classes import Continent, FrontEnd, DataFile, DataCenter
-from .CloudServiceUtils import haversine
+from .CloudServiceUtils import haversine_matrix, continent_indices
+from .dataset_arrays import EntityIndex
+from .fingerprint_index import INDEX_EXACT, FingerprintIndex
+from .instrumentation import record
 
 from typing import TypeAlias
 
 Fingerprint: TypeAlias = dict[DataCenter, float]
 FeatureVector: TypeAlias = dict[DataCenter, float]
 
+EARTH_RADIUS_KM = 6371.0
+
+
+def normalize_coordinates(coord_unnormalized):
+    """
+    Normalizes given coordinates to the ranges: lat = [-90, 90], lon = [-180, 180].
+    Works on a single (lat, lon) pair as well as on an (N, 2) array.
+    Please read the note in multilateraion.
+    """
+    coord_unnormalized = np.asarray(coord_unnormalized, dtype=float)
+    lat1, lon1 = coord_unnormalized[..., 0], coord_unnormalized[..., 1]
+    lat2 = (lat1 + 90) % 180 - 90
+    lon2 = (lon1 + 180) % 360 - 180
+    return np.stack((lat2, lon2), axis=-1)
+
+
+def haversine_with_gradient(targets: np.ndarray, positions: np.ndarray):
+    """
+    Vectorized Haversine distances between every target and every position, with the analytic gradient
+    of each distance with respect to the target's coordinates.
+
+    @param targets: (T, 2) array of (lat, lon) in degrees.
+    @param positions: (F, 2) array of (lat, lon) in degrees.
+    return: (distances, d_lat, d_lon), each of shape (T, F). Distances in kilometers, gradients in km/degree.
+    """
+    lat1, lon1 = np.radians(targets[:, 0])[:, np.newaxis], np.radians(targets[:, 1])[:, np.newaxis]
+    lat2, lon2 = np.radians(positions[:, 0])[np.newaxis, :], np.radians(positions[:, 1])[np.newaxis, :]
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    cos_lat1, cos_lat2 = np.cos(lat1), np.cos(lat2)
+    sin_half_dlon_sq = np.sin(dlon / 2) ** 2
+    a = np.clip(np.sin(dlat / 2) ** 2 + cos_lat1 * cos_lat2 * sin_half_dlon_sq, 0.0, 1.0)
+    distances = 2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    # d(distance)/da is singular when the target coincides with (or is antipodal to) a position,
+    # where the distance has no gradient; those terms are zeroed.
+    denominator = np.sqrt(a * (1 - a))
+    d_distance_d_a = np.divide(EARTH_RADIUS_KM, denominator, out=np.zeros_like(a), where=denominator > 1e-12)
+    d_a_d_lat = -0.5 * np.sin(dlat) - np.sin(lat1) * cos_lat2 * sin_half_dlon_sq
+    d_a_d_lon = -0.5 * cos_lat1 * cos_lat2 * np.sin(dlon)
+
+    to_radians = np.pi / 180
+    return distances, d_distance_d_a * d_a_d_lat * to_radians, d_distance_d_a * d_a_d_lon * to_radians
+
 
 class MultilaterationUtils:
     """
@@ -58,18 +106,8 @@ class MultilaterationUtils:
         Co-Author: Daniel
         """
 
-        def normalize_coordinates(coord_unnormalized):
-            """
-            Normalizes a given coordinates to the ranges: lat = [-90, 90], lon = [-180, 180].
-            Please read the note in multilateraion.
-            """
-            lat1, lon1 = coord_unnormalized[0], coord_unnormalized[1]
-            lat2 = (lat1 + 90) % 180 - 90
-            lon2 = (lon1 + 180) % 360 - 180
-            return (lat2, lon2)
-
         def loss_function(current_guess, known_distances, positions):
-            distances_from_guess = np.array([haversine(current_guess, probe) for probe in positions])
+            distances_from_guess = haversine_matrix(current_guess, positions)[0]
             return np.sum((distances_from_guess - known_distances) ** 2)
 
         def multilateration(positions, distances):
@@ -87,7 +125,122 @@ class MultilaterationUtils:
         feontend_locations = [frontend.coordinates for frontend in distances]
 
         target = multilateration(np.array(feontend_locations), np.array(distances_from_fes))
-        return normalize_coordinates(target)
+        return tuple(normalize_coordinates(target))
+
+    @staticmethod
+    def _geolocate_batch_levenberg_marquardt(positions: np.ndarray, distances: np.ndarray,
+                                             max_iterations: int = 200, tolerance: float = 1e-10) -> np.ndarray:
+        """
+        Stacked Levenberg-Marquardt multilateration of all targets at once.
+        Each target's 2x2 normal equations are solved in closed form, so an iteration costs a handful of
+        (targets x front-ends) array operations regardless of the number of targets.
+
+        @param positions: (F, 2) array of front-end coordinates.
+        @param distances: (T, F) array of distances from each front-end to each target. NaN marks a missing entry.
+        return: (T, 2) array of unnormalized (lat, lon) estimations.
+        """
+        weights = (~np.isnan(distances)).astype(float)
+        known_distances = np.nan_to_num(distances, nan=0.0)
+
+        # Start from the front-end that is closest to each target
+        masked_distances = np.where(weights > 0, known_distances, np.inf)
+        targets = positions[np.argmin(masked_distances, axis=1)].astype(float)
+
+        def residuals_and_loss(current_targets, rows):
+            distances_from_guess, d_lat, d_lon = haversine_with_gradient(current_targets, positions)
+            residuals = (distances_from_guess - known_distances[rows]) * weights[rows]
+            return residuals, d_lat * weights[rows], d_lon * weights[rows], np.sum(residuals ** 2, axis=1)
+
+        damping = np.full(len(targets), 1e-3)
+        active = np.arange(len(targets))
+        residuals, d_lat, d_lon, loss = residuals_and_loss(targets, active)
+
+        for _ in range(max_iterations):
+            if len(active) == 0:
+                break
+            record('multilateration_iterations')
+
+            # Normal equations (J^T J + damping * diag(J^T J)) step = -J^T r, per target
+            jtj_lat_lat = np.sum(d_lat ** 2, axis=1)
+            jtj_lat_lon = np.sum(d_lat * d_lon, axis=1)
+            jtj_lon_lon = np.sum(d_lon ** 2, axis=1)
+            gradient_lat = np.sum(d_lat * residuals, axis=1)
+            gradient_lon = np.sum(d_lon * residuals, axis=1)
+
+            a = jtj_lat_lat * (1 + damping[active]) + 1e-12
+            c = jtj_lon_lon * (1 + damping[active]) + 1e-12
+            determinant = a * c - jtj_lat_lon ** 2
+            step_lat = -(c * gradient_lat - jtj_lat_lon * gradient_lon) / determinant
+            step_lon = -(a * gradient_lon - jtj_lat_lon * gradient_lat) / determinant
+            step = np.stack((step_lat, step_lon), axis=1)
+
+            candidates = targets[active] + step
+            new_residuals, new_d_lat, new_d_lon, new_loss = residuals_and_loss(candidates, active)
+
+            improved = new_loss < loss
+            targets[active[improved]] = candidates[improved]
+            damping[active] = np.where(improved, damping[active] / 10, damping[active] * 10)
+
+            converged = (np.abs(step).max(axis=1) < tolerance) | \
+                        (improved & (loss - new_loss <= tolerance * np.maximum(loss, 1.0))) | \
+                        (damping[active] > 1e12)
+
+            residuals = np.where(improved[:, np.newaxis], new_residuals, residuals)
+            d_lat = np.where(improved[:, np.newaxis], new_d_lat, d_lat)
+            d_lon = np.where(improved[:, np.newaxis], new_d_lon, d_lon)
+            loss = np.where(improved, new_loss, loss)
+
+            keep = ~converged
+            active, residuals, d_lat, d_lon, loss = active[keep], residuals[keep], d_lat[keep], d_lon[keep], loss[keep]
+
+        return targets
+
+    def _rates_matrix(self):
+        """
+        Arrange csp_rates as a (Continent x Continent) array, ordered as the Continent enum.
+        """
+        continents = list(Continent)
+        rates = np.full((len(continents), len(continents)), np.nan)
+        for (src_continent, target_continent), rate in self.csp_rates.items():
+            rates[continents.index(src_continent), continents.index(target_continent)] = rate
+        return rates
+
+    def geolocate_targets(self, delays: np.ndarray, frontends: list[FrontEnd]) -> np.ndarray:
+        """
+        Batch version of geolocate_target: geolocate all target files together.
+
+        @param delays: (files x frontends) array of *single-direction delays*. NaN marks an excluded front-end.
+        @param frontends: the front-end servers matching the columns of delays.
+        return: (files, 2) array of (lat, long) coordinates of the files.
+        """
+        positions, distances = self.target_distances(delays, frontends)
+        if distances.shape[0] == 0:
+            return np.empty((0, 2))
+
+        return normalize_coordinates(self._geolocate_batch_levenberg_marquardt(positions, distances))
+
+    def target_distances(self, delays: np.ndarray, frontends: list[FrontEnd]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Convert the delays of all target files to distances, using the continent-aware rates.
+
+        return: (positions, distances) - (frontends, 2) coordinates and (files x frontends) distances [km].
+        """
+        # One hashed pass over each list (a membership test per front-end on the list would be O(F^2))
+        assert set(frontends).issubset(self.frontend_server), "Inputs do not match (delays, fe_locations)"
+
+        delays = np.asarray(delays, dtype=float).reshape(-1, len(frontends))
+        positions = np.array([frontend.coordinates for frontend in frontends], dtype=float).reshape(-1, 2)
+        if delays.shape[0] == 0:
+            return positions, delays
+
+        frontend_continents = continent_indices(frontends)
+
+        # The assumed continent of each target is the continent of its closest (minimal delay) front-end
+        target_assumed_continents = frontend_continents[np.argmin(np.where(np.isnan(delays), np.inf, delays), axis=1)]
+
+        # Convert time measurements to distances
+        rates = self._rates_matrix()[frontend_continents[np.newaxis, :], target_assumed_continents[:, np.newaxis]]
+        return positions, delays * rates
 
     def geolocate_target(self, measurements_to_target: dict[FrontEnd, float]):
         """
@@ -129,6 +282,74 @@ class MultilaterationUtils:
         return self._geolocate_using_scipy(distances)
 
 
+class FingerprintStore:
+    """
+    Fingerprints as a dense (datacenters x datacenters) matrix: row = datacenter of the file,
+    column = datacenter of the front-end (a feature dimension).
+
+    Cosine similarity on the dimensions present in a feature vector needs the norm of each fingerprint restricted to
+    those dimensions; it is computed as sqrt(mask @ squared_fingerprints.T) from the cached element-wise squares,
+    and the full row norms are cached for feature vectors with no missing dimension.
+    """
+
+    def __init__(self, fingerprints: dict[DataCenter, Fingerprint], datacenters: list[DataCenter]):
+        self.datacenters = EntityIndex(datacenters)
+        num_datacenters = len(self.datacenters)
+
+        self.matrix = np.zeros((num_datacenters, num_datacenters))
+        self.has_fingerprint = np.zeros(num_datacenters, dtype=bool)
+        for file_datacenter, fingerprint in fingerprints.items():
+            row = self.datacenters.ids[file_datacenter]
+            self.has_fingerprint[row] = True
+            for frontend_datacenter, delay in fingerprint.items():
+                self.matrix[row, self.datacenters.ids[frontend_datacenter]] = delay
+
+        self.squared = self.matrix ** 2
+        self.row_norms = np.sqrt(self.squared.sum(axis=1))
+
+    def feature_matrix(self, feature_vectors: list[FeatureVector]) -> np.ndarray:
+        """
+        Arrange feature vectors as a (targets x datacenters) array. Missing dimensions are NaN.
+        """
+        features = np.full((len(feature_vectors), len(self.datacenters)), np.nan)
+        for row, feature_vector in enumerate(feature_vectors):
+            for datacenter, delay in feature_vector.items():
+                features[row, self.datacenters.ids[datacenter]] = delay
+        return features
+
+    def similarities(self, features: np.ndarray, candidate_ids: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarity between every feature vector and every candidate fingerprint,
+        restricted to the dimensions present in each feature vector.
+
+        @param features: (targets x datacenters) array, NaN for missing dimensions.
+        @param candidate_ids: IDs of the candidate datacenters.
+        return: (targets x candidates) array. Candidates without a fingerprint get -inf.
+        """
+        mask = ~np.isnan(features)
+        values = np.where(mask, features, 0.0)
+
+        dots = values @ self.matrix[candidate_ids].T
+        feature_norms = np.linalg.norm(values, axis=1)
+        fingerprint_norms = np.where(mask.all(axis=1)[:, np.newaxis],
+                                     self.row_norms[candidate_ids][np.newaxis, :],
+                                     np.sqrt(mask.astype(float) @ self.squared[candidate_ids].T))
+
+        norms = feature_norms[:, np.newaxis] * fingerprint_norms
+        similarity = np.divide(dots, norms, out=np.full(dots.shape, np.nan), where=norms > 0)
+        similarity[:, ~self.has_fingerprint[candidate_ids]] = -np.inf
+        return similarity
+
+    def match(self, features: np.ndarray, candidates: list[DataCenter]) -> list[DataCenter]:
+        """
+        The most similar candidate datacenter of every feature vector (first one on ties).
+        """
+        candidate_ids = np.array([self.datacenters.ids[datacenter] for datacenter in candidates], dtype=np.intp)
+        similarity = self.similarities(features, candidate_ids)
+        best = np.argmax(np.nan_to_num(similarity, nan=-np.inf), axis=1)
+        return [candidates[index] for index in best]
+
+
 class FingerprintingUtils:
     """
     This class is a utility class for geolocating a target using fingerprinting-based method.
@@ -138,6 +359,8 @@ class FingerprintingUtils:
     def __init__(self, datacenters: list[DataCenter], fingerprints: dict[DataCenter, Fingerprint] = None):
         self.csp_datacenters = datacenters
         self.csp_fingerprints = fingerprints
+        self.fingerprint_store = FingerprintStore(fingerprints, datacenters) if fingerprints else None
+        self.fingerprint_index = None
 
     def create_1party_fingerprints(self, measurements_2hop: dict[tuple[FrontEnd, DataFile], float]) \
             -> dict[DataCenter, Fingerprint]:
@@ -150,11 +373,25 @@ class FingerprintingUtils:
             if file.datacenter not in fingerprints:
                 fingerprints[file.datacenter] = dict()
             fingerprints[file.datacenter][frontend.datacenter] = delay
-            fingerprints[file.datacenter][frontend.datacenter] = delay
 
         self.csp_fingerprints = fingerprints
+        self.fingerprint_store = FingerprintStore(fingerprints, self.csp_datacenters)
+        self.fingerprint_index = None
         return fingerprints
 
+    def build_index(self, possible_file_datacenters: list[DataCenter], mode: str = INDEX_EXACT,
+                    **index_options) -> FingerprintIndex:
+        """
+        Build a candidate index over the fingerprints of the possible file datacenters.
+        Needed for large catalogs of candidates; match_targets and rank_targets use it once built.
+
+        @param mode: one of fingerprint_index.INDEX_MODES.
+        @param index_options: mode-specific options, see FingerprintIndex.
+        """
+        self.fingerprint_index = FingerprintIndex(self.fingerprint_store, possible_file_datacenters, mode,
+                                                  **index_options)
+        return self.fingerprint_index
+
     def evaluate_feature_vector(self, measurements_to_target: dict[FrontEnd, float]) \
             -> FeatureVector:
         """
@@ -177,23 +414,54 @@ class FingerprintingUtils:
         it is necessary to construct new fingerprints of the 3-party dataset in each geolocation attempt of target file.
         """
 
-        possible_fingerprints = dict()
-        for datacenter in possible_file_datacenters:
-            fingerprint_full = self.csp_fingerprints[datacenter]
-            fingerprint_reduced = [fingerprint_full[datacenter] for datacenter in feature_vector]
-            possible_fingerprints[datacenter] = np.array(fingerprint_reduced)
+        features = self.fingerprint_store.feature_matrix([feature_vector])
+        return self.fingerprint_store.match(features, possible_file_datacenters)[0]
+
+    def target_features(self, delays: np.ndarray, frontends: list[FrontEnd]) -> np.ndarray:
+        """
+        Batch version of evaluate_feature_vector: the (files x datacenters) feature matrix of all target files.
 
-        feature_vector_as_array = np.array([feature_vector[datacenter] for datacenter in feature_vector])
+        @param delays: (files x frontends) array of single-direction delays. NaN marks an excluded front-end.
+        @param frontends: the front-end servers matching the columns of delays.
+        """
+        delays = np.asarray(delays, dtype=float).reshape(-1, len(frontends))
+        features = np.full((len(delays), len(self.fingerprint_store.datacenters)), np.nan)
 
-        def similarity(fingerprint) -> float:
-            """
-            Compute the similarity between a fingerprint and a feature vector.
-            """
+        # A later front-end in the same datacenter overrides an earlier one, as in evaluate_feature_vector
+        for column, frontend in enumerate(frontends):
+            present = ~np.isnan(delays[:, column])
+            features[present, self.fingerprint_store.datacenters.ids[frontend.datacenter]] = delays[present, column]
 
-            return np.dot(fingerprint, feature_vector_as_array) / (
-                    np.linalg.norm(fingerprint) * np.linalg.norm(feature_vector_as_array))
+        return features
 
-        # Find the most similar fingerprint
-        best_match = max(possible_fingerprints, key=lambda x: similarity(possible_fingerprints[x]))
+    def _index_for(self, possible_file_datacenters: list[DataCenter]) -> FingerprintIndex:
+        if self.fingerprint_index is None or self.fingerprint_index.candidates != list(possible_file_datacenters):
+            self.build_index(possible_file_datacenters)
+        return self.fingerprint_index
+
+    def rank_targets(self, delays: np.ndarray, frontends: list[FrontEnd],
+                     possible_file_datacenters: list[DataCenter], k: int = 5) \
+            -> tuple[list[list[DataCenter]], np.ndarray]:
+        """
+        The k most similar datacenters of every target file, with their cosine similarity scores.
+
+        return: (datacenters, scores), see FingerprintIndex.query.
+        """
+        features = self.target_features(delays, frontends)
+        return self._index_for(possible_file_datacenters).query(features, k)
+
+    def match_targets(self, delays: np.ndarray, frontends: list[FrontEnd],
+                      possible_file_datacenters: list[DataCenter]) -> list[DataCenter]:
+        """
+        Batch version of evaluate_feature_vector + match_feature_vector_to_fingerprint for all target files.
+
+        @param delays: (files x frontends) array of single-direction delays. NaN marks an excluded front-end.
+        @param frontends: the front-end servers matching the columns of delays.
+        return: the matched datacenter of every file.
+        """
+        if self.fingerprint_index is not None and self.fingerprint_index.mode != INDEX_EXACT:
+            matches, _ = self.rank_targets(delays, frontends, possible_file_datacenters, k=1)
+            return [datacenters[0] for datacenters in matches]
 
-        return best_match
+        features = self.target_features(delays, frontends)
+        return self.fingerprint_store.match(features, possible_file_datacenters)
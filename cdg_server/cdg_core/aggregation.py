@@ -0,0 +1,140 @@
+"""
+Aggregation strategies that reduce the RTT samples of each measurement to a single RTT.
+
+Every strategy is a vectorized reduction over a (n_rows, n_samples) matrix, returning n_rows values.
+Strategies are selected by a spec string: '<name>' or '<name>:<parameter>', e.g. 'trimmed_mean:3', 'percentile:10'.
+"""
+
+from typing import Callable
+
+import numpy as np
+
+__all__ = ['AGGREGATION_MIN', 'AGGREGATION_MEAN', 'AGGREGATION_MEDIAN', 'AGGREGATION_TRIMMED_MEAN',
+           'AGGREGATION_PERCENTILE', 'AGGREGATION_HUBER', 'DEFAULT_AGGREGATION', 'AGGREGATIONS',
+           'get_aggregator', 'is_valid_aggregation']
+
+AGGREGATION_MIN = "min"
+AGGREGATION_MEAN = "mean"
+AGGREGATION_MEDIAN = "median"
+AGGREGATION_TRIMMED_MEAN = "trimmed_mean"
+AGGREGATION_PERCENTILE = "percentile"
+AGGREGATION_HUBER = "huber"
+
+DEFAULT_AGGREGATION = f"{AGGREGATION_TRIMMED_MEAN}:3"
+
+
+def aggregate_min(samples: np.ndarray) -> np.ndarray:
+    return np.min(samples, axis=1)
+
+
+def aggregate_mean(samples: np.ndarray) -> np.ndarray:
+    return np.mean(samples, axis=1)
+
+
+def aggregate_median(samples: np.ndarray) -> np.ndarray:
+    return np.median(samples, axis=1)
+
+
+def aggregate_trimmed_mean(samples: np.ndarray, trim: int = 3) -> np.ndarray:
+    """
+    Mean after dropping the `trim` lowest and `trim` highest samples of each row.
+    """
+    if trim != int(trim):
+        raise ValueError(f"Trim must be a whole number of samples, got {trim}")
+    trim = int(trim)
+    num_samples = samples.shape[1]
+    if trim < 0 or 2 * trim >= num_samples:
+        raise ValueError(f"Cannot trim {trim} samples from each side of {num_samples} samples")
+    if trim == 0:
+        return aggregate_mean(samples)
+
+    # Only the boundaries of the kept range need to be in place, not a full sort: the middle slice holds the kept
+    # samples, in some order
+    partitioned = np.partition(samples, (trim, num_samples - trim - 1), axis=1)
+    return np.mean(partitioned[:, trim:num_samples - trim], axis=1)
+
+
+def aggregate_percentile(samples: np.ndarray, q: float = 50) -> np.ndarray:
+    q = float(q)
+    if not 0 <= q <= 100:
+        raise ValueError(f"Percentile must be within [0, 100], got {q}")
+    return np.percentile(samples, q, axis=1)
+
+
+def aggregate_huber(samples: np.ndarray, k: float = 1.345, iterations: int = 20) -> np.ndarray:
+    """
+    Huber M-estimator of location, computed with iteratively reweighted means for all rows at once.
+    The scale of each row is its normalized median absolute deviation.
+
+    @param k: tuning constant, in units of the row's scale.
+    """
+    k = float(k)
+    location = np.median(samples, axis=1)
+    scale = 1.4826 * np.median(np.abs(samples - location[:, np.newaxis]), axis=1)
+    scale = np.where(scale > 0, scale, 1e-12)
+
+    for _ in range(iterations):
+        residuals = np.abs(samples - location[:, np.newaxis]) / scale[:, np.newaxis]
+        weights = np.minimum(1.0, k / np.maximum(residuals, 1e-12))
+        new_location = np.sum(weights * samples, axis=1) / np.sum(weights, axis=1)
+        if np.allclose(new_location, location, rtol=0, atol=1e-12):
+            location = new_location
+            break
+        location = new_location
+
+    return location
+
+
+AGGREGATIONS: dict[str, Callable[..., np.ndarray]] = {
+    AGGREGATION_MIN: aggregate_min,
+    AGGREGATION_MEAN: aggregate_mean,
+    AGGREGATION_MEDIAN: aggregate_median,
+    AGGREGATION_TRIMMED_MEAN: aggregate_trimmed_mean,
+    AGGREGATION_PERCENTILE: aggregate_percentile,
+    AGGREGATION_HUBER: aggregate_huber,
+}
+
+
+def get_aggregator(spec: str = DEFAULT_AGGREGATION) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Resolve an aggregation spec ('<name>' or '<name>:<parameter>') to a function of the samples matrix.
+    Raises ValueError on an invalid spec, including parameters that don't fit the samples of a measurement row.
+    """
+    # Imported here: parsers imports this module
+    from .parsers import MEASUREMENT_SAMPLES_COUNT
+
+    name, _, parameter = (spec or DEFAULT_AGGREGATION).partition(':')
+    if name not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation: {name}. Expected one of: {', '.join(AGGREGATIONS)}")
+
+    aggregation = AGGREGATIONS[name]
+    if not parameter:
+        return aggregation
+    if aggregation in (aggregate_min, aggregate_mean, aggregate_median):
+        raise ValueError(f"Aggregation {name} takes no parameter")
+
+    try:
+        parameter = float(parameter)
+    except ValueError:
+        raise ValueError(f"Invalid parameter for aggregation {name}: {parameter}") from None
+
+    # Validate the parameter up-front, rather than on the first chunk of samples
+    if aggregation is aggregate_trimmed_mean and (parameter != int(parameter) or parameter < 0):
+        raise ValueError(f"Trim must be a non-negative whole number of samples, got {parameter}")
+    if aggregation is aggregate_trimmed_mean and 2 * parameter >= MEASUREMENT_SAMPLES_COUNT:
+        raise ValueError(f"Cannot trim {int(parameter)} samples from each side of "
+                         f"{MEASUREMENT_SAMPLES_COUNT} samples")
+    if aggregation is aggregate_percentile and not 0 <= parameter <= 100:
+        raise ValueError(f"Percentile must be within [0, 100], got {parameter}")
+    if aggregation is aggregate_huber and parameter <= 0:
+        raise ValueError(f"Huber tuning constant must be positive, got {parameter}")
+
+    return lambda samples: aggregation(samples, parameter)
+
+
+def is_valid_aggregation(spec: str) -> bool:
+    try:
+        get_aggregator(spec)
+        return True
+    except ValueError:
+        return False
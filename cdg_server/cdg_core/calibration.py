@@ -0,0 +1,190 @@
+"""
+Incremental calibration of the CSP delays and rates from a growing 1-party measurement log.
+
+evaluate_csp_rates_and_rtts calibrates from scratch. IncrementalCalibration keeps, instead:
+    - per-key aggregates: the running mean of the aggregated RTT of every (probe, frontend, file) measurement row;
+    - the closest-probe RTT of every (frontend, file) pair and the resulting subtraction-method delays;
+    - RateStatistics (sum(xy), sum(x^2), ...) per continent pair.
+Ingesting new rows updates only the affected keys, delays and statistics. A new row changes one delay, unless it
+measures the closest file of its front-end, which shifts the whole row of that front-end.
+
+Example usage:
+    calibration = IncrementalCalibration(cdgeb_utils_1party)
+    log = MeasurementLogReader(measurements_path, offset=os.path.getsize(measurements_path))
+    ...
+    calibration.ingest_log(log)
+    csp_rates = calibration.rates()
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from .CloudServiceUtils import DatasetUtils1Party, continent_indices, pretty_print_rates
+from .aggregation import DEFAULT_AGGREGATION, get_aggregator
+from .parsers import FILE_MEASUREMENTS_1PARTY, MeasurementChunk, MeasurementLogReader
+from .registry import UnknownEntityError
+
+__all__ = ['IncrementalCalibration']
+
+INCREMENTAL_SOURCE = 'incremental measurements'
+
+
+class IncrementalCalibration:
+    """
+    Subtraction-method calibration of a 1-party dataset, updated in O(new rows).
+    New probes, front-ends or files require a full calibration: they raise UnknownEntityError.
+    """
+
+    def __init__(self, cdgeb_utils_1party: DatasetUtils1Party, aggregation=DEFAULT_AGGREGATION):
+        self.utils = cdgeb_utils_1party
+        self.aggregate_measurements = get_aggregator(aggregation)
+
+        measurements = cdgeb_utils_1party.measurements
+        # Running (sum, count) of the aggregated RTTs of every measurement key. The dataset holds one RTT per key.
+        self.key_sums = dict()
+        self.key_counts = dict()
+        for key, rtt in zip(zip(measurements.probe_ids.tolist(), measurements.frontend_ids.tolist(),
+                                measurements.file_ids.tolist()), measurements.rtts.tolist()):
+            self.key_sums[key] = rtt
+            self.key_counts[key] = 1
+
+        # Closest-probe RTTs, as used by the subtraction method
+        utils = cdgeb_utils_1party
+        frontend_ids = np.arange(len(utils.frontend_servers))
+        self.closest_probe_ids = utils.closest_probe_ids
+        self.closest_file_ids = utils.closest_file_ids
+        self.rtts = measurements.lookup(self.closest_probe_ids[:, np.newaxis], frontend_ids[:, np.newaxis],
+                                        np.arange(len(utils.data_files))[np.newaxis, :])
+
+        self.delays = utils.compute_csp_delays_subtraction().values_matrix
+        self.distances = utils.csp_distances.values_matrix
+        self.frontend_continents = continent_indices(utils.frontend_ids)
+        self.file_continents = continent_indices(utils.file_ids)
+
+        self.statistics = utils.evaluate_rate_statistics()
+
+    def _ids_of(self, keys):
+        utils = self.utils
+        ids = list()
+        for probe_name, frontend_name, file_name in keys:
+            for kind, name_ids, name in (('probe', utils.probe_ids.name_ids, probe_name),
+                                         ('frontend', utils.frontend_ids.name_ids, frontend_name),
+                                         ('file', utils.file_ids.name_ids, file_name)):
+                if name not in name_ids:
+                    raise UnknownEntityError(kind, name, INCREMENTAL_SOURCE)
+            ids.append((utils.probe_ids.name_ids[probe_name], utils.frontend_ids.name_ids[frontend_name],
+                        utils.file_ids.name_ids[file_name]))
+        return ids
+
+    def ingest(self, keys: list[tuple[str, str, str]], rtts) -> int:
+        """
+        Ingest aggregated RTTs of new measurement rows.
+
+        @param keys: (probe name, frontend name, file name) of every row.
+        @param rtts: aggregated RTT of every row.
+        return: number of (frontend, file) delays that changed.
+        """
+        touched_cells = set()
+        touched_frontends = set()
+        for key, rtt in zip(self._ids_of(keys), np.asarray(rtts, dtype=float).tolist()):
+            self.key_sums[key] = self.key_sums.get(key, 0.0) + rtt
+            self.key_counts[key] = self.key_counts.get(key, 0) + 1
+
+            probe_id, frontend_id, file_id = key
+            if probe_id != self.closest_probe_ids[frontend_id]:
+                # Not used by the subtraction method
+                continue
+            self.rtts[frontend_id, file_id] = self.key_sums[key] / self.key_counts[key]
+            if file_id == self.closest_file_ids[frontend_id]:
+                touched_frontends.add(frontend_id)
+            else:
+                touched_cells.add((frontend_id, file_id))
+
+        # A new RTT to the closest file shifts every delay of the front-end
+        num_files = self.delays.shape[1]
+        touched_cells = [(frontend_id, file_id) for frontend_id, file_id in touched_cells
+                         if frontend_id not in touched_frontends]
+        touched_cells += [(frontend_id, file_id) for frontend_id in sorted(touched_frontends)
+                          for file_id in range(num_files)]
+        if not touched_cells:
+            return 0
+
+        frontend_ids, file_ids = np.array(touched_cells, dtype=np.intp).T
+        old_delays = self.delays[frontend_ids, file_ids]
+        new_delays = (self.rtts[frontend_ids, file_ids] -
+                      self.rtts[frontend_ids, self.closest_file_ids[frontend_ids]]) / 2
+
+        src_continents, dst_continents = self.frontend_continents[frontend_ids], self.file_continents[file_ids]
+        distances = self.distances[frontend_ids, file_ids]
+        self.statistics.update(src_continents, dst_continents, distances, old_delays, sign=-1)
+        self.statistics.update(src_continents, dst_continents, distances, new_delays)
+
+        # csp_delays of the dataset utils is a view over this matrix
+        self.delays[frontend_ids, file_ids] = new_delays
+        return len(touched_cells)
+
+    def ingest_samples(self, chunk: MeasurementChunk) -> int:
+        """
+        Ingest raw measurement rows (RTT samples), aggregated with the calibration's aggregation.
+        """
+        if not chunk.keys:
+            return 0
+        return self.ingest(chunk.keys, self.aggregate_measurements(chunk.samples))
+
+    def ingest_log(self, log: MeasurementLogReader) -> int:
+        """
+        Ingest the rows appended to a measurement log since the previous call.
+        """
+        return self.ingest_samples(log.read_new_rows())
+
+    def rates(self) -> dict:
+        """
+        Same as DatasetUtils1Party.evaluate_csp_rates, from the maintained statistics. Also updates the dataset utils.
+        """
+        self.utils.csp_rates = self.statistics.rates()
+        return self.utils.csp_rates
+
+    def general_rate(self) -> float:
+        """
+        Same as DatasetUtils1Party.evaluate_csp_general_rate, from the maintained statistics.
+        """
+        return self.statistics.general_rate()
+
+
+def follow_measurement_log(input_dir, interval=10.0, aggregation=DEFAULT_AGGREGATION):
+    """
+    Calibrate on the 1-party dataset of input_dir, then recalibrate every `interval` seconds from the rows
+    appended to its measurements file.
+    """
+    # Imported here: main imports the modules of the whole pipeline
+    from .main import parse_input_files
+
+    cdgeb_utils_1party, _ = parse_input_files(input_dir, aggregation=aggregation)
+    calibration = IncrementalCalibration(cdgeb_utils_1party, aggregation)
+
+    measurements_path = os.path.join(input_dir, FILE_MEASUREMENTS_1PARTY)
+    log = MeasurementLogReader(measurements_path, offset=os.path.getsize(measurements_path))
+
+    pretty_print_rates(calibration.rates())
+    print("Rates within CSP (All measuremenets):", calibration.general_rate())
+    while True:
+        time.sleep(interval)
+        start_time = time.perf_counter()
+        changed_delays = calibration.ingest_log(log)
+        if changed_delays:
+            print(f"[DEBUG] Recalibrated {changed_delays} delays in {time.perf_counter() - start_time:.4f} s")
+            pretty_print_rates(calibration.rates())
+            print("Rates within CSP (All measuremenets):", calibration.general_rate())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recalibrate the CSP rates as 1-party measurements are appended.")
+    parser.add_argument('input_dir')
+    parser.add_argument('--interval', type=float, default=10.0, help="Seconds between log reads")
+    parser.add_argument('--aggregation', default=DEFAULT_AGGREGATION)
+    args = parser.parse_args()
+
+    follow_measurement_log(args.input_dir, args.interval, args.aggregation)
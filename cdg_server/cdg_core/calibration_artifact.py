@@ -0,0 +1,162 @@
+"""
+Versioned calibration artifact: the CSP model learned from a 1-party dataset, saved as JSON.
+
+Geolocating a 3-party batch needs from the 1-party dataset only:
+    - the continent-pair rates (and the general rate, for reference);
+    - the 1-party 2-hop delays, as fingerprints (file datacenter -> front-end datacenter -> delay);
+    - for the subtraction method, per front-end datacenter: the closest probe and the base RTT to the closest file.
+A run can export these once (save_calibration) and later runs load them instead of parsing and calibrating
+the 1-party dataset.
+
+Example usage:
+    artifact = CalibrationArtifact.from_dataset(cdgeb_utils_1party, METHOD_SUBTRACTION, aggregation)
+    artifact.save('calibration.json')
+    ...
+    artifact = CalibrationArtifact.load('calibration.json')
+"""
+
+import os
+import json
+import datetime
+import dataclasses
+import tempfile
+from typing import Optional
+
+from .data_classes import *
+from .aggregation import DEFAULT_AGGREGATION
+from .dataset_cache import hash_input_files
+from .parsers import FILE_DATACENTERS, FILE_SERVERS_1PARTY, FILE_MEASUREMENTS_1PARTY
+from .registry import DatasetRegistry
+
+__all__ = ['ARTIFACT_FORMAT', 'ARTIFACT_VERSION', 'CalibrationArtifact', 'hash_1party_files']
+
+ARTIFACT_FORMAT = 'cdg-calibration'
+ARTIFACT_VERSION = 1
+
+FILES_1PARTY = [FILE_DATACENTERS, FILE_SERVERS_1PARTY, FILE_MEASUREMENTS_1PARTY]
+
+
+def hash_1party_files(input_dir) -> str:
+    """
+    SHA-256 over the content of the files a calibration is learned from.
+    """
+    return hash_input_files(input_dir, filenames=FILES_1PARTY)
+
+
+def _rate_to_json(rate):
+    # JSON has no infinity
+    return None if rate == float('inf') else float(rate)
+
+
+def _rate_from_json(rate):
+    return float('inf') if rate is None else rate
+
+
+@dataclasses.dataclass
+class CalibrationArtifact:
+    rtt_method: str
+    aggregation: str
+    rates: dict[tuple[Continent, Continent], float]
+    general_rate: float
+    datacenters: list[DataCenter]
+    # fingerprints[file datacenter][front-end datacenter] = 2-hop delay,
+    # as FingerprintingUtils.create_1party_fingerprints
+    fingerprints: dict[DataCenter, dict[DataCenter, float]]
+    # baselines[front-end datacenter] = (closest probe, RTT to the closest file). Subtraction method only.
+    baselines: Optional[dict[DataCenter, tuple[ProbeClient, float]]] = None
+    source_hash: Optional[str] = None
+    created_utc: Optional[str] = None
+
+    @classmethod
+    def from_dataset(cls, cdgeb_utils_1party, rtt_method, aggregation=DEFAULT_AGGREGATION, baselines=None,
+                     source_hash=None) -> 'CalibrationArtifact':
+        """
+        Collect the model of a calibrated 1-party dataset (after evaluate_csp_rates_and_rtts).
+        """
+        fingerprints = dict()
+        for (frontend, data_file), delay in cdgeb_utils_1party.csp_delays.items():
+            fingerprints.setdefault(data_file.datacenter, dict())[frontend.datacenter] = delay
+
+        return cls(rtt_method=rtt_method,
+                   aggregation=aggregation,
+                   rates=dict(cdgeb_utils_1party.csp_rates),
+                   general_rate=cdgeb_utils_1party.csp_rate_statistics.general_rate(),
+                   datacenters=list(cdgeb_utils_1party.datacenters),
+                   fingerprints=fingerprints,
+                   baselines=baselines,
+                   source_hash=source_hash,
+                   created_utc=datetime.datetime.now(datetime.UTC).isoformat())
+
+    def to_dict(self) -> dict:
+        return {
+            'format': ARTIFACT_FORMAT,
+            'version': ARTIFACT_VERSION,
+            'created_utc': self.created_utc,
+            'source_hash': self.source_hash,
+            'rtt_method': self.rtt_method,
+            'aggregation': self.aggregation,
+            'datacenters': [[dc.name, dc.coordinates[0], dc.coordinates[1], str(dc.continent)]
+                            for dc in self.datacenters],
+            'rates': [[str(continent_a), str(continent_b), _rate_to_json(rate)]
+                      for (continent_a, continent_b), rate in self.rates.items()],
+            'general_rate': _rate_to_json(self.general_rate),
+            'fingerprints': [[file_dc.name, frontend_dc.name, delay]
+                             for file_dc, fingerprint in self.fingerprints.items()
+                             for frontend_dc, delay in fingerprint.items()],
+            'baselines': None if self.baselines is None else
+            [[dc.name, probe.name, probe.coordinates[0], probe.coordinates[1], str(probe.continent), rtt]
+             for dc, (probe, rtt) in self.baselines.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data) -> 'CalibrationArtifact':
+        if not isinstance(data, dict) or data.get('format') != ARTIFACT_FORMAT:
+            raise ValueError("Not a CDG calibration artifact")
+        if data.get('version') != ARTIFACT_VERSION:
+            raise ValueError(f"Unsupported calibration artifact version: {data.get('version')} "
+                             f"(expected {ARTIFACT_VERSION})")
+
+        datacenters = [DataCenter(name, (lat, lon), Continent(continent))
+                       for name, lat, lon, continent in data['datacenters']]
+        registry = DatasetRegistry(datacenters)
+        source = 'calibration artifact'
+
+        fingerprints = dict()
+        for file_dc_name, frontend_dc_name, delay in data['fingerprints']:
+            fingerprints.setdefault(registry.datacenter(file_dc_name, source), dict())[
+                registry.datacenter(frontend_dc_name, source)] = delay
+
+        baselines = None
+        if data['baselines'] is not None:
+            baselines = {registry.datacenter(dc_name, source):
+                         (ProbeClient(probe_name, (lat, lon), Continent(continent)), rtt)
+                         for dc_name, probe_name, lat, lon, continent, rtt in data['baselines']}
+
+        return cls(rtt_method=data['rtt_method'],
+                   aggregation=data['aggregation'],
+                   rates={(Continent(continent_a), Continent(continent_b)): _rate_from_json(rate)
+                          for continent_a, continent_b, rate in data['rates']},
+                   general_rate=_rate_from_json(data['general_rate']),
+                   datacenters=datacenters,
+                   fingerprints=fingerprints,
+                   baselines=baselines,
+                   source_hash=data.get('source_hash'),
+                   created_utc=data.get('created_utc'))
+
+    def save(self, path):
+        """
+        Write the artifact atomically, so a concurrent load never sees a partial file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.json.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.to_dict(), f)
+        # Artifacts are meant to be shared between runs and servers (mkstemp creates the file owner-only)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path) -> 'CalibrationArtifact':
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
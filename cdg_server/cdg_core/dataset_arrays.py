@@ -0,0 +1,196 @@
+"""
+Array-backed dataset representation.
+
+Entities get dense integer IDs (their position in the dataset's entity list); measurements, delays and distances
+are stored as NumPy arrays indexed by those IDs. The Mapping classes below keep the old tuple-keyed dict interface
+available as a read-only view over the arrays.
+"""
+
+import functools
+from collections.abc import Mapping
+
+import numpy as np
+
+from .data_classes import Continent
+
+__all__ = ['EntityIndex', 'PairMatrix', 'MeasurementArrays']
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    array.setflags(write=False)
+    return array
+
+
+class EntityIndex:
+    """
+    Dense integer IDs of a list of entities, by entity and by name.
+    """
+
+    def __init__(self, entities):
+        self.entities = list(entities)
+        self.ids = dict()
+        self.name_ids = dict()
+        for entity_id, entity in enumerate(self.entities):
+            # First occurrence wins, as with list.index
+            self.ids.setdefault(entity, entity_id)
+            self.name_ids.setdefault(entity.name, entity_id)
+
+    def __len__(self):
+        return len(self.entities)
+
+    # Per-entity arrays, built on first access and shared by every caller: they are read-only.
+    # The entity list is copied, so they never go stale; a new list of entities needs a new EntityIndex.
+
+    @functools.cached_property
+    def locations(self) -> np.ndarray:
+        """
+        (N, 2) (lat, lon) coordinates.
+        """
+        return _read_only(np.array([entity.coordinates for entity in self.entities], dtype=float).reshape(-1, 2))
+
+    @functools.cached_property
+    def continents(self) -> np.ndarray:
+        return _read_only(np.array([entity.continent for entity in self.entities], dtype=object))
+
+    @functools.cached_property
+    def continent_ids(self) -> np.ndarray:
+        """
+        Index of the continent of every entity, in the order of the Continent enum.
+        """
+        continent_ids = {continent: continent_id for continent_id, continent in enumerate(Continent)}
+        return _read_only(np.fromiter((continent_ids[entity.continent] for entity in self.entities), dtype=np.intp,
+                                      count=len(self.entities)))
+
+    @functools.cached_property
+    def names(self) -> np.ndarray:
+        return _read_only(np.array([entity.name for entity in self.entities], dtype=object))
+
+    def ids_of_names(self, names) -> np.ndarray:
+        return np.fromiter((self.name_ids[name] for name in names), dtype=np.intp)
+
+
+class PairMatrix(Mapping):
+    """
+    A (rows x columns) matrix with a read-only dict view keyed by (row entity, column entity),
+    e.g. csp_delays[(frontend, data_file)].
+    """
+
+    def __init__(self, rows, columns, values: np.ndarray):
+        self.rows = rows if isinstance(rows, EntityIndex) else EntityIndex(rows)
+        self.columns = columns if isinstance(columns, EntityIndex) else EntityIndex(columns)
+        self.values_matrix = np.asarray(values, dtype=float)
+        assert self.values_matrix.shape == (len(self.rows), len(self.columns)), "Matrix does not match entities"
+
+    @classmethod
+    def from_mapping(cls, mapping, rows, columns):
+        if isinstance(mapping, PairMatrix):
+            return mapping
+        matrix = cls(rows, columns, np.full((len(rows), len(columns)), np.nan))
+        for (row, column), value in mapping.items():
+            matrix.values_matrix[matrix.rows.ids[row], matrix.columns.ids[column]] = value
+        return matrix
+
+    def __getitem__(self, key):
+        row, column = key
+        try:
+            return float(self.values_matrix[self.rows.ids[row], self.columns.ids[column]])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        try:
+            row, column = key
+        except (TypeError, ValueError):
+            return False
+        return row in self.rows.ids and column in self.columns.ids
+
+    def __iter__(self):
+        for row in self.rows.entities:
+            for column in self.columns.entities:
+                yield row, column
+
+    def __len__(self):
+        return len(self.rows) * len(self.columns)
+
+    def row(self, row) -> np.ndarray:
+        return self.values_matrix[self.rows.ids[row]]
+
+    def column(self, column) -> np.ndarray:
+        return self.values_matrix[:, self.columns.ids[column]]
+
+
+class MeasurementArrays(Mapping):
+    """
+    Aggregated RTT measurements as parallel (probe ID, frontend ID, file ID, rtt) arrays,
+    with a read-only dict view keyed by (probe name, frontend name, file name).
+    """
+
+    def __init__(self, probes: EntityIndex, frontends: EntityIndex, files: EntityIndex,
+                 probe_ids: np.ndarray, frontend_ids: np.ndarray, file_ids: np.ndarray, rtts: np.ndarray):
+        self.probes, self.frontends, self.files = probes, frontends, files
+        self.probe_ids = np.asarray(probe_ids, dtype=np.intp)
+        self.frontend_ids = np.asarray(frontend_ids, dtype=np.intp)
+        self.file_ids = np.asarray(file_ids, dtype=np.intp)
+        self.rtts = np.asarray(rtts, dtype=float)
+
+        # Sorted flat codes allow vectorized lookups of arbitrary (probe, frontend, file) triplets
+        codes = self._codes(self.probe_ids, self.frontend_ids, self.file_ids)
+        self._order = np.argsort(codes, kind='stable')
+        self._sorted_codes = codes[self._order]
+        self._num_keys = int(np.count_nonzero(np.diff(self._sorted_codes))) + 1 if len(codes) else 0
+
+    @classmethod
+    def from_mapping(cls, measurements, probes: EntityIndex, frontends: EntityIndex, files: EntityIndex):
+        if isinstance(measurements, MeasurementArrays):
+            return measurements
+        keys = list(measurements)
+        return cls(probes, frontends, files,
+                   probes.ids_of_names(key[0] for key in keys),
+                   frontends.ids_of_names(key[1] for key in keys),
+                   files.ids_of_names(key[2] for key in keys),
+                   np.fromiter(measurements.values(), dtype=float, count=len(keys)))
+
+    def _codes(self, probe_ids, frontend_ids, file_ids):
+        return (np.asarray(probe_ids) * len(self.frontends) + np.asarray(frontend_ids)) * len(self.files) + \
+            np.asarray(file_ids)
+
+    def lookup(self, probe_ids, frontend_ids, file_ids) -> np.ndarray:
+        """
+        Vectorized lookup of the RTTs of (probe ID, frontend ID, file ID) triplets. Broadcasts its arguments.
+        Missing measurements are NaN.
+        """
+        codes = self._codes(*np.broadcast_arrays(probe_ids, frontend_ids, file_ids))
+        if len(self._sorted_codes) == 0:
+            return np.full(codes.shape, np.nan)
+
+        # With duplicated keys the last row wins, like updating a dict
+        positions = np.searchsorted(self._sorted_codes, codes, side='right') - 1
+        found = (positions >= 0) & (self._sorted_codes[np.maximum(positions, 0)] == codes)
+        return np.where(found, self.rtts[self._order[np.maximum(positions, 0)]], np.nan)
+
+    def __getitem__(self, key):
+        probe_name, frontend_name, file_name = key
+        try:
+            ids = self.probes.name_ids[probe_name], self.frontends.name_ids[frontend_name], \
+                self.files.name_ids[file_name]
+        except KeyError:
+            raise KeyError(key) from None
+        rtt = self.lookup(*ids)
+        if np.isnan(rtt):
+            raise KeyError(key)
+        return float(rtt)
+
+    def __iter__(self):
+        probe_names = [probe.name for probe in self.probes.entities]
+        frontend_names = [frontend.name for frontend in self.frontends.entities]
+        file_names = [data_file.name for data_file in self.files.entities]
+        seen = set()
+        for probe_id, frontend_id, file_id in zip(self.probe_ids.tolist(), self.frontend_ids.tolist(),
+                                                  self.file_ids.tolist()):
+            key = (probe_names[probe_id], frontend_names[frontend_id], file_names[file_id])
+            if key not in seen:
+                seen.add(key)
+                yield key
+
+    def __len__(self):
+        return self._num_keys
@@ -0,0 +1,243 @@
+"""
+Compiled (binary) dataset cache.
+
+The first parse of an input directory writes its entity tables, measurement index and raw RTT samples
+to <cache_dir>/<input hash>/. Later runs on the same input files memory-map the arrays instead of parsing the CSVs.
+
+Layout of a cache entry:
+    meta.json                          entity tables and measurement name tables
+    <party>-keys.npy                   (n_rows, 3) int32 indices into the party's measurement name tables
+    <party>-samples.npy                (n_rows, n_samples) float64 raw RTTs
+    <party>-aggregated-<spec>.npy      (n_rows,) float64 aggregated RTTs, one file per aggregation spec
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+from .data_classes import *
+from .aggregation import DEFAULT_AGGREGATION, get_aggregator
+from .parsers import *
+from .parsers import FILE_MEASUREMENTS_1PARTY, FILE_SERVERS_1PARTY, FILE_DATACENTERS, FILE_MEASUREMENTS_3PARTY, \
+    FILE_SERVERS_3PARTY, FILE_SOLUTION, MEASUREMENT_CHUNK_ROWS
+from .registry import DatasetRegistry
+from .dataset_arrays import EntityIndex, MeasurementArrays
+
+__all__ = ['PARTY_1', 'PARTY_3', 'CompiledDataset', 'hash_input_files', 'write_dataset_cache', 'load_dataset']
+
+CACHE_FORMAT_VERSION = 1
+CACHE_META_FILE = 'meta.json'
+
+PARTY_1 = '1party'
+PARTY_3 = '3party'
+
+MEASUREMENT_FILES = {PARTY_1: FILE_MEASUREMENTS_1PARTY, PARTY_3: FILE_MEASUREMENTS_3PARTY}
+
+
+def hash_input_files(input_dir, testing_mode=False, filenames=None) -> str:
+    """
+    SHA-256 over the content of the input files (and the cache format version).
+
+    @param input_dir: a directory or a mapping of file name -> content, see parsers.open_input_file.
+    @param filenames: the files to hash. Default: all the input files of a run.
+    """
+    if filenames is None:
+        filenames = [FILE_DATACENTERS, FILE_SERVERS_1PARTY, FILE_MEASUREMENTS_1PARTY, FILE_SERVERS_3PARTY,
+                     FILE_MEASUREMENTS_3PARTY]
+        if testing_mode:
+            filenames.append(FILE_SOLUTION)
+
+    digest = hashlib.sha256(f'cdg-dataset-v{CACHE_FORMAT_VERSION}'.encode())
+    for filename in filenames:
+        digest.update(filename.encode())
+        with open_input_file(input_dir, filename, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _aggregated_filename(party, aggregation):
+    slug = aggregation.replace(':', '-').replace('.', '_')
+    return f'{party}-aggregated-{slug}.npy'
+
+
+def _save_array(path, array):
+    """
+    Write an .npy file atomically, so concurrent readers never see a partial file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(temp_path, path)
+
+
+def _datacenter_table(datacenters, possible_file_datacenters):
+    possible_names = set(dc.name for dc in possible_file_datacenters)
+    return [[dc.name, dc.coordinates[0], dc.coordinates[1], str(dc.continent), dc.name in possible_names]
+            for dc in datacenters]
+
+
+def _servers_table(probe_clients, frontend_servers, data_files):
+    return {
+        'probes': [[probe.name, probe.coordinates[0], probe.coordinates[1], str(probe.continent)]
+                   for probe in probe_clients],
+        'frontends': [[frontend.name, frontend.datacenter.name] for frontend in frontend_servers],
+        'files': [[data_file.name, data_file.datacenter.name if data_file.datacenter else None]
+                  for data_file in data_files],
+    }
+
+
+def write_dataset_cache(input_dir, cache_path, testing_mode=False):
+    """
+    Parse the input CSVs once and write them as a compiled dataset at cache_path.
+    """
+    datacenters, possible_file_datacenters = parse_datacenters(input_dir)
+    registry = DatasetRegistry(datacenters)
+    meta = {
+        'format_version': CACHE_FORMAT_VERSION,
+        'testing_mode': testing_mode,
+        'datacenters': _datacenter_table(datacenters, possible_file_datacenters),
+        'solution': None,
+    }
+
+    parent_dir = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=parent_dir, prefix='.building-')
+    try:
+        for party, parse_servers in ((PARTY_1, parse_servers_1party), (PARTY_3, parse_servers_3party)):
+            probe_clients, frontend_servers, data_files = parse_servers(input_dir, registry)
+            samples = load_measurement_samples(os.path.join(input_dir, MEASUREMENT_FILES[party]))
+
+            # Index the (probe, frontend, file) names of every row
+            name_tables, key_columns = list(), list()
+            for column in range(3):
+                names, indices = np.unique(np.array([key[column] for key in samples.keys], dtype=object),
+                                           return_inverse=True)
+                name_tables.append([str(name) for name in names])
+                key_columns.append(indices.reshape(-1))
+            keys = np.stack(key_columns, axis=1).astype(np.int32) if samples.keys else np.empty((0, 3), np.int32)
+
+            meta[party] = _servers_table(probe_clients, frontend_servers, data_files)
+            meta[party]['measurement_names'] = name_tables
+
+            np.save(os.path.join(temp_path, f'{party}-keys.npy'), keys)
+            np.save(os.path.join(temp_path, f'{party}-samples.npy'), samples.samples)
+            np.save(os.path.join(temp_path, _aggregated_filename(party, DEFAULT_AGGREGATION)),
+                    get_aggregator(DEFAULT_AGGREGATION)(samples.samples))
+
+            if party == PARTY_3 and testing_mode:
+                solution = parse_solution(input_dir, registry, data_files)
+                meta['solution'] = [[data_file.name, datacenter.name] for data_file, datacenter in solution.items()]
+
+        # The metadata is written last: its presence marks a complete cache entry
+        with open(os.path.join(temp_path, CACHE_META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.isdir(cache_path):
+            # Built concurrently by another run
+            shutil.rmtree(temp_path)
+        else:
+            os.replace(temp_path, cache_path)
+    except BaseException:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+
+class CompiledDataset:
+    """
+    A compiled dataset loaded from the cache. RTT arrays are memory-mapped.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        with open(os.path.join(cache_path, CACHE_META_FILE), 'r') as f:
+            self.meta = json.load(f)
+
+        if self.meta.get('format_version') != CACHE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported dataset cache format: {self.meta.get('format_version')}")
+
+        self.datacenters = list()
+        self.possible_file_datacenters = list()
+        for name, lat, lon, continent, possible in self.meta['datacenters']:
+            datacenter = DataCenter(name, (lat, lon), Continent(continent))
+            self.datacenters.append(datacenter)
+            if possible:
+                self.possible_file_datacenters.append(datacenter)
+        registry = DatasetRegistry(self.datacenters)
+
+        self.servers = dict()
+        self.keys = dict()
+        self.samples = dict()
+        for party in (PARTY_1, PARTY_3):
+            table = self.meta[party]
+            probe_clients = [registry.intern(ProbeClient(name, (lat, lon), Continent(continent)))
+                             for name, lat, lon, continent in table['probes']]
+            frontend_servers = [registry.intern(FrontEnd(name, registry.datacenter(dc_name)))
+                                for name, dc_name in table['frontends']]
+            data_files = [registry.intern(DataFile(name, registry.datacenter(dc_name) if dc_name else None))
+                          for name, dc_name in table['files']]
+            self.servers[party] = (probe_clients, frontend_servers, data_files)
+
+            self.keys[party] = np.load(os.path.join(cache_path, f'{party}-keys.npy'), mmap_mode='r')
+            self.samples[party] = np.load(os.path.join(cache_path, f'{party}-samples.npy'), mmap_mode='r')
+
+        self.solution = None
+        if self.meta['solution'] is not None:
+            registry.add(data_files=self.servers[PARTY_3][2])
+            self.solution = {registry.data_file(file_name): registry.datacenter(dc_name)
+                             for file_name, dc_name in self.meta['solution']}
+
+    def aggregated(self, party, aggregation=DEFAULT_AGGREGATION) -> np.ndarray:
+        """
+        Aggregated RTT of every measurement row. Computed from the raw samples (in chunks) on first use
+        of an aggregation spec, then cached alongside the raw arrays.
+        """
+        path = os.path.join(self.cache_path, _aggregated_filename(party, aggregation))
+        if os.path.isfile(path):
+            return np.load(path, mmap_mode='r')
+
+        aggregate_measurements = get_aggregator(aggregation)
+        samples = self.samples[party]
+        aggregated = np.concatenate([aggregate_measurements(np.asarray(samples[start:start + MEASUREMENT_CHUNK_ROWS]))
+                                     for start in range(0, len(samples), MEASUREMENT_CHUNK_ROWS)]) \
+            if len(samples) else np.empty(0)
+        try:
+            _save_array(path, aggregated)
+        except OSError as e:
+            print("[WARNING] Could not cache aggregated measurements:", e)
+        return aggregated
+
+    def measurements(self, party, aggregation=DEFAULT_AGGREGATION):
+        """
+        The measurements of a party, as MeasurementArrays (read as the dict returned by parse_measurements).
+        Built from the memory-mapped arrays: the measurement name tables are validated and mapped to entity IDs,
+        the rows are never turned into Python objects.
+        """
+        name_tables = self.meta[party]['measurement_names']
+        if not validate_measurement_names(*(set(names) for names in name_tables), *self.servers[party]):
+            # Already logged inside
+            return False
+
+        entity_indexes = [EntityIndex(entities) for entities in self.servers[party]]
+        keys = np.asarray(self.keys[party])
+        entity_ids = [entity_index.ids_of_names(names)[keys[:, column]]
+                      for column, (entity_index, names) in enumerate(zip(entity_indexes, name_tables))]
+        return MeasurementArrays(*entity_indexes, *entity_ids, self.aggregated(party, aggregation))
+
+
+def load_dataset(input_dir, cache_dir, testing_mode=False) -> CompiledDataset:
+    """
+    Load the compiled dataset of the input files from cache_dir, compiling it first if needed.
+    """
+    cache_path = os.path.join(cache_dir, hash_input_files(input_dir, testing_mode))
+    if not os.path.isfile(os.path.join(cache_path, CACHE_META_FILE)):
+        print("[DEBUG] Compiling dataset cache:", cache_path)
+        write_dataset_cache(input_dir, cache_path, testing_mode)
+    else:
+        print("[DEBUG] Loading dataset from cache:", cache_path)
+
+    return CompiledDataset(cache_path)
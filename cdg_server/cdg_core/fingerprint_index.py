@@ -0,0 +1,190 @@
+"""
+Candidate index over the fingerprints of a (possibly very large) catalog of candidate datacenters.
+
+The fingerprints of the candidates are kept L2-normalized in one contiguous (candidates x dimensions) array.
+A query runs in two steps:
+    1. candidate generation - all candidates (INDEX_EXACT), the candidates of the closest partitions (INDEX_IVF),
+       or the candidates with the closest random-projection signatures (INDEX_RANDOM_PROJECTION);
+    2. exact re-ranking of the generated candidates with the cosine similarity restricted to the dimensions
+       present in the feature vector.
+
+Missing dimensions (NaN in the feature vector) are zero-filled for candidate generation and masked out of the
+fingerprints during re-ranking, so the index never has to be rebuilt for a different set of front-ends.
+
+Example usage:
+    index = FingerprintIndex(store, possible_file_datacenters, mode=INDEX_IVF)
+    candidates, scores = index.query(features, k=5)
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+__all__ = ['INDEX_EXACT', 'INDEX_IVF', 'INDEX_RANDOM_PROJECTION', 'INDEX_MODES', 'FingerprintIndex']
+
+INDEX_EXACT = "exact"
+INDEX_IVF = "ivf"
+INDEX_RANDOM_PROJECTION = "random_projection"
+INDEX_MODES = [INDEX_EXACT, INDEX_IVF, INDEX_RANDOM_PROJECTION]
+
+# Fixed seed, so that the same catalog always builds the same index
+INDEX_SEED = 0
+KMEANS_ITERATIONS = 25
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _spherical_kmeans(vectors: np.ndarray, num_clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    K-means on the unit sphere (cosine similarity). Returns the normalized centroids.
+    """
+    centroids = vectors[rng.choice(len(vectors), size=num_clusters, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        membership = csr_matrix((np.ones(len(vectors)), (assignment, np.arange(len(vectors)))),
+                                shape=(num_clusters, len(vectors)))
+        sums = membership @ vectors
+        counts = np.bincount(assignment, minlength=num_clusters)
+
+        # Empty clusters keep their previous centroid
+        new_centroids = np.where(counts[:, np.newaxis] > 0, _normalize_rows(sums), centroids)
+        if np.allclose(new_centroids, centroids):
+            break
+        centroids = new_centroids
+    return centroids
+
+
+class FingerprintIndex:
+    """
+    Top-k fingerprint matching over a fixed list of candidate datacenters.
+    """
+
+    def __init__(self, store, candidates: list, mode: str = INDEX_EXACT, num_lists: int = None,
+                 num_probes: int = None, num_bits: int = 16, num_candidates: int = None):
+        """
+        @param store: FingerprintStore with the fingerprints of the candidates.
+        @param candidates: the candidate datacenters.
+        @param mode: INDEX_EXACT, INDEX_IVF or INDEX_RANDOM_PROJECTION.
+        @param num_lists: IVF - number of partitions. Default: sqrt(candidates).
+        @param num_probes: IVF - number of partitions searched per query. Default: a quarter of the partitions.
+        @param num_bits: random projection - length of the signatures.
+        @param num_candidates: random projection - candidates re-ranked per query. Default: 4 * sqrt(candidates).
+        """
+        if mode not in INDEX_MODES:
+            raise ValueError(f"Unknown fingerprint index mode: {mode}. Expected one of: {', '.join(INDEX_MODES)}")
+
+        self.store = store
+        self.candidates = list(candidates)
+        self.mode = mode
+        self.candidate_ids = np.array([store.datacenters.ids[datacenter] for datacenter in self.candidates],
+                                      dtype=np.intp)
+        self.vectors = np.ascontiguousarray(_normalize_rows(store.matrix[self.candidate_ids]))
+
+        num_candidates_total = len(self.candidates)
+        rng = np.random.default_rng(INDEX_SEED)
+
+        if mode == INDEX_IVF and num_candidates_total > 0:
+            num_lists = num_lists or max(1, int(np.sqrt(num_candidates_total)))
+            num_lists = min(num_lists, num_candidates_total)
+            self.centroids = _spherical_kmeans(self.vectors, num_lists, rng)
+            assignment = np.argmax(self.vectors @ self.centroids.T, axis=1)
+            self.lists = [np.flatnonzero(assignment == cluster) for cluster in range(num_lists)]
+            # Raw fingerprints of each partition in their own contiguous block, for the re-ranking products
+            self.list_fingerprints = [np.ascontiguousarray(store.matrix[self.candidate_ids[positions]])
+                                      for positions in self.lists]
+            self.num_probes = min(num_probes or max(1, num_lists // 4), num_lists)
+
+        if mode == INDEX_RANDOM_PROJECTION:
+            # Fingerprints are all-positive delays: center them, or every signature lands in the same orthant
+            self.center = self.vectors.mean(axis=0)
+            self.planes = rng.standard_normal((self.vectors.shape[1], num_bits))
+            self.signatures = (self.vectors - self.center) @ self.planes > 0
+            self.num_candidates = num_candidates or max(1, 4 * int(np.sqrt(num_candidates_total)))
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def _rerank(self, feature: np.ndarray, positions: np.ndarray, dots: np.ndarray = None) -> np.ndarray:
+        """
+        Exact cosine similarity of a single feature vector and the candidates at the given positions,
+        restricted to the dimensions present in the feature vector.
+
+        The restricted fingerprint norms are summed over the present dimensions, or derived from the cached full
+        norms minus the missing dimensions, whichever touches fewer columns.
+        """
+        is_missing = np.isnan(feature)
+        missing, present = np.flatnonzero(is_missing), np.flatnonzero(~is_missing)
+        values = np.nan_to_num(feature, nan=0.0)
+        candidate_ids = self.candidate_ids[positions]
+
+        if dots is None:
+            dots = self.store.matrix[np.ix_(candidate_ids, present)] @ values[present]
+        if len(missing) <= len(present):
+            squared_norms = self.store.row_norms[candidate_ids] ** 2
+            if len(missing):
+                squared_norms = squared_norms - self.store.squared[np.ix_(candidate_ids, missing)].sum(axis=1)
+        else:
+            squared_norms = self.store.squared[np.ix_(candidate_ids, present)].sum(axis=1)
+
+        norms = np.linalg.norm(values) * np.sqrt(np.maximum(squared_norms, 0.0))
+        similarity = np.divide(dots, norms, out=np.full(dots.shape, -np.inf), where=norms > 0)
+        similarity[~self.store.has_fingerprint[candidate_ids]] = -np.inf
+        return similarity
+
+    def _search(self, feature: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Candidate generation and re-ranking of a single feature vector.
+        return: (positions, similarities) of the re-ranked candidates, in candidate list order.
+        """
+        values = np.nan_to_num(feature, nan=0.0)
+        query = values / (np.linalg.norm(values) or 1.0)
+
+        dots = None
+        if self.mode == INDEX_IVF:
+            closest_lists = np.argsort(-(self.centroids @ query), kind='stable')[:self.num_probes]
+            positions = np.concatenate([self.lists[cluster] for cluster in closest_lists])
+            dots = np.concatenate([self.list_fingerprints[cluster] @ values for cluster in closest_lists])
+        else:
+            # INDEX_RANDOM_PROJECTION
+            hamming = np.count_nonzero(self.signatures != ((query - self.center) @ self.planes > 0), axis=1)
+            num_candidates = min(max(self.num_candidates, k), len(self))
+            positions = np.argpartition(hamming, num_candidates - 1)[:num_candidates]
+
+        if len(positions) < k:
+            # Not enough candidates in the probed partitions: fall back to the approximate scores of all candidates
+            positions, dots = np.argsort(-(self.vectors @ query), kind='stable')[:k], None
+
+        order = np.argsort(positions, kind='stable')
+        positions = positions[order]
+        return positions, self._rerank(feature, positions, dots[order] if dots is not None else None)
+
+    def query(self, features: np.ndarray, k: int = 1) -> tuple[list[list], np.ndarray]:
+        """
+        Top-k candidates of every feature vector.
+
+        @param features: (targets x dimensions) array, NaN for missing dimensions.
+        return: (candidates, scores). candidates[t] lists the k best datacenters of target t, best first;
+                scores is the matching (targets x k) array of cosine similarities (-inf when there is no fingerprint).
+        """
+        features = np.atleast_2d(np.asarray(features, dtype=float))
+        k = min(k, len(self))
+        if self.mode == INDEX_EXACT:
+            # Every candidate is re-ranked: score all targets in a single matrix product
+            positions = np.arange(len(self))
+            results = zip([positions] * len(features), self.store.similarities(features, self.candidate_ids))
+        else:
+            results = (self._search(feature, k) for feature in features)
+
+        matches = list()
+        scores = np.full((len(features), k), -np.inf)
+        for row, (positions, similarity) in enumerate(results):
+            similarity = np.nan_to_num(similarity, nan=-np.inf)
+
+            # Stable sort: ties keep the order of the candidate list
+            best = np.argsort(-similarity, kind='stable')[:k]
+            matches.append([self.candidates[position] for position in positions[best]])
+            scores[row, :len(best)] = similarity[best]
+
+        return matches, scores
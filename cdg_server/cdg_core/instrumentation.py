@@ -0,0 +1,221 @@
+"""
+Per-stage instrumentation of the geolocation pipeline: wall time, CPU time, peak memory and counts.
+
+A PipelineReport records one StageStats per stage (see report.stage()). While a stage runs, code deeper in the
+pipeline adds counts to it with record(), e.g. the iterations of an optimizer; record() does nothing when no stage
+is running on the current thread, so the pipeline runs the same without a report.
+
+Memory: max_rss is the peak resident set size of the process at the end of the stage (not available on Windows).
+With trace_memory, peak_memory is also traced with tracemalloc (NumPy reports its buffers to it), as the peak above
+the memory in use when the stage starts. Tracing slows down allocations a lot, so it is off by default; it is also
+process-wide: when several requests run at once, their peaks overlap.
+CPU time is the CPU time of the calling thread: worker processes (--workers) and BLAS threads are not included.
+
+Optionally, the whole run is profiled with cProfile or pyinstrument (if installed), see profile_run().
+
+Example usage:
+    report = PipelineReport()
+    with report.stage(STAGE_PARSE):
+        ...
+        record('measurement_rows', rows)
+    print_stage_report(report)
+    json.dumps(report.to_dict())
+"""
+
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import dataclasses
+from typing import Optional
+
+from rich.console import Console
+from rich.table import Table
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+__all__ = ['STAGE_PARSE', 'STAGE_VALIDATE', 'STAGE_CALIBRATION', 'STAGE_GEOLOCATION', 'STAGE_APPLY_CALIBRATION',
+           'PROFILER_CPROFILE', 'PROFILER_PYINSTRUMENT', 'PROFILERS', 'record', 'StageStats', 'PipelineReport',
+           'print_stage_report', 'profile_run']
+
+# Stages of geolocation_main
+STAGE_PARSE = 'parse'  # parse_input_files
+STAGE_VALIDATE = 'validate'  # validate_inputs
+STAGE_CALIBRATION = 'calibration'  # calibrate_csp and apply_calibration (evaluate_csp_rates_and_rtts)
+STAGE_GEOLOCATION = 'geolocation'  # geolocate_from_data, including the maps (but not the background ones)
+# Service solves (service.SolverService): calibration is the 1-party calibration (or its cache lookup), done before
+# parsing the 3-party files; applying it to them is a stage of its own
+STAGE_APPLY_CALIBRATION = 'apply_calibration'  # apply_calibration
+
+PROFILER_CPROFILE = 'cprofile'
+PROFILER_PYINSTRUMENT = 'pyinstrument'
+PROFILERS = [PROFILER_CPROFILE, PROFILER_PYINSTRUMENT]
+
+# Functions listed in a cProfile report
+PROFILE_TOP_FUNCTIONS = 30
+
+_local = threading.local()
+
+
+def _max_rss() -> Optional[int]:
+    """
+    Peak resident set size of the process, in bytes.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def record(name, value=1):
+    """
+    Add value to the count `name` of the stage running on the current thread, if any.
+    """
+    stats = getattr(_local, 'stage', None)
+    if stats is not None:
+        stats.counts[name] = stats.counts.get(name, 0) + value
+
+
+@dataclasses.dataclass
+class StageStats:
+    name: str
+    wall_time: float = 0.0  # Seconds
+    cpu_time: float = 0.0  # Seconds, of the calling thread
+    max_rss: Optional[int] = None  # Bytes, peak of the process so far
+    peak_memory: Optional[int] = None  # Bytes above the memory in use at the start. None: not traced
+    counts: dict = dataclasses.field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {'wall_time': self.wall_time, 'cpu_time': self.cpu_time, 'max_rss': self.max_rss,
+                'peak_memory': self.peak_memory, 'counts': self.counts}
+
+
+class PipelineReport:
+    """
+    Stats of the stages of a run, in the order they ran. A stage that runs again is accumulated into the same stats.
+    Stages don't nest: a nested stage would reset the memory peak of the outer one.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages: dict[str, StageStats] = dict()
+        # Text report of profile_run(), if the run was profiled
+        self.profile: Optional[str] = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stats = self.stages.setdefault(name, StageStats(name))
+        previous = getattr(_local, 'stage', None)
+        _local.stage = stats
+
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+
+        start_time, start_cpu_time = time.perf_counter(), time.thread_time()
+        try:
+            yield stats
+        finally:
+            stats.wall_time += time.perf_counter() - start_time
+            stats.cpu_time += time.thread_time() - start_cpu_time
+            stats.max_rss = _max_rss()
+            if self.trace_memory:
+                # Another thread may have stopped tracing meanwhile
+                peak_memory = max(0, tracemalloc.get_traced_memory()[1] - start_memory)
+                stats.peak_memory = max(stats.peak_memory or 0, peak_memory)
+            if started_tracing:
+                tracemalloc.stop()
+            _local.stage = previous
+
+    @property
+    def total_time(self) -> float:
+        return sum(stats.wall_time for stats in self.stages.values())
+
+    def to_dict(self) -> dict:
+        report = {'stages': {name: stats.to_dict() for name, stats in self.stages.items()},
+                  'total_time': self.total_time}
+        if self.profile is not None:
+            report['profile'] = self.profile
+        return report
+
+
+def print_stage_report(report: PipelineReport):
+    table = Table(title="Pipeline Stages", show_header=True, header_style="bold cyan")
+
+    table.add_column("Stage", justify="center")
+    table.add_column("Wall [s]", justify="center")
+    table.add_column("CPU [s]", justify="center")
+    table.add_column("Max RSS [MB]", justify="center")
+    table.add_column("Traced Peak [MB]", justify="center")
+
+    def megabytes(size):
+        return '-' if size is None else f"{size / 2 ** 20:.2f}"
+
+    for stats in report.stages.values():
+        table.add_row(stats.name, f"{stats.wall_time:.4f}", f"{stats.cpu_time:.4f}", megabytes(stats.max_rss),
+                      megabytes(stats.peak_memory))
+
+    counts_table = Table(title="Stage Counts", show_header=True, header_style="bold cyan")
+
+    counts_table.add_column("Stage", justify="center")
+    counts_table.add_column("Count", justify="left")
+    counts_table.add_column("Value", justify="right")
+
+    for stats in report.stages.values():
+        for name, value in stats.counts.items():
+            counts_table.add_row(stats.name, name, str(value))
+
+    console = Console()
+    console.print(table)
+    console.print(counts_table)
+
+
+@contextlib.contextmanager
+def profile_run(report: PipelineReport, profiler=PROFILER_CPROFILE):
+    """
+    Profile the calling thread while the block runs, and keep the text report in report.profile.
+    An unavailable profiler (pyinstrument not installed, another profiler already active) is logged and skipped.
+    """
+    if profiler == PROFILER_PYINSTRUMENT:
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("[ERROR] pyinstrument is not installed, the run is not profiled")
+            yield
+            return
+        profile = Profiler()
+        start, stop = profile.start, profile.stop
+    else:
+        profile = cProfile.Profile()
+        start, stop = profile.enable, profile.disable
+
+    try:
+        start()
+    except (RuntimeError, ValueError) as e:
+        print("[WARNING] The run is not profiled:", e)
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        stop()
+        if profiler == PROFILER_PYINSTRUMENT:
+            report.profile = profile.output_text()
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats(pstats.SortKey.CUMULATIVE) \
+                .print_stats(PROFILE_TOP_FUNCTIONS)
+            report.profile = stream.getvalue()
@@ -0,0 +1,162 @@
+"""
+Asynchronous geolocation jobs on top of SolverService.
+
+Jobs run on a bounded pool of worker threads that share the service and its warm calibration cache (the heavy
+parts run in NumPy/SciPy, and multilateration can itself use worker processes, see SolverService.workers).
+At most max_workers jobs run at a time and at most max_queued more wait for a worker; beyond that, submit()
+raises QueueFullError so the caller can push back (HTTP 503) instead of piling up work.
+
+Example usage:
+    queue = JobQueue(SolverService(), max_workers=4, max_queued=32)
+    job = queue.submit(files, METHOD_SUBTRACTION, METHOD_MULTILATERATION)
+    ...
+    queue.get(job.job_id).status_dict()
+"""
+
+import time
+import uuid
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from .service import SOLVE_STAGES, SolveResult, SolverService
+
+__all__ = ['JOB_QUEUED', 'JOB_RUNNING', 'JOB_DONE', 'JOB_FAILED', 'QueueFullError', 'Job', 'JobQueue']
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'  # Solved successfully
+JOB_FAILED = 'failed'  # Invalid inputs (see the output) or an unexpected error
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_MAX_QUEUED = 16
+# Finished jobs kept for their results to be fetched. The oldest ones are dropped first.
+DEFAULT_MAX_FINISHED = 256
+
+
+class QueueFullError(RuntimeError):
+    """
+    Raised by JobQueue.submit when max_queued jobs are already waiting for a worker.
+    """
+
+
+def _utc_now() -> str:
+    return datetime.datetime.now(datetime.UTC).isoformat()
+
+
+class Job:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.status = JOB_QUEUED
+        self.stage = None
+        self.created_utc = _utc_now()
+        self.started_utc = None
+        self.finished_utc = None
+        self.result: Optional[SolveResult] = None
+        self.error = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    @property
+    def progress(self) -> float:
+        """
+        Fraction of the solve stages completed.
+        """
+        if self.finished:
+            return 1.0
+        if self.stage is None:
+            return 0.0
+        return SOLVE_STAGES.index(self.stage) / len(SOLVE_STAGES)
+
+    def status_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'created_utc': self.created_utc,
+            'started_utc': self.started_utc,
+            'finished_utc': self.finished_utc,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """
+    Bounded, thread-safe job queue. Jobs are solved in submission order.
+    """
+
+    def __init__(self, service: SolverService, max_workers=DEFAULT_MAX_WORKERS, max_queued=DEFAULT_MAX_QUEUED,
+                 max_finished=DEFAULT_MAX_FINISHED):
+        self.service = service
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cdg-job')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def counts(self) -> dict[str, int]:
+        with self.lock:
+            counts = {status: 0 for status in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED)}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def submit(self, files, rtt_method, geolocation_method, aggregation, calibration=None, profile=None) -> Job:
+        """
+        Queue a solve (see SolverService.solve).
+        Raises QueueFullError when max_queued jobs are already waiting.
+        """
+        with self.lock:
+            queued = sum(1 for job in self.jobs.values() if job.status == JOB_QUEUED)
+            if queued >= self.max_queued:
+                raise QueueFullError(f"{queued} jobs are already waiting, try again later")
+
+            job = Job(uuid.uuid4().hex)
+            self.jobs[job.job_id] = job
+            self._drop_finished()
+
+        self.executor.submit(self._run, job, files, rtt_method, geolocation_method, aggregation, calibration, profile)
+        return job
+
+    def get(self, job_id) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _drop_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def _run(self, job: Job, files, rtt_method, geolocation_method, aggregation, calibration, profile):
+        job.status = JOB_RUNNING
+        job.started_utc = _utc_now()
+        start_time = time.perf_counter()
+
+        def progress(stage):
+            job.stage = stage
+
+        try:
+            job.result = self.service.solve(files, rtt_method, geolocation_method, aggregation, calibration, progress,
+                                            profile)
+            status = JOB_DONE if job.result.success else JOB_FAILED
+        except Exception as e:
+            print(f"[ERROR] Job {job.job_id} failed:", e)
+            job.error = str(e)
+            status = JOB_FAILED
+
+        # The status is set last: a finished job is complete
+        job.finished_utc = _utc_now()
+        job.status = status
+        print(f"[DEBUG] Job {job.job_id} {status} in {time.perf_counter() - start_time:.3f} s")
+
+        with self.lock:
+            self._drop_finished()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
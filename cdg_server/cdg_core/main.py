@@ -1,5 +1,11 @@
 import os
-import sys
+import json
+import argparse
+import contextlib
+import dataclasses
+from concurrent.futures import Future
+from typing import Optional
+
 import numpy as np
 from rich.console import Console
 from rich.table import Table
@@ -7,27 +13,78 @@ from rich.table import Table
 from .CloudServiceUtils import *
 from .GeolocationUtils import MultilaterationUtils, FingerprintingUtils
 from .data_classes import *
-from .plot_map import MapBuilder
+from .plot_map import MAPS_NONE, MAPS_GEOJSON, MAPS_BACKGROUND, MAPS_HTML, MAP_MODES, TargetMap, \
+    save_all_targets_map, write_results_geojson
+from .parallel import geolocate_targets_parallel, save_target_maps, save_maps_in_background
 from .parsers import *
+from .aggregation import DEFAULT_AGGREGATION, is_valid_aggregation
+from .dataset_cache import PARTY_1, PARTY_3, load_dataset
+from .fingerprint_index import INDEX_EXACT, INDEX_MODES
+from .calibration_artifact import CalibrationArtifact, hash_1party_files
+from .instrumentation import STAGE_PARSE, STAGE_VALIDATE, STAGE_CALIBRATION, STAGE_GEOLOCATION, PROFILERS, record, \
+    PipelineReport, print_stage_report, profile_run
 
 METHOD_SUBTRACTION = "Subtraction"
 METHOD_OPTIMIZATION = "Optimization"
+METHOD_LEAST_SQUARES = "LeastSquares"
 METHOD_MULTILATERATION = "Multilateration"
 METHOD_FINGERPRINTING = "Fingerprinting"
 
+FINGERPRINT_TOP_K = 3
 
-def parse_input_files(input_dir, testing_mode=False):
-    datacenters, possible_file_datacenters = parse_datacenters(input_dir)
+DATASET_CACHE_DIR = '.cdg_cache'
 
-    probes_1party, frontends_1party, files_1party = parse_servers_1party(input_dir, datacenters)
-    measurements_1party = parse_measurements_1party(input_dir, probes_1party, frontends_1party, files_1party)
 
-    probes_3party, frontends_3party, files_3party = parse_servers_3party(input_dir, datacenters)
-    measurements_3party = parse_measurements_3party(input_dir, probes_3party, frontends_3party, files_3party)
+def parse_input_files(input_dir, testing_mode=False, aggregation=DEFAULT_AGGREGATION, cache_dir=None,
+                      include_1party=True):
+    """
+    Parse the input files into 1-party and 3-party dataset utils.
+    If cache_dir is given, the compiled dataset cache is used (and written on first parse) instead of the CSVs.
 
-    true_file_datacenter_mapping_3party = None
-    if testing_mode:
-        true_file_datacenter_mapping_3party = parse_solution(input_dir, datacenters, files_3party)
+    @param include_1party: if False (a calibration artifact replaces the 1-party dataset), only the 3-party files
+                           are parsed, from the CSVs, and None is returned for the 1-party dataset utils.
+    """
+    if not include_1party:
+        datacenters, possible_file_datacenters = parse_datacenters(input_dir)
+        registry = DatasetRegistry(datacenters)
+
+        probes_3party, frontends_3party, files_3party = parse_servers_3party(input_dir, registry)
+        measurements_3party = parse_measurements_3party(input_dir, probes_3party, frontends_3party, files_3party,
+                                                        aggregation)
+
+        true_file_datacenter_mapping_3party = None
+        if testing_mode:
+            true_file_datacenter_mapping_3party = parse_solution(input_dir, registry, files_3party)
+    elif cache_dir:
+        dataset = load_dataset(input_dir, cache_dir, testing_mode)
+        datacenters, possible_file_datacenters = dataset.datacenters, dataset.possible_file_datacenters
+
+        probes_1party, frontends_1party, files_1party = dataset.servers[PARTY_1]
+        measurements_1party = dataset.measurements(PARTY_1, aggregation)
+
+        probes_3party, frontends_3party, files_3party = dataset.servers[PARTY_3]
+        measurements_3party = dataset.measurements(PARTY_3, aggregation)
+
+        true_file_datacenter_mapping_3party = dataset.solution if testing_mode else None
+    else:
+        datacenters, possible_file_datacenters = parse_datacenters(input_dir)
+        registry = DatasetRegistry(datacenters)
+
+        probes_1party, frontends_1party, files_1party = parse_servers_1party(input_dir, registry)
+        measurements_1party = parse_measurements_1party(input_dir, probes_1party, frontends_1party, files_1party,
+                                                        aggregation)
+
+        probes_3party, frontends_3party, files_3party = parse_servers_3party(input_dir, registry)
+        measurements_3party = parse_measurements_3party(input_dir, probes_3party, frontends_3party, files_3party,
+                                                        aggregation)
+
+        true_file_datacenter_mapping_3party = None
+        if testing_mode:
+            true_file_datacenter_mapping_3party = parse_solution(input_dir, registry, files_3party)
+
+    if include_1party:
+        record('measurements_1party', len(measurements_1party) if measurements_1party else 0)
+    record('measurements_3party', len(measurements_3party) if measurements_3party else 0)
 
     cdgeb_utils_1party = DatasetUtils1Party(
         measurements=measurements_1party,
@@ -35,7 +92,7 @@ def parse_input_files(input_dir, testing_mode=False):
         probe_clients=probes_1party,
         frontend_servers=frontends_1party,
         data_files=files_1party,
-    )
+    ) if include_1party else None
 
     cdgeb_utils_3party = DatasetUtils3Party(
         measurements=measurements_3party,
@@ -50,8 +107,32 @@ def parse_input_files(input_dir, testing_mode=False):
     return cdgeb_utils_1party, cdgeb_utils_3party
 
 
-def validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, geolocation_method, testing_mode):
-    if rtt_method not in [METHOD_SUBTRACTION, METHOD_OPTIMIZATION]:
+def parse_1party_files(input_dir, aggregation=DEFAULT_AGGREGATION) -> DatasetUtils1Party:
+    """
+    Parse only the 1-party dataset (and the datacenters), e.g. to calibrate without a 3-party batch.
+    """
+    datacenters, _ = parse_datacenters(input_dir)
+    registry = DatasetRegistry(datacenters)
+
+    probes_1party, frontends_1party, files_1party = parse_servers_1party(input_dir, registry)
+    measurements_1party = parse_measurements_1party(input_dir, probes_1party, frontends_1party, files_1party,
+                                                    aggregation)
+
+    return DatasetUtils1Party(
+        measurements=measurements_1party,
+        datacenters=datacenters,
+        probe_clients=probes_1party,
+        frontend_servers=frontends_1party,
+        data_files=files_1party,
+    )
+
+
+def validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, geolocation_method, testing_mode,
+                    calibration=None):
+    """
+    @param calibration: CalibrationArtifact that replaces the 1-party dataset (cdgeb_utils_1party is then None).
+    """
+    if rtt_method not in [METHOD_SUBTRACTION, METHOD_OPTIMIZATION, METHOD_LEAST_SQUARES]:
         print("[ERROR] Invalid 2-hop RTT extraction method:", rtt_method)
         return False
 
@@ -59,18 +140,53 @@ def validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, geolocat
         print("[ERROR] Invalid geolocation method:", geolocation_method)
         return False
 
+    if calibration is not None:
+        if calibration.rtt_method != rtt_method:
+            print(f"[ERROR] The calibration artifact was made with the {calibration.rtt_method} 2-hop RTT extraction "
+                  f"method, not {rtt_method}")
+            return False
+        if rtt_method == METHOD_SUBTRACTION and calibration.baselines is None:
+            print("[ERROR] The calibration artifact has no subtraction baselines")
+            return False
+
     if rtt_method == METHOD_SUBTRACTION:
+        if calibration is not None:
+            datacenters_1party = calibration.datacenters
+            closest_probes_1party = [probe for probe, _ in calibration.baselines.values()]
+        else:
+            datacenters_1party = cdgeb_utils_1party.datacenters
+            closest_probes_1party = cdgeb_utils_1party.closest_probe_to_frontend.values()
+
         # Each datacenter utilized by 3Party must be present in 1Party
-        if not set(cdgeb_utils_3party.datacenters) <= set(cdgeb_utils_1party.datacenters):
+        if not set(cdgeb_utils_3party.datacenters) <= set(datacenters_1party):
             print("[ERROR] Datacenters in 3Party not found in 1Party")
             return False
 
         # Both 1Party and 3Party must have the same "closest" probe clients
-        if not set(cdgeb_utils_3party.closest_probe_to_frontend.values()) <= set(
-                cdgeb_utils_1party.closest_probe_to_frontend.values()):
+        if not set(cdgeb_utils_3party.closest_probe_to_frontend.values()) <= set(closest_probes_1party):
             print("[ERROR] 1Party and 3Party don't share the same closest probe clients")
             return False
 
+        # Every 3Party front-end datacenter needs a baseline
+        frontend_datacenters_3party = set(frontend.datacenter for frontend in cdgeb_utils_3party.frontend_servers)
+        if calibration is not None and not frontend_datacenters_3party <= set(calibration.baselines):
+            print("[ERROR] Some 3Party front-end datacenters have no baseline in the calibration artifact")
+            return False
+
+        # Each 3Party front-end must have the closest probe of the baseline of its datacenter, i.e. of the first
+        # 1Party front-end in it (see DatasetUtils1Party.subtraction_baselines)
+        if calibration is not None:
+            baseline_probes = {datacenter: probe for datacenter, (probe, _) in calibration.baselines.items()}
+        else:
+            baseline_probes = dict()
+            for frontend, probe in cdgeb_utils_1party.closest_probe_to_frontend.items():
+                baseline_probes.setdefault(frontend.datacenter, probe)
+        if any(baseline_probes.get(frontend.datacenter) != probe
+               for frontend, probe in cdgeb_utils_3party.closest_probe_to_frontend.items()):
+            print("[ERROR] 1Party and 3Party front-ends of the same datacenter don't share the same closest probe "
+                  "client")
+            return False
+
     if testing_mode:
         # Each file in 3Party must have a solution
         if not set(cdgeb_utils_3party.data_files) <= set(cdgeb_utils_3party.solutions):
@@ -85,44 +201,105 @@ def validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, geolocat
     return True
 
 
-def evaluate_csp_rates_and_rtts(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, testing_mode=False):
+def calibrate_csp(cdgeb_utils_1party, rtt_method, aggregation=DEFAULT_AGGREGATION, source_hash=None) \
+        -> CalibrationArtifact:
     """
-    This function uses the 1st-party dataset to compute the CSP rates and second-hop RTTs,
-    and then computes the second-hop RTTs for the 3rd-party dataset.
+    Learn the CSP model (rates, second-hop delays and, for the subtraction method, baselines) from the
+    1st-party dataset.
     """
     if rtt_method == METHOD_SUBTRACTION:
         cdgeb_utils_1party.compute_csp_delays_subtraction()
-        csp_general_rate = cdgeb_utils_1party.evaluate_csp_general_rate()
-        csp_rates = cdgeb_utils_1party.evaluate_csp_rates()
+    elif rtt_method == METHOD_OPTIMIZATION:
+        cdgeb_utils_1party.compute_csp_delays_optimizer()
+    else:
+        # rtt_method == METHOD_LEAST_SQUARES
+        cdgeb_utils_1party.compute_csp_delays_least_squares()
+    csp_general_rate = cdgeb_utils_1party.evaluate_csp_general_rate()
+    csp_rates = cdgeb_utils_1party.evaluate_csp_rates()
 
-        # print rates
-        print()
-        pretty_print_rates(csp_rates)
-        print("Rates within CSP (All measuremenets):", csp_general_rate)
-        print()
+    # print rates
+    print()
+    pretty_print_rates(csp_rates)
+    pretty_print_rate_fit(cdgeb_utils_1party.csp_rate_statistics)
+    print("Rates within CSP (All measuremenets):", csp_general_rate)
+    print()
 
-        cdgeb_utils_3party.csp_rates = csp_rates
-        cdgeb_utils_3party.compute_csp_delays_subtraction(cdgeb_utils_1party)
+    baselines = cdgeb_utils_1party.subtraction_baselines() if rtt_method == METHOD_SUBTRACTION else None
+    return CalibrationArtifact.from_dataset(cdgeb_utils_1party, rtt_method, aggregation, baselines, source_hash)
 
+
+def apply_calibration(calibration: CalibrationArtifact, cdgeb_utils_3party):
+    """
+    Compute the second-hop RTTs of the 3rd-party dataset with a learned CSP model.
+    """
+    cdgeb_utils_3party.csp_rates = calibration.rates
+    if calibration.rtt_method == METHOD_SUBTRACTION:
+        cdgeb_utils_3party.compute_csp_delays_from_baselines(calibration.baselines)
+    elif calibration.rtt_method == METHOD_OPTIMIZATION:
+        cdgeb_utils_3party.compute_csp_delays_optimizer()
     else:
-        # rtt_method == METHOD_OPTIMIZATION
-        cdgeb_utils_1party.compute_csp_delays_optimizer()
-        csp_general_rate = cdgeb_utils_1party.evaluate_csp_general_rate()
-        csp_rates = cdgeb_utils_1party.evaluate_csp_rates()
+        # calibration.rtt_method == METHOD_LEAST_SQUARES
+        cdgeb_utils_3party.compute_csp_delays_least_squares()
 
-        # print rates
-        print()
-        pretty_print_rates(csp_rates)
-        print("Rates within CSP (All measuremenets):", csp_general_rate)
-        print()
 
-        cdgeb_utils_3party.csp_rates = csp_rates
-        cdgeb_utils_3party.compute_csp_delays_optimizer()
+def evaluate_csp_rates_and_rtts(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, testing_mode=False):
+    """
+    This function uses the 1st-party dataset to compute the CSP rates and second-hop RTTs,
+    and then computes the second-hop RTTs for the 3rd-party dataset.
+    """
+    calibration = calibrate_csp(cdgeb_utils_1party, rtt_method)
+    apply_calibration(calibration, cdgeb_utils_3party)
+    return calibration.rates
 
-    return csp_rates
 
+def _json_float(value):
+    # JSON has no infinity or NaN
+    value = float(value)
+    return value if np.isfinite(value) else None
 
-def geolocate_from_data(output_dir, cdgeb_utils_1party, cdgeb_utils_3party, geolocation_method, testing_mode):
+
+@dataclasses.dataclass
+class GeolocationResults:
+    """
+    Per-target results of geolocate_from_data, in the order of the 3-party data files.
+    """
+    target_maps: list[TargetMap]
+    closest_datacenters: list[DataCenter]
+    # Fingerprinting only: the FINGERPRINT_TOP_K best datacenters of every target and their similarity scores
+    ranked_datacenters: Optional[list[list[DataCenter]]] = None
+    ranked_scores: Optional[np.ndarray] = None
+    # Testing mode only: the error statistics printed after the results table
+    summary: Optional[dict] = None
+    # MAPS_BACKGROUND only: completes when the maps are saved
+    maps_future: Optional[Future] = None
+
+    def to_dict(self) -> dict:
+        targets = list()
+        for target_index, (target_map, closest_datacenter) in enumerate(zip(self.target_maps,
+                                                                            self.closest_datacenters)):
+            target = {
+                'file': target_map.file_name,
+                'estimated_location': [float(x) for x in target_map.estimated_location],
+                'closest_datacenter': closest_datacenter.name,
+            }
+            if self.ranked_datacenters is not None:
+                target['matches'] = [{'datacenter': datacenter.name, 'score': _json_float(score)}
+                                     for datacenter, score in zip(self.ranked_datacenters[target_index],
+                                                                  self.ranked_scores[target_index])]
+            if target_map.true_coordinates is not None:
+                target['true_location'] = list(target_map.true_coordinates)
+                target['geolocation_error_km'] = float(target_map.geolocation_error)
+                target['success'] = target_map.success
+            targets.append(target)
+        return {'targets': targets, 'summary': self.summary}
+
+
+def geolocate_from_data(output_dir, calibration, cdgeb_utils_3party, geolocation_method, testing_mode,
+                        fingerprint_index=INDEX_EXACT, workers=1, maps=MAPS_HTML) -> GeolocationResults:
+    """
+    @param workers: number of worker processes for the per-target work. 1 runs serially, None or 0 uses all cores.
+    @param maps: map output mode, one of plot_map.MAP_MODES. output_dir is not used with MAPS_NONE.
+    """
     if testing_mode:
         # Create a Rich table for results
         table = Table(title="Geolocation Results", show_header=True, header_style="bold cyan")
@@ -140,91 +317,89 @@ def geolocate_from_data(output_dir, cdgeb_utils_1party, cdgeb_utils_3party, geol
         table.add_column("Assumed Datacenter", justify="center")
 
     # Stages - Geolocation
-    # Create map of all geolocated targets
-    map_all_targets = MapBuilder("all_targets", cdgeb_utils_3party.probe_clients,
-                                 cdgeb_utils_3party.possible_file_datacenters)
-    map_all_targets.add_datacenter()
-
     # Preparation for geolocation
     if geolocation_method == METHOD_MULTILATERATION:
         csp_geolocator = MultilaterationUtils(cdgeb_utils_3party.frontend_servers,
                                               csp_rates=cdgeb_utils_3party.csp_rates)
     else:
         # geolocation_method == METHOD_FINGERPRINTING
-        csp_geolocator = FingerprintingUtils(cdgeb_utils_1party.datacenters)
-        csp_geolocator.create_1party_fingerprints(cdgeb_utils_1party.csp_delays)
-
-    errors = []
-    for target_file in cdgeb_utils_3party.data_files:
-        # Prepare delays from front-end servers for the target file.
-        # Remove delays from front-end server in the same datacenter.
-        delays_from_server = {k[0]: v for (k, v) in cdgeb_utils_3party.csp_delays.items()
-                              if k[1] == target_file and k[0].datacenter != k[1].datacenter}
+        csp_geolocator = FingerprintingUtils(calibration.datacenters, calibration.fingerprints)
+        csp_geolocator.build_index(cdgeb_utils_3party.possible_file_datacenters, fingerprint_index)
+
+    record('targets', len(cdgeb_utils_3party.data_files))
+
+    # Prepare delays from front-end servers for every target file: one row per file.
+    # Remove delays from front-end server in the same datacenter.
+    frontends = cdgeb_utils_3party.frontend_servers
+    delays_matrix = cdgeb_utils_3party.csp_delays.values_matrix.T.copy()
+    datacenter_ids = cdgeb_utils_3party.datacenter_ids.ids
+    frontend_datacenter_ids = np.array([datacenter_ids.get(frontend.datacenter, -1) for frontend in frontends])
+    for target_index, target_file in enumerate(cdgeb_utils_3party.data_files):
+        if target_file.datacenter is not None:
+            delays_matrix[target_index, frontend_datacenter_ids == datacenter_ids.get(target_file.datacenter)] = np.nan
         if testing_mode:
-            frontend_in_same_datacenter = [fe for fe in cdgeb_utils_3party.frontend_servers
-                                           if fe.datacenter == cdgeb_utils_3party.solutions[target_file]]
+            frontend_in_same_datacenter = np.flatnonzero(
+                frontend_datacenter_ids == datacenter_ids.get(cdgeb_utils_3party.solutions[target_file]))
             if len(frontend_in_same_datacenter) > 0:
-                delays_from_server.pop(frontend_in_same_datacenter[0])
+                delays_matrix[target_index, frontend_in_same_datacenter[0]] = np.nan
 
+    ranked_datacenters, scores = None, None
+    if geolocation_method == METHOD_MULTILATERATION:
+        # Geolocate all targets in a single batch
+        estimated_locations = geolocate_targets_parallel(csp_geolocator, delays_matrix, frontends, workers)
+        closest_datacenters = cdgeb_utils_3party.position_correction_batch(estimated_locations)
+    else:
+        # geolocation_method == METHOD_FINGERPRINTING
+        # Match all targets in a single batch
+        ranked_datacenters, scores = csp_geolocator.rank_targets(delays_matrix, frontends,
+                                                                 cdgeb_utils_3party.possible_file_datacenters,
+                                                                 k=FINGERPRINT_TOP_K)
+        closest_datacenters = [datacenters[0] for datacenters in ranked_datacenters]
+        for target_file, datacenters, target_scores in zip(cdgeb_utils_3party.data_files, ranked_datacenters, scores):
+            matches = ", ".join(f"{datacenter.name} ({score:.4f})"
+                                for datacenter, score in zip(datacenters, target_scores))
+            print(f"[DEBUG] Top fingerprint matches of {target_file.name}:", matches)
+
+    errors = []
+    target_maps = []
+    for target_index, target_file in enumerate(cdgeb_utils_3party.data_files):
         # Geolocation
         if geolocation_method == METHOD_MULTILATERATION:
-            estimated_location = csp_geolocator.geolocate_target(delays_from_server)
-            closest_datacenter = cdgeb_utils_3party.position_correction(estimated_location)
+            estimated_location = tuple(estimated_locations[target_index])
+            closest_datacenter = closest_datacenters[target_index]
         else:
             # geolocation_method == METHOD_FINGERPRINTING
-            feature_vector = csp_geolocator.evaluate_feature_vector(delays_from_server)
-            closest_datacenter = csp_geolocator.match_feature_vector_to_fingerprint(feature_vector,
-                                                                                    cdgeb_utils_3party.possible_file_datacenters)
+            closest_datacenter = closest_datacenters[target_index]
             estimated_location = closest_datacenter.coordinates
 
-        # Make target-specific map file
-        map_single_target = MapBuilder(f'{target_file.name.replace(" ", "_")}_estimated',
-                                       cdgeb_utils_3party.probe_clients,
-                                       cdgeb_utils_3party.datacenters)
-        map_single_target.add_datacenter()
-
         true_file_datacenter = cdgeb_utils_3party.solutions[target_file] \
             if testing_mode else None
         true_file_coordinates = true_file_datacenter.coordinates \
             if testing_mode else None
 
-        if testing_mode:
-            map_single_target.add_point(estimated_location, f'estimated-location-of-{target_file.name}',
-                                        color="green" if closest_datacenter.name == true_file_datacenter.name else "red")
-            map_single_target.add_circle(estimated_location,
-                                         haversine(estimated_location, true_file_coordinates))
-            map_single_target.add_dashed_line(estimated_location, true_file_coordinates)
-        else:
-            map_single_target.add_point(estimated_location, f'estimated-location-of-{target_file.name}',
-                                        color="orange")
-
-        map_single_target.add_line(estimated_location, closest_datacenter.coordinates)
-        map_single_target.save_map(output_dir)
-
         if testing_mode:
             # Calculate errors
             geolocation_error = haversine(estimated_location, true_file_coordinates)
             closest_error = haversine(closest_datacenter.coordinates, true_file_coordinates)
 
+            target_maps.append(TargetMap(target_file.name, estimated_location, closest_datacenter.coordinates,
+                                         true_file_coordinates, geolocation_error,
+                                         closest_datacenter.name == true_file_datacenter.name))
+
             errors.append((geolocation_error, closest_error))
             table.add_row(target_file.name, true_file_datacenter.name, closest_datacenter.name,
                           str(round(geolocation_error, 2)), str(closest_datacenter.name == true_file_datacenter.name),
                           str(round(closest_error, 2))
                           )
-
-            map_all_targets.add_point(estimated_location, f'estimated-location-of-{target_file.name}',
-                                      color="green" if closest_datacenter.name == true_file_datacenter.name else "red")
         else:
+            target_maps.append(TargetMap(target_file.name, estimated_location, closest_datacenter.coordinates))
             table.add_row(target_file.name, closest_datacenter.name)
 
-            map_all_targets.add_point(estimated_location, f'estimated-location-of-{target_file.name}',
-                                      color="green")
-            map_all_targets.add_dashed_line(estimated_location, closest_datacenter.coordinates)
-
     # Print the table
     console = Console()
     console.print(table)
 
+    summary = None
     if testing_mode:
         final_mean_error = np.mean([err[1] for err in errors])
         final_max_error = np.max([err[1] for err in errors])
@@ -245,47 +420,182 @@ def geolocate_from_data(output_dir, cdgeb_utils_1party, cdgeb_utils_3party, geol
         print("Multilateration RMSE Error:\t", round(multilateration_rmse_error, 2), "\t[km]")
         print()
 
-    # Save the map
-    map_all_targets.save_map(output_dir)
+        summary = {
+            'final_mean_error_km': float(final_mean_error),
+            'final_max_error_km': float(final_max_error),
+            'final_rmse_error_km': float(final_rmse_error),
+            'successes': total_successes,
+            'attempts': total_attempts,
+            'multilateration_mean_error_km': float(multilateration_mean_error),
+            'multilateration_max_error_km': float(multilateration_max_error),
+            'multilateration_rmse_error_km': float(multilateration_rmse_error),
+        }
+
+    # Maps are rendered from the results, after they are reported
+    maps_future = save_maps(target_maps, cdgeb_utils_3party, output_dir, maps, workers)
+    return GeolocationResults(target_maps, list(closest_datacenters), ranked_datacenters, scores, summary,
+                              maps_future)
 
 
-def geolocation_main(input_dir, output_dir, rtt_method, geolocation_method):
+def save_maps(target_maps, cdgeb_utils_3party, output_dir, maps=MAPS_HTML, workers=1):
+    """
+    Write the maps of the geolocation results in the requested output mode.
+
+    return: in MAPS_BACKGROUND mode, a future that completes when the maps are saved. Otherwise, None.
+    """
+    probe_clients = cdgeb_utils_3party.probe_clients
+    if maps == MAPS_NONE:
+        return None
+    if maps == MAPS_GEOJSON:
+        write_results_geojson(target_maps, probe_clients, cdgeb_utils_3party.datacenters, output_dir)
+        return None
+    if maps == MAPS_BACKGROUND:
+        return save_maps_in_background(target_maps, probe_clients, cdgeb_utils_3party.datacenters,
+                                       cdgeb_utils_3party.possible_file_datacenters, output_dir, workers)
+
+    # maps == MAPS_HTML
+    # Make target-specific map files
+    save_target_maps(target_maps, probe_clients, cdgeb_utils_3party.datacenters, output_dir, workers)
+    # Save the map of all geolocated targets
+    save_all_targets_map(target_maps, probe_clients, cdgeb_utils_3party.possible_file_datacenters, output_dir)
+    return None
+
+
+def geolocation_main(input_dir, output_dir, rtt_method, geolocation_method, aggregation=DEFAULT_AGGREGATION,
+                     cache_dir=None, fingerprint_index=INDEX_EXACT, workers=1, maps=MAPS_HTML,
+                     calibration_path=None, save_calibration_path=None, report: PipelineReport = None):
+    """
+    @param calibration_path: calibration artifact to load instead of calibrating on the 1-party dataset.
+    @param save_calibration_path: where to export the calibration artifact learned from the 1-party dataset.
+    @param report: PipelineReport that records the stats of every stage.
+    return: the GeolocationResults, or False (None on missing input files) if the run failed.
+            With MAPS_BACKGROUND, the maps may still be rendering: wait for results.maps_future before exiting.
+    """
+    report = report or PipelineReport()
+
     if not output_dir:
         output_dir = os.path.join(input_dir, 'out')
-    if not check_files_exist(input_dir):
+    if not check_files_exist(input_dir, include_1party=calibration_path is None):
         # Already logged inside
         return
+    if not is_valid_aggregation(aggregation):
+        print("[ERROR] Invalid RTT aggregation:", aggregation)
+        return False
+    if fingerprint_index not in INDEX_MODES:
+        print("[ERROR] Invalid fingerprint index:", fingerprint_index)
+        return False
+    if maps not in MAP_MODES:
+        print("[ERROR] Invalid map output mode:", maps)
+        return False
 
-    # Create output directory if not exist
-    if not os.path.isdir(output_dir):
+    # Create output directory if not exist. Only the maps are written to it.
+    if maps != MAPS_NONE and not os.path.isdir(output_dir):
         os.makedirs(output_dir)
 
     testing_mode = is_testing_mode(input_dir)
 
-    cdgeb_utils_1party, cdgeb_utils_3party = parse_input_files(input_dir, testing_mode)
+    calibration = None
+    if calibration_path is not None:
+        try:
+            calibration = CalibrationArtifact.load(calibration_path)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print("[ERROR] Invalid calibration artifact:", e)
+            return False
+        print("[DEBUG] Loaded calibration artifact:", calibration_path,
+              f"({calibration.rtt_method}, {calibration.aggregation}, created {calibration.created_utc})")
+        if calibration.aggregation != aggregation:
+            print(f"[WARNING] The calibration artifact was made with the {calibration.aggregation} RTT aggregation, "
+                  f"the 3-party measurements use {aggregation}")
+
+    try:
+        with report.stage(STAGE_PARSE):
+            cdgeb_utils_1party, cdgeb_utils_3party = parse_input_files(input_dir, testing_mode, aggregation,
+                                                                       cache_dir, include_1party=calibration is None)
+    except ValueError as e:  # UnknownEntityError, or an aggregation that doesn't fit the samples
+        print("[ERROR]", e)
+        return False
 
-    if not validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, geolocation_method, testing_mode):
+    with report.stage(STAGE_VALIDATE):
+        valid = validate_inputs(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, geolocation_method, testing_mode,
+                                calibration)
+    if not valid:
         # Already logged inside
         return False
 
-    evaluate_csp_rates_and_rtts(cdgeb_utils_1party, cdgeb_utils_3party, rtt_method, testing_mode)
-
-    geolocate_from_data(output_dir, cdgeb_utils_1party, cdgeb_utils_3party, geolocation_method, testing_mode)
-
-    return True
+    with report.stage(STAGE_CALIBRATION):
+        if calibration is None:
+            calibration = calibrate_csp(cdgeb_utils_1party, rtt_method, aggregation, hash_1party_files(input_dir))
+            if save_calibration_path:
+                calibration.save(save_calibration_path)
+                print("[DEBUG] Saved calibration artifact:", save_calibration_path)
+        else:
+            # print rates
+            print()
+            pretty_print_rates(calibration.rates)
+            print("Rates within CSP (All measuremenets):", calibration.general_rate)
+            print()
+
+        apply_calibration(calibration, cdgeb_utils_3party)
+
+    with report.stage(STAGE_GEOLOCATION):
+        results = geolocate_from_data(output_dir, calibration, cdgeb_utils_3party, geolocation_method, testing_mode,
+                                      fingerprint_index, workers, maps)
+
+    return results
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Geolocate cloud files using the CDG three-tier solver.")
+    # Run from src. (python -m cdg_core.main)
+    parser.add_argument('input_dir', nargs='?', default='../Datasets/DS-B1/')
+    parser.add_argument('output_dir', nargs='?', default=None, help="Default: <input_dir>/out")
+    parser.add_argument('--rtt-method', default=METHOD_SUBTRACTION,
+                        choices=[METHOD_SUBTRACTION, METHOD_OPTIMIZATION, METHOD_LEAST_SQUARES])
+    parser.add_argument('--geolocation-method', default=METHOD_MULTILATERATION,
+                        choices=[METHOD_MULTILATERATION, METHOD_FINGERPRINTING])
+    parser.add_argument('--aggregation', default=DEFAULT_AGGREGATION,
+                        help="RTT aggregation: <name>[:<parameter>], e.g. trimmed_mean:3, min, percentile:10")
+    parser.add_argument('--cache-dir', default=None, help="Compiled dataset cache. Default: <input_dir>/.cdg_cache")
+    parser.add_argument('--no-cache', action='store_true', help="Always parse the CSV files")
+    parser.add_argument('--fingerprint-index', default=INDEX_EXACT, choices=INDEX_MODES,
+                        help="Candidate index for fingerprinting large datacenter catalogs")
+    parser.add_argument('--maps', default=MAPS_HTML, choices=MAP_MODES,
+                        help="Map output: none, geojson (one GeoJSON + viewer page), background or html")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes for per-target geolocation and maps. 0: one per CPU core")
+    parser.add_argument('--calibration', default=None,
+                        help="Load this calibration artifact instead of calibrating on the 1-party files")
+    parser.add_argument('--save-calibration', default=None, help="Export the calibration artifact to this path")
+    parser.add_argument('--stage-report', default=None, help="Save the stats of every stage to this JSON file")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Trace the peak memory of every stage with tracemalloc (slows down allocations)")
+    parser.add_argument('--profile', default=None, choices=PROFILERS,
+                        help="Profile the run with cProfile or pyinstrument (if installed)")
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
     print(os.getcwd())
-    if len(sys.argv) > 1:
-        input_dir = sys.argv[1]
-    else:
-        # Run from src. (python -m cdg_core.main)
-        input_dir = '../Datasets/DS-B1/'
-
-    if len(sys.argv) > 2:
-        output_dir = sys.argv[2]
-    else:
-        output_dir = None  # Use default
-
-    geolocation_main(input_dir, output_dir, METHOD_SUBTRACTION, METHOD_MULTILATERATION)
+    args = parse_arguments()
+
+    cache_dir = None if args.no_cache else (args.cache_dir or os.path.join(args.input_dir, DATASET_CACHE_DIR))
+
+    report = PipelineReport(trace_memory=args.trace_memory)
+    with profile_run(report, args.profile) if args.profile else contextlib.nullcontext():
+        results = geolocation_main(args.input_dir, args.output_dir, args.rtt_method, args.geolocation_method,
+                                   args.aggregation, cache_dir, args.fingerprint_index, args.workers, args.maps,
+                                   args.calibration, args.save_calibration, report)
+
+    print_stage_report(report)
+    if report.profile:
+        print(report.profile)
+    if args.stage_report:
+        with open(args.stage_report, 'w') as f:
+            json.dump(report.to_dict(), f, indent=2)
+        print("[DEBUG] Saved stage report:", args.stage_report)
+
+    if results and results.maps_future is not None:
+        # Background maps: the results and the stage report are out, the maps are still rendering. A process pool
+        # can't be started once the interpreter shuts down, so wait for them here. Failures are logged by the renderer.
+        print("[DEBUG] Waiting for the background maps")
+        results.maps_future.exception()
@@ -0,0 +1,166 @@
+"""
+Streamed ZIP packaging of in-memory result artifacts.
+
+A package is a list of (archive name, content) entries. The content is bytes, a string, or a function that
+returns either, called only when the entry is written (e.g. to render a map). stream_zip() writes the archive to a
+non-seekable buffer and yields it in chunks as it goes, so nothing is written to disk and only one entry is held
+in memory at a time, on top of the inputs.
+
+Example usage:
+    entries = [('output/results.txt', output), ('output/map_all_targets.html', render_all_targets_map)]
+    for chunk in stream_zip(entries, COMPRESSION_FAST):
+        ...
+"""
+
+import io
+import json
+import time
+import uuid
+import zipfile
+import threading
+import functools
+import dataclasses
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+from .plot_map import MAPS_GEOJSON, MAPS_HTML, GEOJSON_RESULTS_FILE, GEOJSON_RESULTS_SCRIPT_FILE, GEOJSON_VIEWER_FILE, \
+    ALL_TARGETS_MAP, TargetMap, map_filename, target_map_name, build_target_map, build_all_targets_map, \
+    results_geojson, results_geojson_script, geojson_viewer_html
+
+__all__ = ['COMPRESSION_NONE', 'COMPRESSION_FAST', 'COMPRESSION_DEFAULT', 'COMPRESSION_LEVELS', 'stream_zip',
+           'map_entries', 'Package', 'PackageStore']
+
+COMPRESSION_NONE = 'none'  # Stored: no CPU cost, largest archive
+COMPRESSION_FAST = 'fast'  # Deflate level 1
+COMPRESSION_DEFAULT = 'default'  # Deflate level 6, zlib's default
+# Compression option -> (zipfile compression method, compression level)
+COMPRESSION_LEVELS = {
+    COMPRESSION_NONE: (zipfile.ZIP_STORED, None),
+    COMPRESSION_FAST: (zipfile.ZIP_DEFLATED, 1),
+    COMPRESSION_DEFAULT: (zipfile.ZIP_DEFLATED, 6),
+}
+
+STREAM_CHUNK_SIZE = 2 ** 16
+
+DEFAULT_MAX_PACKAGES = 64
+# Seconds a package stays available for download
+DEFAULT_PACKAGE_TTL = 3600
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """
+    Write-only, non-seekable sink that collects the bytes written since the last drain().
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = list()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return data
+
+
+def _entry_bytes(content) -> bytes:
+    if callable(content):
+        content = content()
+    return content.encode() if isinstance(content, str) else content
+
+
+def stream_zip(entries, compression=COMPRESSION_DEFAULT, chunk_size=STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Generate a ZIP archive of the entries, chunk by chunk.
+
+    @param entries: (archive name, content) pairs. content: bytes, str, or a function returning either.
+    @param compression: one of COMPRESSION_LEVELS.
+    """
+    method, level = COMPRESSION_LEVELS[compression]
+    buffer = _ChunkBuffer()
+
+    # On a non-seekable stream, zipfile writes the sizes after each entry (data descriptors).
+    # Entries opened by name take the compression and level of the archive.
+    with zipfile.ZipFile(buffer, 'w', compression=method, compresslevel=level) as archive:
+        for name, content in entries:
+            data = _entry_bytes(content)
+            # The size is known up front: ZIP64 is decided before the entry is written
+            with archive.open(name, 'w', force_zip64=len(data) > zipfile.ZIP64_LIMIT) as f:
+                for start in range(0, len(data), chunk_size):
+                    f.write(data[start:start + chunk_size])
+                    if buffer.size >= chunk_size:
+                        yield buffer.drain()
+            yield buffer.drain()
+    # Central directory
+    yield buffer.drain()
+
+
+def map_entries(target_maps: list[TargetMap], probe_clients, datacenters, possible_file_datacenters, maps,
+                directory='') -> list[tuple]:
+    """
+    Package entries of the maps that main.save_maps writes in the given map output mode.
+    Folium maps are rendered when their entry is written.
+    """
+    if maps == MAPS_GEOJSON:
+        # Built once, for both the GeoJSON file and the script
+        results = functools.cache(lambda: results_geojson(target_maps, probe_clients, datacenters))
+        return [(directory + GEOJSON_RESULTS_FILE, lambda: json.dumps(results())),
+                (directory + GEOJSON_RESULTS_SCRIPT_FILE, lambda: results_geojson_script(results())),
+                (directory + GEOJSON_VIEWER_FILE, geojson_viewer_html())]
+    if maps != MAPS_HTML:
+        return []
+
+    entries = [(directory + map_filename(target_map_name(target_map.file_name)),
+                lambda target_map=target_map: build_target_map(target_map, probe_clients, datacenters).render())
+               for target_map in target_maps]
+    entries.append((directory + map_filename(ALL_TARGETS_MAP),
+                    lambda: build_all_targets_map(target_maps, probe_clients, possible_file_datacenters).render()))
+    return entries
+
+
+@dataclasses.dataclass
+class Package:
+    entries: list[tuple]
+    filename: str
+    compression: str = COMPRESSION_DEFAULT
+    created: float = dataclasses.field(default_factory=time.monotonic)
+
+
+class PackageStore:
+    """
+    Packages waiting to be downloaded, by token. Bounded in number and age; the oldest are dropped first.
+    """
+
+    def __init__(self, max_packages=DEFAULT_MAX_PACKAGES, ttl=DEFAULT_PACKAGE_TTL):
+        self.max_packages = max_packages
+        self.ttl = ttl
+        self.packages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, package: Package) -> str:
+        token = uuid.uuid4().hex
+        with self.lock:
+            self._expire()
+            self.packages[token] = package
+            while len(self.packages) > self.max_packages:
+                self.packages.popitem(last=False)
+        return token
+
+    def get(self, token) -> Optional[Package]:
+        with self.lock:
+            self._expire()
+            return self.packages.get(token)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.packages and now - next(iter(self.packages.values())).created > self.ttl:
+            self.packages.popitem(last=False)
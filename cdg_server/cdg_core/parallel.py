@@ -0,0 +1,162 @@
+"""
+Process-pool execution of the per-target work of geolocate_from_data.
+
+Read-only dataset arrays are placed in shared memory once and attached by every worker, instead of being pickled
+with each task. Targets are split into contiguous chunks and results are collected in chunk order, so the output
+does not depend on the number of workers or on scheduling.
+
+Example usage:
+    estimated_locations = geolocate_targets_parallel(csp_geolocator, delays_matrix, frontends, workers=8)
+"""
+
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .GeolocationUtils import MultilaterationUtils, normalize_coordinates
+from .plot_map import TargetMap, save_target_map, save_all_targets_map
+
+__all__ = ['resolve_workers', 'SharedArray', 'geolocate_targets_parallel', 'save_target_maps',
+           'save_maps_in_background']
+
+# Per-worker state, set by the pool initializers
+_worker_state = dict()
+
+
+def resolve_workers(workers) -> int:
+    """
+    Number of worker processes to use. None or 0 means one per CPU core.
+    """
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def _chunks(num_items, workers, min_chunk_size=1):
+    """
+    Contiguous (start, stop) ranges: a few chunks per worker, to balance uneven targets.
+    """
+    chunk_size = max(min_chunk_size, -(-num_items // (4 * workers)))
+    return [(start, min(start + chunk_size, num_items)) for start in range(0, num_items, chunk_size)]
+
+
+class SharedArray:
+    """
+    A NumPy array in a named shared memory block.
+    The creating process owns the block and unlinks it on close(); workers attach to it by descriptor.
+    """
+
+    def __init__(self, array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+        self.descriptor = (self.shm.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(descriptor) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+        name, shape, dtype = descriptor
+        shm = shared_memory.SharedMemory(name=name)
+        return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _init_geolocation_worker(positions_descriptor, distances_descriptor):
+    # Keep the SharedMemory handles referenced for the lifetime of the worker
+    _worker_state['positions'] = SharedArray.attach(positions_descriptor)
+    _worker_state['distances'] = SharedArray.attach(distances_descriptor)
+
+
+def _geolocate_chunk(chunk):
+    start, stop = chunk
+    positions = _worker_state['positions'][1]
+    distances = _worker_state['distances'][1]
+    return MultilaterationUtils._geolocate_batch_levenberg_marquardt(positions, distances[start:stop])
+
+
+def geolocate_targets_parallel(geolocator: MultilaterationUtils, delays: np.ndarray, frontends: list,
+                               workers=None) -> np.ndarray:
+    """
+    Parallel version of MultilaterationUtils.geolocate_targets. Targets are solved independently,
+    so the result is the same as the serial version.
+
+    @param workers: number of worker processes. None or 0 means one per CPU core.
+    """
+    workers = resolve_workers(workers)
+    positions, distances = geolocator.target_distances(delays, frontends)
+    if workers == 1 or len(distances) <= 1:
+        return normalize_coordinates(geolocator._geolocate_batch_levenberg_marquardt(positions, distances))
+
+    with SharedArray(positions) as shared_positions, SharedArray(distances) as shared_distances:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_geolocation_worker,
+                                 initargs=(shared_positions.descriptor, shared_distances.descriptor)) as executor:
+            # executor.map yields in submission order, regardless of completion order
+            results = list(executor.map(_geolocate_chunk, _chunks(len(distances), workers)))
+
+    return normalize_coordinates(np.concatenate(results))
+
+
+def _init_map_worker(probe_clients, datacenters, output_dir):
+    _worker_state['map_context'] = (probe_clients, datacenters, output_dir)
+
+
+def _save_target_maps_chunk(target_maps):
+    probe_clients, datacenters, output_dir = _worker_state['map_context']
+    for target_map in target_maps:
+        save_target_map(target_map, probe_clients, datacenters, output_dir)
+    return len(target_maps)
+
+
+def save_target_maps(target_maps: list, probe_clients: list, datacenters: list, output_dir, workers=None):
+    """
+    Render and save the per-target maps (see plot_map.TargetMap) using a pool of worker processes.
+    The entity lists are sent once per worker rather than once per map.
+    """
+    workers = resolve_workers(workers)
+    if workers == 1 or len(target_maps) <= 1:
+        for target_map in target_maps:
+            save_target_map(target_map, probe_clients, datacenters, output_dir)
+        return
+
+    chunks = [target_maps[start:stop] for start, stop in _chunks(len(target_maps), workers)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_map_worker,
+                             initargs=(probe_clients, datacenters, output_dir)) as executor:
+        # Consume the results to surface worker exceptions
+        for _ in executor.map(_save_target_maps_chunk, chunks):
+            pass
+
+
+def save_maps_in_background(target_maps: list[TargetMap], probe_clients, datacenters, possible_file_datacenters,
+                            path, workers=1) -> Future:
+    """
+    Render the per-target maps and the combined map on a background thread (which may itself use a process pool).
+    The returned future completes when all maps are saved. The thread is not a daemon, so the interpreter waits for
+    the maps before exiting.
+    """
+    future = Future()
+
+    def render():
+        try:
+            save_target_maps(target_maps, probe_clients, datacenters, path, workers)
+            save_all_targets_map(target_maps, probe_clients, possible_file_datacenters, path)
+            future.set_result(len(target_maps) + 1)
+        except BaseException as e:
+            print("[ERROR] Map rendering failed:", e)
+            future.set_exception(e)
+
+    future.set_running_or_notify_cancel()
+    threading.Thread(target=render, name='cdg-map-renderer').start()
+    return future
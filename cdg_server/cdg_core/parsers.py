@@ -1,11 +1,24 @@
 import os
+import io
 import csv
-from statistics import mean
+import time
+import itertools
+import dataclasses
+from collections.abc import Mapping
+from typing import Iterator
+
+import numpy as np
 
 from .data_classes import *
+from .aggregation import DEFAULT_AGGREGATION, get_aggregator
+from .registry import DatasetRegistry, UnknownEntityError, as_registry
+from .instrumentation import record
 
-__all__ = ['check_files_exist', 'is_testing_mode', 'parse_datacenters', 'parse_servers_1party', 'parse_servers_3party',
-           'parse_measurements_1party', 'parse_measurements_3party', 'parse_solution', ]
+__all__ = ['open_input_file', 'input_file_exists', 'check_files_exist', 'is_testing_mode', 'parse_datacenters',
+           'parse_servers_1party', 'parse_servers_3party', 'parse_measurements_1party', 'parse_measurements_3party',
+           'parse_solution', 'validate_measurements', 'validate_measurement_names', 'DatasetRegistry',
+           'UnknownEntityError', 'MeasurementChunk', 'iter_measurement_chunks', 'MeasurementLogReader',
+           'load_measurement_samples', ]
 
 FILE_MEASUREMENTS_1PARTY = 'measurements-1party.csv'
 FILE_SERVERS_1PARTY = 'servers-1party.csv'
@@ -19,6 +32,9 @@ MEASUREMENT_FRONTENDS = 1
 MEASUREMENT_FILES = 2
 
 MEASUREMENT_FILE_ENTRY_LENGTH = 23
+MEASUREMENT_KEY_LENGTH = 3
+MEASUREMENT_SAMPLES_COUNT = MEASUREMENT_FILE_ENTRY_LENGTH - MEASUREMENT_KEY_LENGTH
+MEASUREMENT_CHUNK_ROWS = 65536
 SERVER_FILE_FULL_ENTRY_LENGTH = 4
 DATACENTER_FILE_ENTRY_LENGTH = 5
 SOLUTION_FILE_ENTRY_LENGTH = 2
@@ -26,35 +42,65 @@ SOLUTION_FILE_ENTRY_LENGTH = 2
 COORDINATES_LENGTH = 2
 
 
-def check_files_exist(input_dir):
-    filepath = os.path.join(input_dir, FILE_MEASUREMENTS_1PARTY)
-    if not os.path.isfile(filepath):
+def open_input_file(input_dir, filename, mode='r'):
+    """
+    Open an input file for reading.
+
+    @param input_dir: a directory, or a mapping of file name -> content (bytes) for inputs held in memory,
+                      e.g. uploaded files.
+    @param mode: 'r' or 'rb'.
+    """
+    if isinstance(input_dir, Mapping):
+        f = io.BytesIO(input_dir[filename])
+        # Decoded like open() does
+        return f if 'b' in mode else io.TextIOWrapper(f)
+    return open(os.path.join(input_dir, filename), mode)
+
+
+def input_file_exists(input_dir, filename) -> bool:
+    if isinstance(input_dir, Mapping):
+        return filename in input_dir
+    return os.path.isfile(os.path.join(input_dir, filename))
+
+
+def input_file_size(input_dir, filename) -> int:
+    if isinstance(input_dir, Mapping):
+        return len(input_dir[filename])
+    return os.path.getsize(os.path.join(input_dir, filename))
+
+
+def check_files_exist(input_dir, include_1party=True):
+    """
+    @param input_dir: a directory or a mapping of file name -> content, see open_input_file.
+    @param include_1party: whether the 1-party files are required (not when a calibration artifact is used).
+    """
+    if include_1party and not input_file_exists(input_dir, FILE_MEASUREMENTS_1PARTY):
         print("Missing file", FILE_MEASUREMENTS_1PARTY)
         return False
-    if not os.path.isfile(os.path.join(input_dir, FILE_SERVERS_1PARTY)):
+    if include_1party and not input_file_exists(input_dir, FILE_SERVERS_1PARTY):
         print("Missing file", FILE_SERVERS_1PARTY)
         return False
-    if not os.path.isfile(os.path.join(input_dir, FILE_DATACENTERS)):
+    if not input_file_exists(input_dir, FILE_DATACENTERS):
         print("Missing file", FILE_DATACENTERS)
         return False
-    if not os.path.isfile(os.path.join(input_dir, FILE_MEASUREMENTS_3PARTY)):
+    if not input_file_exists(input_dir, FILE_MEASUREMENTS_3PARTY):
         print("Missing file", FILE_MEASUREMENTS_3PARTY)
         return False
-    if not os.path.isfile(os.path.join(input_dir, FILE_SERVERS_3PARTY)):
+    if not input_file_exists(input_dir, FILE_SERVERS_3PARTY):
         print("Missing file", FILE_SERVERS_3PARTY)
         return False
     return True
 
 
 def is_testing_mode(input_dir):
-    return os.path.isfile(os.path.join(input_dir, FILE_SOLUTION))
+    return input_file_exists(input_dir, FILE_SOLUTION)
 
 
 def parse_datacenters(input_dir) -> tuple[list[DataCenter], list[DataCenter]]:
     datacenters = list()
     possible_file_datacenters = list()
 
-    with open(os.path.join(input_dir, FILE_DATACENTERS), 'r') as f:
+    with open_input_file(input_dir, FILE_DATACENTERS) as f:
         csv_reader = csv.reader(f, delimiter=',')
         for row in csv_reader:
             row = list(filter(None, row))  # Remove empty strings
@@ -80,12 +126,13 @@ def parse_datacenters(input_dir) -> tuple[list[DataCenter], list[DataCenter]]:
     return datacenters, possible_file_datacenters
 
 
-def parse_servers_1party(input_dir, datacenters: list[DataCenter]):
+def parse_servers_1party(input_dir, datacenters: list[DataCenter] | DatasetRegistry):
+    registry = as_registry(datacenters)
     probe_clients = list()
     frontend_servers = list()
     data_files = list()
 
-    with open(os.path.join(input_dir, FILE_SERVERS_1PARTY), 'r') as f:
+    with open_input_file(input_dir, FILE_SERVERS_1PARTY) as f:
         csv_reader = csv.reader(f, delimiter=',')
         for row in csv_reader:
             row = list(filter(None, row))  # Remove empty strings
@@ -94,27 +141,28 @@ def parse_servers_1party(input_dir, datacenters: list[DataCenter]):
                 continue
             if row[0] == 'probe' and len(row) == 5:
                 name, lat, lon, continent = row[1:5]
-                probe_clients.append(ProbeClient(name, (float(lat), float(lon)), Continent(continent)))
+                probe_clients.append(registry.intern(ProbeClient(name, (float(lat), float(lon)), Continent(continent))))
             elif row[0] == 'frontend' and len(row) == 3:
                 name, datacenter_name = row[1:3]
-                datacenter = [dc for dc in datacenters if dc.name == datacenter_name][0]
-                frontend_servers.append(FrontEnd(name, datacenter))
+                datacenter = registry.datacenter(datacenter_name, FILE_SERVERS_1PARTY)
+                frontend_servers.append(registry.intern(FrontEnd(name, datacenter)))
             elif row[0] == 'file' and len(row) == 3:
                 name, datacenter_name = row[1:3]
-                datacenter = [dc for dc in datacenters if dc.name == datacenter_name][0]
-                data_files.append(DataFile(name, datacenter))
+                datacenter = registry.datacenter(datacenter_name, FILE_SERVERS_1PARTY)
+                data_files.append(registry.intern(DataFile(name, datacenter)))
             else:
                 print("[WARNING] Skipping invalid row in file", FILE_SERVERS_1PARTY, ":", row)
 
     return probe_clients, frontend_servers, data_files
 
 
-def parse_servers_3party(input_dir, datacenters: list[DataCenter]):
+def parse_servers_3party(input_dir, datacenters: list[DataCenter] | DatasetRegistry):
+    registry = as_registry(datacenters)
     probe_clients = list()
     frontend_servers = list()
     data_files = list()
 
-    with open(os.path.join(input_dir, FILE_SERVERS_3PARTY), 'r') as f:
+    with open_input_file(input_dir, FILE_SERVERS_3PARTY) as f:
         csv_reader = csv.reader(f, delimiter=',')
         for row in csv_reader:
             row = list(filter(None, row))  # Remove empty strings
@@ -123,44 +171,173 @@ def parse_servers_3party(input_dir, datacenters: list[DataCenter]):
                 continue
             if row[0] == 'probe' and len(row) == 5:
                 name, lat, lon, continent = row[1:5]
-                probe_clients.append(ProbeClient(name, (float(lat), float(lon)), Continent(continent)))
+                probe_clients.append(registry.intern(ProbeClient(name, (float(lat), float(lon)), Continent(continent))))
             elif row[0] == 'frontend' and len(row) == 3:
                 name, datacenter_name = row[1:3]
-                datacenter = [dc for dc in datacenters if dc.name == datacenter_name][0]
-                frontend_servers.append(FrontEnd(name, datacenter))
+                datacenter = registry.datacenter(datacenter_name, FILE_SERVERS_3PARTY)
+                frontend_servers.append(registry.intern(FrontEnd(name, datacenter)))
             elif row[0] == 'file' and len(row) == 2:
                 name = row[1]
-                data_files.append(DataFile(name))
+                data_files.append(registry.intern(DataFile(name)))
             else:
                 print("[WARNING] Skipping invalid row in file", FILE_SERVERS_3PARTY, ":", row)
 
     return probe_clients, frontend_servers, data_files
 
 
-def aggregate_measurements(measurements):
-    # return min(measurements)
-    # return mean(measurements)
-    # return median(measurements)
-    return mean(sorted(measurements)[3:-3])
+@dataclasses.dataclass
+class MeasurementChunk:
+    keys: list[tuple[str, str, str]]  # (probe, frontend, file) per row
+    samples: np.ndarray  # (n_rows, MEASUREMENT_SAMPLES_COUNT) RTTs
+
+
+def _parse_measurement_row_slow(line, measurement_file):
+    """
+    Fallback for rows that don't fit the fast path (quoting, empty fields, etc.).
+    return: (key, samples) or None if the row is incomplete.
+    """
+    row = next(csv.reader([line], delimiter=','), [])
+    row = list(filter(None, row))  # Remove empty strings
+    if len(row) < MEASUREMENT_FILE_ENTRY_LENGTH:
+        print(f"Skipping incomplete row in file {measurement_file}: {row}")
+        return None
+    return tuple(row[:MEASUREMENT_KEY_LENGTH]), \
+        [float(x) for x in row[MEASUREMENT_KEY_LENGTH:MEASUREMENT_FILE_ENTRY_LENGTH]]
+
+
+def _parse_measurement_lines(lines, measurement_file) -> MeasurementChunk:
+    """
+    Parse measurement rows. Well-formed rows (3 names followed by exactly MEASUREMENT_SAMPLES_COUNT samples)
+    are converted by NumPy's C parser in one call; any other row goes through the csv module.
+    """
+    expected_separators = MEASUREMENT_SAMPLES_COUNT - 1
+
+    keys, samples = list(), list()
+    fast_rows, fast_rests = list(), list()
+    for line in lines:
+        parts = line.split(',', MEASUREMENT_KEY_LENGTH)
+        rest = parts[-1].rstrip().rstrip(',')
+        if len(parts) == MEASUREMENT_KEY_LENGTH + 1 and all(parts[:MEASUREMENT_KEY_LENGTH]) and \
+                '"' not in line and ',,' not in rest and rest.count(',') == expected_separators:
+            fast_rows.append(len(keys))
+            fast_rests.append(rest)
+            keys.append(tuple(parts[:MEASUREMENT_KEY_LENGTH]))
+            samples.append(None)
+        elif line.strip():
+            parsed = _parse_measurement_row_slow(line, measurement_file)
+            if parsed:
+                keys.append(parsed[0])
+                samples.append(parsed[1])
+
+    if len(fast_rows) == len(keys):
+        chunk_samples = np.loadtxt(io.StringIO('\n'.join(fast_rests)), delimiter=',', ndmin=2) \
+            if fast_rests else np.empty((0, MEASUREMENT_SAMPLES_COUNT))
+    else:
+        # Mixed chunk: keep the rows in file order
+        chunk_samples = np.empty((len(keys), MEASUREMENT_SAMPLES_COUNT))
+        for row, row_samples in enumerate(samples):
+            if row_samples is not None:
+                chunk_samples[row] = row_samples
+        if fast_rests:
+            chunk_samples[fast_rows] = np.loadtxt(io.StringIO('\n'.join(fast_rests)), delimiter=',', ndmin=2)
+
+    return MeasurementChunk(keys, chunk_samples)
+
+
+def iter_measurement_chunks(filepath, chunk_rows=MEASUREMENT_CHUNK_ROWS) -> Iterator[MeasurementChunk]:
+    """
+    Stream a measurements file in chunks of at most chunk_rows rows, so memory stays bounded by the chunk size.
+    Only the first MEASUREMENT_SAMPLES_COUNT samples of a row are used.
+    """
+    with open(filepath, 'r') as f:
+        yield from _iter_measurement_file_chunks(f, os.path.basename(filepath), chunk_rows)
+
+
+def _iter_measurement_file_chunks(f, measurement_file, chunk_rows=MEASUREMENT_CHUNK_ROWS) -> Iterator[MeasurementChunk]:
+    while True:
+        lines = list(itertools.islice(f, chunk_rows))
+        if not lines:
+            break
+
+        yield _parse_measurement_lines(lines, measurement_file)
+
+
+class MeasurementLogReader:
+    """
+    Follow a measurements file that keeps growing (an append-only measurement log).
+    Every read_new_rows() call parses only the complete rows appended since the previous call.
+    """
+
+    def __init__(self, filepath, offset=0):
+        """
+        @param offset: byte offset to start from, e.g. os.path.getsize() of the part that was already ingested.
+        """
+        self.filepath = filepath
+        self.offset = offset
+
+    def read_new_rows(self, max_bytes=None) -> MeasurementChunk:
+        with open(self.filepath, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read() if max_bytes is None else f.read(max_bytes)
+
+        # A row that is still being written is left for the next call
+        complete = data.rfind(b'\n') + 1
+        self.offset += complete
+        return _parse_measurement_lines(data[:complete].decode().splitlines(), os.path.basename(self.filepath))
+
+
+def load_measurement_samples(filepath, chunk_rows=MEASUREMENT_CHUNK_ROWS) -> MeasurementChunk:
+    """
+    Load a whole measurements file as a single (n_rows, n_samples) float array.
+    """
+    chunks = list(iter_measurement_chunks(filepath, chunk_rows))
+    keys = [key for chunk in chunks for key in chunk.keys]
+    samples = np.concatenate([chunk.samples for chunk in chunks]) if chunks \
+        else np.empty((0, MEASUREMENT_SAMPLES_COUNT))
+    return MeasurementChunk(keys, samples)
+
+
+def parse_measurements(input_dir, measurement_file, probe_clients, frontend_servers, data_files,
+                       aggregation=DEFAULT_AGGREGATION):
+    aggregate_measurements = get_aggregator(aggregation)
+
+    start_time = time.perf_counter()
+    measurements = dict()
+    with open_input_file(input_dir, measurement_file) as f:
+        for chunk in _iter_measurement_file_chunks(f, measurement_file):
+            # Only the aggregated RTTs are kept, so memory is bounded by the chunk size
+            measurements.update(zip(chunk.keys, aggregate_measurements(chunk.samples).tolist()))
+            record('measurement_rows', len(chunk.keys))
+    elapsed_time = time.perf_counter() - start_time
+
+    megabytes = input_file_size(input_dir, measurement_file) / 2 ** 20
+    print(f"[DEBUG] Parsed {measurement_file}: {megabytes:.2f} MB in {elapsed_time:.3f} s "
+          f"({megabytes / max(elapsed_time, 1e-9):.1f} MB/s)")
+
+    if not validate_measurements(measurements, probe_clients, frontend_servers, data_files):
+        # Already logged inside
+        return False
 
+    return measurements
 
-def parse_measurements(input_dir, measurement_file, probe_clients, frontend_servers, data_files):
-    measurements = dict()
-    with open(os.path.join(input_dir, measurement_file), 'r') as f:
-        csv_reader = csv.reader(f, delimiter=',')
-        for row in csv_reader:
-            row = list(filter(None, row))  # Remove empty strings
-            if len(row) < MEASUREMENT_FILE_ENTRY_LENGTH:
-                print(f"Skipping incomplete row in file {measurement_file}: {row}")
-                continue
-            probe, frontend, file = row[:3]
-            rtts = [float(x) for x in row[3:24]]
-            measurements[(probe, frontend, file)] = aggregate_measurements(rtts)
 
+def validate_measurements(measurements, probe_clients, frontend_servers, data_files) -> bool:
+    """
+    Check that the (probe, frontend, file) names of the measurements are disjoint and match the servers list.
+    """
     probes_names = set([key[MEASUREMENT_PROBES] for key in measurements])
     frontends_names = set([key[MEASUREMENT_FRONTENDS] for key in measurements])
     files_names = set([key[MEASUREMENT_FILES] for key in measurements])
 
+    return validate_measurement_names(probes_names, frontends_names, files_names, probe_clients, frontend_servers,
+                                      data_files)
+
+
+def validate_measurement_names(probes_names, frontends_names, files_names, probe_clients, frontend_servers,
+                               data_files) -> bool:
+    """
+    validate_measurements, given the sets of (probe, frontend, file) names found in the measurements.
+    """
     # Check for common elements
     if len(probes_names.intersection(frontends_names)) > 0:
         print("[ERROR] Probes and frontends have common elements")
@@ -173,38 +350,42 @@ def parse_measurements(input_dir, measurement_file, probe_clients, frontend_serv
         return False
 
     # Validate inputs are matching
-    if not all(any(probe.name == probe_name for probe in probe_clients) for probe_name in probes_names):
-        print("[ERROR] Some probes are not in the servers list")
-        return False
-    if not all(
-            any(frontend.name == frontend_name for frontend in frontend_servers) for frontend_name in frontends_names):
-        print("[ERROR] Some frontends are not in the servers list")
-        return False
-    if not all(any(file.name == file_name for file in data_files) for file_name in files_names):
-        print("[ERROR] Some files are not in the servers list")
-        return False
+    registry = DatasetRegistry(probe_clients=probe_clients, frontend_servers=frontend_servers, data_files=data_files)
+    for kind, names, known_names in (('probes', probes_names, registry.probe_clients),
+                                     ('frontends', frontends_names, registry.frontend_servers),
+                                     ('files', files_names, registry.data_files)):
+        unknown_names = sorted(names.difference(known_names))
+        if unknown_names:
+            print(f"[ERROR] Some {kind} are not in the servers list:", ", ".join(unknown_names))
+            return False
 
-    return measurements
+    return True
 
 
-def parse_measurements_1party(input_dir, probe_clients, frontend_servers, data_files):
-    return parse_measurements(input_dir, FILE_MEASUREMENTS_1PARTY, probe_clients, frontend_servers, data_files)
+def parse_measurements_1party(input_dir, probe_clients, frontend_servers, data_files,
+                              aggregation=DEFAULT_AGGREGATION):
+    return parse_measurements(input_dir, FILE_MEASUREMENTS_1PARTY, probe_clients, frontend_servers, data_files,
+                              aggregation)
 
 
-def parse_measurements_3party(input_dir, probe_clients, frontend_servers, data_files):
-    return parse_measurements(input_dir, FILE_MEASUREMENTS_3PARTY, probe_clients, frontend_servers, data_files)
+def parse_measurements_3party(input_dir, probe_clients, frontend_servers, data_files,
+                              aggregation=DEFAULT_AGGREGATION):
+    return parse_measurements(input_dir, FILE_MEASUREMENTS_3PARTY, probe_clients, frontend_servers, data_files,
+                              aggregation)
 
 
 def parse_solution(input_dir, datacenters, data_files):
+    datacenters_registry = as_registry(datacenters)
+    files_registry = DatasetRegistry(data_files=data_files)
     file_datacenter_mapping = dict()
-    with open(os.path.join(input_dir, FILE_SOLUTION), 'r') as f:
+    with open_input_file(input_dir, FILE_SOLUTION) as f:
         reader = csv.reader(f, delimiter=',')
         for row in reader:
             row = list(filter(None, row))  # Remove empty strings
             if len(row) == SOLUTION_FILE_ENTRY_LENGTH:
                 file_name, datacenter_name = row[:2]
-                file = [file for file in data_files if file.name == file_name][0]
-                datacenter = [dc for dc in datacenters if dc.name == datacenter_name][0]
+                file = files_registry.data_file(file_name, FILE_SOLUTION)
+                datacenter = datacenters_registry.datacenter(datacenter_name, FILE_SOLUTION)
                 file_datacenter_mapping[file] = datacenter
             else:
                 print(f"Skipping incomplete row in file {FILE_SOLUTION}: {row}")
@@ -8,14 +8,40 @@ Example usage:
 
 import folium
 import os
+import json
+import dataclasses
+from typing import Optional
 
 from .data_classes import ProbeClient, DataCenter
 
+# Map output modes
+MAPS_NONE = "none"  # No maps
+MAPS_GEOJSON = "geojson"  # One GeoJSON file (and script) with all results + a single HTML viewer that loads it
+MAPS_BACKGROUND = "background"  # Folium HTML maps, rendered in the background after the results are returned
+MAPS_HTML = "html"  # Folium HTML maps, rendered before returning
+MAP_MODES = [MAPS_NONE, MAPS_GEOJSON, MAPS_BACKGROUND, MAPS_HTML]
+
+GEOJSON_RESULTS_FILE = 'results.geojson'
+# The same results as a script: browsers block fetch() on file:// pages, but not <script src>
+GEOJSON_RESULTS_SCRIPT_FILE = 'results.js'
+GEOJSON_VIEWER_FILE = 'map_viewer.html'
+
+
+ALL_TARGETS_MAP = 'all_targets'
+
+
+def map_filename(map_name) -> str:
+    return f'map_{map_name}.html'
+
+
+def target_map_name(file_name) -> str:
+    return f'{file_name.replace(" ", "_")}_estimated'
+
 
 class MapBuilder:
     def __init__(self, map_name='', probe_clients: ProbeClient = None, datacenters: DataCenter = None):
         self.map = folium.Map(location=(0, 0), zoom_start=2)
-        self.map_name = f'map_{map_name}.html'
+        self.map_name = map_filename(map_name)
         self.probe_clients = probe_clients
         self.datacenters = datacenters
 
@@ -61,10 +87,183 @@ class MapBuilder:
     def add_line(self, start, end, color='green'):
         folium.PolyLine([start, end], color=color).add_to(self.map)
 
+    def render(self) -> str:
+        """
+        The HTML of the map, as written by save_map.
+        """
+        return self.map.get_root().render()
+
     def save_map(self, path):
         self.map.save(os.path.join(path, self.map_name))
 
 
+@dataclasses.dataclass(frozen=True)
+class TargetMap:
+    """
+    Everything needed to render the map of a single target file, detached from the dataset objects.
+    """
+    file_name: str
+    estimated_location: tuple[float, float]
+    closest_datacenter_coordinates: tuple[float, float]
+    # Testing mode only
+    true_coordinates: Optional[tuple[float, float]] = None
+    geolocation_error: Optional[float] = None
+    success: Optional[bool] = None
+
+
+def build_target_map(target_map: TargetMap, probe_clients, datacenters) -> MapBuilder:
+    # Make target-specific map
+    map_single_target = MapBuilder(target_map_name(target_map.file_name), probe_clients, datacenters)
+    map_single_target.add_datacenter()
+
+    estimated_location = target_map.estimated_location
+    if target_map.true_coordinates is not None:
+        map_single_target.add_point(estimated_location, f'estimated-location-of-{target_map.file_name}',
+                                    color="green" if target_map.success else "red")
+        map_single_target.add_circle(estimated_location, target_map.geolocation_error)
+        map_single_target.add_dashed_line(estimated_location, target_map.true_coordinates)
+    else:
+        map_single_target.add_point(estimated_location, f'estimated-location-of-{target_map.file_name}',
+                                    color="orange")
+
+    map_single_target.add_line(estimated_location, target_map.closest_datacenter_coordinates)
+    return map_single_target
+
+
+def save_target_map(target_map: TargetMap, probe_clients, datacenters, path):
+    build_target_map(target_map, probe_clients, datacenters).save_map(path)
+
+
+def build_all_targets_map(target_maps: list[TargetMap], probe_clients, datacenters) -> MapBuilder:
+    # Create map of all geolocated targets
+    map_all_targets = MapBuilder(ALL_TARGETS_MAP, probe_clients, datacenters)
+    map_all_targets.add_datacenter()
+
+    for target_map in target_maps:
+        label = f'estimated-location-of-{target_map.file_name}'
+        if target_map.success is not None:
+            map_all_targets.add_point(target_map.estimated_location, label,
+                                      color="green" if target_map.success else "red")
+        else:
+            map_all_targets.add_point(target_map.estimated_location, label, color="green")
+            map_all_targets.add_dashed_line(target_map.estimated_location, target_map.closest_datacenter_coordinates)
+
+    return map_all_targets
+
+
+def save_all_targets_map(target_maps: list[TargetMap], probe_clients, datacenters, path):
+    build_all_targets_map(target_maps, probe_clients, datacenters).save_map(path)
+
+
+def _point_feature(coordinates, **properties):
+    # GeoJSON positions are (lon, lat)
+    return {'type': 'Feature', 'properties': properties,
+            'geometry': {'type': 'Point', 'coordinates': [coordinates[1], coordinates[0]]}}
+
+
+def _line_feature(start, end, **properties):
+    return {'type': 'Feature', 'properties': properties,
+            'geometry': {'type': 'LineString', 'coordinates': [[start[1], start[0]], [end[1], end[0]]]}}
+
+
+def results_geojson(target_maps: list[TargetMap], probe_clients, datacenters) -> dict:
+    """
+    All results as a single GeoJSON FeatureCollection.
+    """
+    features = [_point_feature(datacenter.coordinates[:2], kind='datacenter', name=datacenter.name)
+                for datacenter in datacenters or []]
+    features += [_point_feature(probe.coordinates, kind='probe', name=probe.name) for probe in probe_clients or []]
+
+    for target_map in target_maps:
+        features.append(_point_feature(target_map.estimated_location, kind='estimate', name=target_map.file_name,
+                                       success=target_map.success, error_km=target_map.geolocation_error))
+        features.append(_line_feature(target_map.estimated_location, target_map.closest_datacenter_coordinates,
+                                      kind='closest-datacenter', name=target_map.file_name))
+        if target_map.true_coordinates is not None:
+            features.append(_line_feature(target_map.estimated_location, target_map.true_coordinates,
+                                          kind='true-location', name=target_map.file_name))
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def results_geojson_script(results: dict) -> str:
+    """
+    The results FeatureCollection as a script that sets the `results` variable of the viewer page.
+    """
+    return 'var results = ' + json.dumps(results) + ';\n'
+
+
+def geojson_viewer_html() -> str:
+    return GEOJSON_VIEWER_HTML.replace('__RESULTS_SCRIPT_FILE__', GEOJSON_RESULTS_SCRIPT_FILE)
+
+
+def write_results_geojson(target_maps: list[TargetMap], probe_clients, datacenters, path):
+    """
+    Write all results as a single GeoJSON FeatureCollection, and as a script next to a static viewer page that
+    loads it, so the page also works when it is opened from disk.
+    """
+    results = results_geojson(target_maps, probe_clients, datacenters)
+    with open(os.path.join(path, GEOJSON_RESULTS_FILE), 'w') as f:
+        json.dump(results, f)
+    with open(os.path.join(path, GEOJSON_RESULTS_SCRIPT_FILE), 'w') as f:
+        f.write(results_geojson_script(results))
+    with open(os.path.join(path, GEOJSON_VIEWER_FILE), 'w') as f:
+        f.write(geojson_viewer_html())
+
+
+GEOJSON_VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8"/>
+    <title>CDG Geolocation Results</title>
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+    <script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+    <style>html, body, #map { height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script src="__RESULTS_SCRIPT_FILE__"></script>
+<script>
+    // Shows the results script next to this page, which also loads from file://.
+    // A served copy can load another GeoJSON with map_viewer.html?data=<GeoJSON URL>.
+    var dataUrl = new URLSearchParams(window.location.search).get('data');
+    var map = L.map('map').setView([0, 0], 2);
+    L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+        attribution: '&copy; OpenStreetMap contributors'
+    }).addTo(map);
+
+    var pointColors = {datacenter: 'blue', probe: 'darkgreen'};
+    function estimateColor(properties) {
+        if (properties.success === null) { return 'orange'; }
+        return properties.success ? 'green' : 'red';
+    }
+
+    function addResults(results) {
+        L.geoJSON(results, {
+            pointToLayer: function (feature, latlng) {
+                var properties = feature.properties;
+                var color = properties.kind === 'estimate' ? estimateColor(properties) : pointColors[properties.kind];
+                return L.circleMarker(latlng, {radius: properties.kind === 'estimate' ? 7 : 5, color: color})
+                    .bindTooltip(properties.name);
+            },
+            style: function (feature) {
+                var trueLocation = feature.properties.kind === 'true-location';
+                return {color: trueLocation ? 'blue' : 'green', dashArray: trueLocation ? '10, 10' : null};
+            }
+        }).addTo(map);
+    }
+
+    if (dataUrl) {
+        fetch(dataUrl).then(function (response) { return response.json(); }).then(addResults);
+    } else if (typeof results !== 'undefined') {
+        addResults(results);
+    }
+</script>
+</body>
+</html>
+"""
+
+
 def make_map_with_all_frontends(path):
     map = MapBuilder('all_frontends')
     map.add_probes()
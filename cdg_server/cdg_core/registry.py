@@ -0,0 +1,77 @@
+from .data_classes import *
+
+__all__ = ['UnknownEntityError', 'DatasetRegistry', 'as_registry']
+
+
+class UnknownEntityError(ValueError):
+    """
+    Raised when an input file references a name that is not defined where it should be.
+    """
+
+    def __init__(self, kind: str, name: str, source: str = None):
+        self.kind = kind
+        self.name = name
+        self.source = source
+        location = f" (referenced in {source})" if source else ""
+        super().__init__(f"Unknown {kind} '{name}'{location}")
+
+
+class DatasetRegistry:
+    """
+    Name -> entity lookup tables of a dataset, built once and shared by the parsers and validators.
+    """
+
+    def __init__(self, datacenters: list[DataCenter] = (), probe_clients: list[ProbeClient] = (),
+                 frontend_servers: list[FrontEnd] = (), data_files: list[DataFile] = ()):
+        self.datacenters: dict[str, DataCenter] = dict()
+        self.probe_clients: dict[str, ProbeClient] = dict()
+        self.frontend_servers: dict[str, FrontEnd] = dict()
+        self.data_files: dict[str, DataFile] = dict()
+        # Entity -> the first equal entity seen (see intern)
+        self.interned: dict = dict()
+
+        self.add(datacenters, probe_clients, frontend_servers, data_files)
+
+    def add(self, datacenters=(), probe_clients=(), frontend_servers=(), data_files=()):
+        # First definition of a name wins, as with a scan over the entity list
+        for table, entities in ((self.datacenters, datacenters), (self.probe_clients, probe_clients),
+                                (self.frontend_servers, frontend_servers), (self.data_files, data_files)):
+            for entity in entities:
+                table.setdefault(entity.name, entity)
+        return self
+
+    def intern(self, entity):
+        """
+        The first entity equal to the given one that was interned in this registry, or the given one.
+        Entities parsed through the same registry (e.g. the 1-party and 3-party servers) are then shared, and dict
+        lookups across the two parties stop at the identity check.
+        """
+        return self.interned.setdefault(entity, entity)
+
+    @staticmethod
+    def _lookup(table, kind, name, source):
+        try:
+            return table[name]
+        except KeyError:
+            raise UnknownEntityError(kind, name, source) from None
+
+    def datacenter(self, name: str, source: str = None) -> DataCenter:
+        return self._lookup(self.datacenters, 'datacenter', name, source)
+
+    def probe(self, name: str, source: str = None) -> ProbeClient:
+        return self._lookup(self.probe_clients, 'probe', name, source)
+
+    def frontend(self, name: str, source: str = None) -> FrontEnd:
+        return self._lookup(self.frontend_servers, 'frontend', name, source)
+
+    def data_file(self, name: str, source: str = None) -> DataFile:
+        return self._lookup(self.data_files, 'file', name, source)
+
+
+def as_registry(datacenters) -> DatasetRegistry:
+    """
+    Accept either a registry or a plain list of datacenters.
+    """
+    if isinstance(datacenters, DatasetRegistry):
+        return datacenters
+    return DatasetRegistry(datacenters)
@@ -0,0 +1,335 @@
+"""
+Long-lived solver service: keeps calibrated CSP models warm between requests.
+
+Calibrating on a 1-party dataset dominates the cost of a run. The service keeps the calibration artifacts
+(see calibration_artifact) in an LRU cache keyed by the hash of the 1-party files, so a 3-party batch against a
+known 1-party dataset only parses its own files and geolocates its targets. Inputs are taken as
+{file name: content} mappings and solved in memory; the console output of a solve is captured per thread, so
+concurrent requests don't mix their logs.
+
+Example usage:
+    service = SolverService()
+    result = service.solve(files, METHOD_SUBTRACTION, METHOD_MULTILATERATION)
+    print(result.output)
+    json.dumps(result.to_dict())
+"""
+
+import io
+import os
+import sys
+import threading
+import contextlib
+import dataclasses
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+from .main import METHOD_MULTILATERATION, GeolocationResults, parse_1party_files, \
+    parse_input_files, validate_inputs, calibrate_csp, apply_calibration, geolocate_from_data
+from .CloudServiceUtils import DatasetUtils3Party, pretty_print_rates
+from .aggregation import DEFAULT_AGGREGATION, is_valid_aggregation
+from .calibration_artifact import CalibrationArtifact, FILES_1PARTY, hash_1party_files
+from .fingerprint_index import INDEX_EXACT
+from .instrumentation import STAGE_PARSE, STAGE_VALIDATE, STAGE_CALIBRATION, STAGE_APPLY_CALIBRATION, \
+    STAGE_GEOLOCATION, PipelineReport, profile_run
+from .parsers import FILE_SERVERS_3PARTY, FILE_MEASUREMENTS_3PARTY, FILE_SOLUTION, check_files_exist, \
+    is_testing_mode
+from .plot_map import MAPS_NONE
+
+__all__ = ['SOLVE_STAGES', 'ThreadLocalStdout', 'capture_stdout', 'CalibrationCache', 'SolveResult', 'SolverService',
+           'read_input_files']
+
+DEFAULT_CACHE_SIZE = 16
+
+# Stages of a solve, in order, as reported to the progress callback
+SOLVE_STAGES = [STAGE_CALIBRATION, STAGE_PARSE, STAGE_VALIDATE, STAGE_APPLY_CALIBRATION, STAGE_GEOLOCATION]
+
+_install_lock = threading.Lock()
+
+
+class ThreadLocalStdout:
+    """
+    sys.stdout replacement that writes to a per-thread stream when one is set (see capture_stdout),
+    and to the original stdout otherwise.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def write(self, text):
+        return self.target.write(text)
+
+    def flush(self):
+        return self.target.flush()
+
+    def __getattr__(self, name):
+        # isatty, encoding, fileno... of the current target
+        return getattr(self.target, name)
+
+
+def _install_stdout_proxy() -> ThreadLocalStdout:
+    with _install_lock:
+        if not isinstance(sys.stdout, ThreadLocalStdout):
+            sys.stdout = ThreadLocalStdout(sys.stdout)
+        return sys.stdout
+
+
+@contextlib.contextmanager
+def capture_stdout(stream=None):
+    """
+    Redirect the prints of the current thread (only) to stream. Default: a new StringIO.
+    Other threads keep writing to their own stream or to the original stdout.
+    """
+    proxy = _install_stdout_proxy()
+    stream = stream if stream is not None else io.StringIO()
+    previous = getattr(proxy.local, 'stream', None)
+    proxy.local.stream = stream
+    try:
+        yield stream
+    finally:
+        proxy.local.stream = previous
+
+
+class CalibrationCache:
+    """
+    Thread-safe LRU cache of calibration artifacts.
+    Concurrent misses on the same key calibrate once: the other callers wait for the first one.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key) -> Optional[CalibrationArtifact]:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, calibration: CalibrationArtifact):
+        with self.lock:
+            self._put(key, calibration)
+
+    def _put(self, key, calibration):
+        self.entries[key] = calibration
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_or_create(self, key, factory) -> tuple[Optional[CalibrationArtifact], bool]:
+        """
+        @param factory: called without arguments on a miss. Returns the calibration, or None on failure
+                        (failures are not cached).
+        return: (calibration, whether it came from the cache).
+        """
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key], True
+            self.misses += 1
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = self.pending[key] = Future()
+
+        if not owner:
+            return future.result(), True
+
+        try:
+            calibration = factory()
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.pending[key]
+            if calibration is not None:
+                self._put(key, calibration)
+        future.set_result(calibration)
+        return calibration, False
+
+
+@dataclasses.dataclass
+class SolveResult:
+    success: bool
+    # Console output of the solve (parsing logs, rates, results table)
+    output: str
+    calibration: Optional[CalibrationArtifact] = None
+    calibration_cached: bool = False
+    results: Optional[GeolocationResults] = None
+    # The parsed 3-party dataset, e.g. to render maps with main.save_maps
+    dataset: Optional[DatasetUtils3Party] = None
+    # Stats of every stage (see instrumentation)
+    report: PipelineReport = dataclasses.field(default_factory=PipelineReport)
+
+    def to_dict(self) -> dict:
+        return {
+            'success': self.success,
+            'calibration': None if self.calibration is None else {
+                'rtt_method': self.calibration.rtt_method,
+                'aggregation': self.calibration.aggregation,
+                'source_hash': self.calibration.source_hash,
+                'created_utc': self.calibration.created_utc,
+                'cached': self.calibration_cached,
+            },
+            'results': None if self.results is None else self.results.to_dict(),
+            'stages': self.report.to_dict(),
+        }
+
+
+class SolverService:
+    """
+    Solves 3-party batches against calibrations cached by 1-party dataset.
+    Thread-safe: cached calibrations are shared read-only between requests.
+    """
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, fingerprint_index=INDEX_EXACT, workers=1, trace_memory=False):
+        """
+        @param trace_memory: trace the peak memory of every stage with tracemalloc (see instrumentation).
+        """
+        self.calibrations = CalibrationCache(cache_size)
+        self.fingerprint_index = fingerprint_index
+        self.workers = workers
+        self.trace_memory = trace_memory
+
+    @staticmethod
+    def cache_key(source_hash, rtt_method, aggregation):
+        # The rates and delays learned from a dataset depend on the RTT method and aggregation
+        return source_hash, rtt_method, aggregation
+
+    def calibration_for(self, files, rtt_method, aggregation=DEFAULT_AGGREGATION) \
+            -> tuple[Optional[CalibrationArtifact], bool]:
+        """
+        The calibration of the 1-party files, from the cache or calibrated (and cached) on a miss.
+
+        @param files: directory or {file name: content} mapping with the 1-party files and datacenters.csv.
+        return: (calibration or None on failure, whether it came from the cache).
+        """
+        source_hash = hash_1party_files(files)
+
+        def calibrate():
+            try:
+                cdgeb_utils_1party = parse_1party_files(files, aggregation)
+            except ValueError as e:
+                print("[ERROR]", e)
+                return None
+            return calibrate_csp(cdgeb_utils_1party, rtt_method, aggregation, source_hash)
+
+        return self.calibrations.get_or_create(self.cache_key(source_hash, rtt_method, aggregation), calibrate)
+
+    def add_calibration(self, calibration: CalibrationArtifact):
+        """
+        Cache an existing calibration (e.g. loaded from an artifact file) under its source hash.
+        """
+        if calibration.source_hash is not None:
+            self.calibrations.put(self.cache_key(calibration.source_hash, calibration.rtt_method,
+                                                 calibration.aggregation), calibration)
+
+    def solve(self, files, rtt_method, geolocation_method=METHOD_MULTILATERATION, aggregation=DEFAULT_AGGREGATION,
+              calibration: CalibrationArtifact = None, progress=None, profile=None) -> SolveResult:
+        """
+        Geolocate the 3-party batch of files, in memory. No maps are rendered.
+
+        @param files: {file name: content (bytes)} mapping (or a directory) with the input files. The 1-party files
+                      are not needed when a calibration is given.
+        @param calibration: calibration to use instead of the one of the 1-party files.
+        @param progress: called with the name of every stage (SOLVE_STAGES) as it starts.
+        @param profile: profile the solve with this profiler (instrumentation.PROFILERS). The text report is kept in
+                        result.report.profile.
+        """
+        report = PipelineReport(self.trace_memory)
+        with capture_stdout() as output:
+            with profile_run(report, profile) if profile else contextlib.nullcontext():
+                result = self._solve(files, rtt_method, geolocation_method, aggregation, calibration,
+                                     progress or (lambda stage: None), report)
+        result.output = output.getvalue()
+        return result
+
+    def _solve(self, files, rtt_method, geolocation_method, aggregation, calibration, progress, report) \
+            -> SolveResult:
+        result = SolveResult(False, '', report=report)
+
+        if not check_files_exist(files, include_1party=calibration is None):
+            # Already logged inside
+            return result
+        if not is_valid_aggregation(aggregation):
+            print("[ERROR] Invalid RTT aggregation:", aggregation)
+            return result
+
+        progress(STAGE_CALIBRATION)
+        with report.stage(STAGE_CALIBRATION):
+            if calibration is None:
+                calibration, result.calibration_cached = self.calibration_for(files, rtt_method, aggregation)
+            elif calibration.aggregation != aggregation:
+                print(f"[WARNING] The calibration artifact was made with the {calibration.aggregation} RTT "
+                      f"aggregation, the 3-party measurements use {aggregation}")
+        if calibration is None:
+            return result
+        result.calibration = calibration
+
+        if result.calibration_cached:
+            # Printed by calibrate_csp on a miss
+            print()
+            pretty_print_rates(calibration.rates)
+            print("Rates within CSP (All measuremenets):", calibration.general_rate)
+            print()
+
+        progress(STAGE_PARSE)
+        testing_mode = is_testing_mode(files)
+        try:
+            with report.stage(STAGE_PARSE):
+                _, cdgeb_utils_3party = parse_input_files(files, testing_mode, aggregation, include_1party=False)
+        except ValueError as e:
+            print("[ERROR]", e)
+            return result
+
+        progress(STAGE_VALIDATE)
+        with report.stage(STAGE_VALIDATE):
+            valid = validate_inputs(None, cdgeb_utils_3party, rtt_method, geolocation_method, testing_mode,
+                                    calibration)
+        if not valid:
+            # Already logged inside
+            return result
+
+        progress(STAGE_APPLY_CALIBRATION)
+        with report.stage(STAGE_APPLY_CALIBRATION):
+            apply_calibration(calibration, cdgeb_utils_3party)
+        progress(STAGE_GEOLOCATION)
+        with report.stage(STAGE_GEOLOCATION):
+            result.results = geolocate_from_data(None, calibration, cdgeb_utils_3party, geolocation_method,
+                                                 testing_mode, self.fingerprint_index, self.workers, MAPS_NONE)
+
+        result.dataset = cdgeb_utils_3party
+        result.success = True
+        return result
+
+
+def read_input_files(directory, filenames=None) -> dict[str, bytes]:
+    """
+    Load input files of a directory into a {file name: content} mapping, e.g. to replay a dataset through the
+    service. Missing files are skipped.
+    """
+    filenames = filenames or FILES_1PARTY + [FILE_SERVERS_3PARTY, FILE_MEASUREMENTS_3PARTY, FILE_SOLUTION]
+    files = dict()
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                files[filename] = f.read()
+    return files
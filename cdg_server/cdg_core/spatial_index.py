@@ -0,0 +1,85 @@
+"""
+Spatial index over entities with known coordinates (DataCenter, ProbeClient, FrontEnd...).
+
+Example usage:
+    index = SpatialIndex(datacenters)
+    closest_datacenters = index.nearest([(48.85, 2.35), (35.68, 139.69)])
+"""
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+__all__ = ['SpatialIndex']
+
+EARTH_RADIUS_KM = 6371.0
+
+# Distances (in radians) closer than this are considered a tie
+TIE_TOLERANCE = 1e-12
+
+
+class SpatialIndex:
+    """
+    Haversine BallTree over the coordinates of a list of entities.
+    Build it once per dataset; each query costs O(log N) instead of a scan over all entities.
+    """
+
+    def __init__(self, entities: list):
+        """
+        @param entities: list of objects exposing a (lat, lon) `coordinates` attribute.
+        """
+        self.entities = list(entities)
+        if len(self.entities) == 0:
+            raise ValueError("SpatialIndex requires at least one entity")
+
+        self.coordinates = np.array([entity.coordinates for entity in self.entities], dtype=float).reshape(-1, 2)
+        self.tree = BallTree(np.radians(self.coordinates), metric='haversine')
+
+    def __len__(self):
+        return len(self.entities)
+
+    @staticmethod
+    def _as_radians(coordinates) -> np.ndarray:
+        return np.radians(np.asarray(coordinates, dtype=float).reshape(-1, 2))
+
+    def query(self, coordinates, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        k-nearest neighbours of each of the given coordinates.
+
+        @param coordinates: a single (lat, lon) pair or an (N, 2) array-like of pairs.
+        @param k: number of neighbours to return for each point.
+        return: (distances [km], indices), both of shape (N, k), sorted by distance.
+        """
+        distances, indices = self.tree.query(self._as_radians(coordinates), k=min(k, len(self)))
+        return distances * EARTH_RADIUS_KM, indices
+
+    def query_radius(self, coordinates, radius_km: float) -> tuple[list[np.ndarray], list[np.ndarray]]:
+        """
+        All entities within radius_km of each of the given coordinates.
+
+        return: (distances [km], indices), one array per query point, sorted by distance.
+        """
+        indices, distances = self.tree.query_radius(self._as_radians(coordinates), r=radius_km / EARTH_RADIUS_KM,
+                                                    return_distance=True, sort_results=True)
+        return [d * EARTH_RADIUS_KM for d in distances], list(indices)
+
+    def nearest_indices(self, coordinates) -> np.ndarray:
+        """
+        Index of the nearest entity to each of the given coordinates.
+        Ties are resolved in favour of the entity that appears first, like min() over the entity list.
+        """
+        points = self._as_radians(coordinates)
+        distances, indices = self.tree.query(points, k=min(2, len(self)))
+        nearest = indices[:, 0].copy()
+
+        if indices.shape[1] > 1:
+            for row in np.flatnonzero(distances[:, 1] - distances[:, 0] <= TIE_TOLERANCE):
+                tied = self.tree.query_radius(points[row:row + 1], r=distances[row, 0] + TIE_TOLERANCE)[0]
+                nearest[row] = tied.min()
+
+        return nearest
+
+    def nearest(self, coordinates) -> list:
+        """
+        Nearest entity to each of the given coordinates.
+        """
+        return [self.entities[index] for index in self.nearest_indices(coordinates)]
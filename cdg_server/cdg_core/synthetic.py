@@ -0,0 +1,257 @@
+"""
+Synthetic CDG datasets of any size, written in the CSV formats read by parsers.
+
+Datacenters, probes and front-ends are placed at random on the continents, files are spread over the
+datacenters. Every probe measures every (front-end, file) pair, and every measurement row holds `samples` RTTs of
+    rtt = 2 * distance(probe, front-end) / access rate + access delay
+          + 2 * distance(front-end, file) / backbone rate(front-end continent, file continent)
+          + noise (exponential)
+so the continent-pair rates the calibration learns are the backbone rates (distance / one-way delay). Small datasets
+may leave continent pairs without any front-end -> file pair: the calibration gives them an infinite rate.
+Measurement rows are generated and written in chunks of chunk_rows rows, so memory stays bounded by the chunk size
+whatever the number of rows (probes x front-ends x files).
+
+The 3-party files are the 1-party ones (as in the bundled datasets) without the file locations, and solution.csv
+holds the true datacenter of every file, so a generated dataset measures accuracy and throughput together.
+
+Example usage:
+    config = SyntheticConfig(datacenters=50, probes=100, frontends=50, files=2000,
+                             backbone_rates={(Continent.EU, Continent.AS): 80000.0})
+    rows = generate_dataset('/tmp/synthetic', config)
+
+    python -m cdg_core.synthetic /tmp/synthetic --datacenters 50 --probes 100 --files 2000 --backbone-rate EU:AS:80000
+"""
+
+import os
+import time
+import shutil
+import argparse
+import dataclasses
+
+import numpy as np
+
+from .data_classes import *
+from .CloudServiceUtils import haversine_matrix
+from .parsers import FILE_DATACENTERS, FILE_SERVERS_1PARTY, FILE_SERVERS_3PARTY, FILE_MEASUREMENTS_1PARTY, \
+    FILE_MEASUREMENTS_3PARTY, FILE_SOLUTION, MEASUREMENT_SAMPLES_COUNT
+
+__all__ = ['CONTINENT_BOUNDS', 'SyntheticConfig', 'generate_entities', 'generate_dataset']
+
+# Rough (lat_min, lat_max, lon_min, lon_max) of the land masses of every continent
+CONTINENT_BOUNDS = {
+    Continent.AS: (10.0, 45.0, 70.0, 140.0),
+    Continent.EU: (38.0, 60.0, -8.0, 30.0),
+    Continent.AMN: (28.0, 50.0, -122.0, -72.0),
+    Continent.AMS: (-35.0, 5.0, -72.0, -38.0),
+    Continent.AU: (-38.0, -20.0, 115.0, 152.0),
+}
+
+# km/s
+DEFAULT_BACKBONE_RATE = 100000.0
+DEFAULT_ACCESS_RATE = 60000.0
+# Seconds
+DEFAULT_ACCESS_DELAY = 0.005
+DEFAULT_NOISE_SCALE = 0.002
+
+GENERATOR_CHUNK_ROWS = 65536
+
+
+@dataclasses.dataclass
+class SyntheticConfig:
+    datacenters: int = 10
+    probes: int = 10
+    frontends: int = 10  # Spread round-robin over the datacenters
+    files: int = 10
+    samples: int = MEASUREMENT_SAMPLES_COUNT  # RTT samples per measurement row
+    # Backbone rate [km/s] per (front-end continent, file continent). Missing pairs use default_backbone_rate.
+    backbone_rates: dict[tuple[Continent, Continent], float] = dataclasses.field(default_factory=dict)
+    default_backbone_rate: float = DEFAULT_BACKBONE_RATE
+    access_rate: float = DEFAULT_ACCESS_RATE  # km/s, probe -> front-end
+    access_delay: float = DEFAULT_ACCESS_DELAY  # Seconds, added to every RTT
+    noise_scale: float = DEFAULT_NOISE_SCALE  # Seconds, mean of the exponential noise of every sample
+    seed: int = 0
+
+    def validate(self):
+        if min(self.datacenters, self.probes, self.frontends, self.files) < 1:
+            raise ValueError("A dataset needs at least one datacenter, probe, front-end and file")
+        if self.samples < MEASUREMENT_SAMPLES_COUNT:
+            # The parser skips shorter rows (and aggregates the first MEASUREMENT_SAMPLES_COUNT samples only)
+            raise ValueError(f"Measurement rows need at least {MEASUREMENT_SAMPLES_COUNT} samples")
+        if min([self.default_backbone_rate, self.access_rate] + list(self.backbone_rates.values())) <= 0:
+            raise ValueError("Rates must be positive")
+
+    def backbone_rate_matrix(self) -> np.ndarray:
+        """
+        (Continent x Continent) backbone rates, ordered as the Continent enum.
+        """
+        continents = list(Continent)
+        rates = np.full((len(continents), len(continents)), self.default_backbone_rate)
+        for (src_continent, dst_continent), rate in self.backbone_rates.items():
+            rates[continents.index(src_continent), continents.index(dst_continent)] = rate
+        return rates
+
+
+def _random_locations(rng, count) -> tuple[list[tuple[float, float]], list[Continent]]:
+    continents = list(CONTINENT_BOUNDS)
+    location_continents = [continents[i] for i in rng.integers(len(continents), size=count)]
+    bounds = np.array([CONTINENT_BOUNDS[continent] for continent in location_continents]).reshape(count, 4)
+    locations = np.round(np.column_stack([rng.uniform(bounds[:, 0], bounds[:, 1]),
+                                          rng.uniform(bounds[:, 2], bounds[:, 3])]), 4)
+    return [tuple(location) for location in locations.tolist()], location_continents
+
+
+def generate_entities(config: SyntheticConfig, rng) \
+        -> tuple[list[DataCenter], list[ProbeClient], list[FrontEnd], list[DataFile]]:
+    """
+    Place the datacenters, probes, front-ends and files of a synthetic dataset.
+    The data files have their true datacenter.
+    """
+    locations, continents = _random_locations(rng, config.datacenters)
+    datacenters = [DataCenter(f'dc-{i:05d}', location, continent)
+                   for i, (location, continent) in enumerate(zip(locations, continents))]
+
+    locations, continents = _random_locations(rng, config.probes)
+    probe_clients = [ProbeClient(f'probe-{i:05d}', location, continent)
+                     for i, (location, continent) in enumerate(zip(locations, continents))]
+
+    frontend_servers = [FrontEnd(f'frontend-{i:05d}', datacenters[i % config.datacenters])
+                        for i in range(config.frontends)]
+
+    # Every front-end datacenter hosts a file first (the subtraction method measures from the closest file),
+    # the other files are spread at random
+    frontend_datacenter_ids = list(dict.fromkeys(i % config.datacenters for i in range(config.frontends)))
+    file_datacenter_ids = frontend_datacenter_ids[:config.files] + \
+        rng.integers(config.datacenters, size=max(0, config.files - len(frontend_datacenter_ids))).tolist()
+    data_files = [DataFile(f'file-{i:06d}', datacenters[datacenter_id])
+                  for i, datacenter_id in enumerate(file_datacenter_ids)]
+
+    return datacenters, probe_clients, frontend_servers, data_files
+
+
+def _write_servers(path, probe_clients, frontend_servers, data_files, with_file_locations):
+    with open(path, 'w') as f:
+        for probe in probe_clients:
+            f.write(f'probe,{probe.name},{probe.coordinates[0]},{probe.coordinates[1]},{probe.continent},\n')
+        for frontend in frontend_servers:
+            f.write(f'frontend,{frontend.name},{frontend.datacenter.name},\n')
+        for data_file in data_files:
+            f.write(f'file,{data_file.name},{data_file.datacenter.name},\n' if with_file_locations
+                    else f'file,{data_file.name},\n')
+
+
+def _write_measurements(path, config: SyntheticConfig, rng, probe_clients, frontend_servers, data_files,
+                        chunk_rows=GENERATOR_CHUNK_ROWS) -> int:
+    """
+    Stream the probes x front-ends x files measurement rows, in (probe, front-end, file) order.
+    """
+    num_frontends, num_files = len(frontend_servers), len(data_files)
+    num_rows = len(probe_clients) * num_frontends * num_files
+
+    continents = list(Continent)
+    # (probes x front-ends) access RTTs and (front-ends x files) backbone RTTs: the noise-free part of every row
+    access_rtts = 2 * haversine_matrix([probe.coordinates for probe in probe_clients],
+                                       [frontend.coordinates for frontend in frontend_servers]) \
+        / config.access_rate + config.access_delay
+    backbone_rates = config.backbone_rate_matrix()[
+        np.array([continents.index(frontend.continent) for frontend in frontend_servers])[:, np.newaxis],
+        np.array([continents.index(data_file.continent) for data_file in data_files])[np.newaxis, :]]
+    backbone_rtts = 2 * haversine_matrix([frontend.coordinates for frontend in frontend_servers],
+                                         [data_file.coordinates for data_file in data_files]) / backbone_rates
+
+    probe_names = [probe.name + ',' for probe in probe_clients]
+    frontend_names = [frontend.name + ',' for frontend in frontend_servers]
+    file_names = [data_file.name for data_file in data_files]
+    # One % operation formats a whole chunk
+    row_format = '%s' + ',%.6f' * config.samples + '\n'
+
+    with open(path, 'w') as f:
+        for start in range(0, num_rows, chunk_rows):
+            rows = np.arange(start, min(start + chunk_rows, num_rows))
+            probe_ids, frontend_ids, file_ids = rows // (num_frontends * num_files), \
+                rows // num_files % num_frontends, rows % num_files
+
+            rtts = (access_rtts[probe_ids, frontend_ids] + backbone_rtts[frontend_ids, file_ids])[:, np.newaxis] + \
+                rng.exponential(config.noise_scale, size=(len(rows), config.samples))
+
+            values = np.empty((len(rows), config.samples + 1), dtype=object)
+            values[:, 0] = [probe_names[probe_id] + frontend_names[frontend_id] + file_names[file_id]
+                            for probe_id, frontend_id, file_id in
+                            zip(probe_ids.tolist(), frontend_ids.tolist(), file_ids.tolist())]
+            values[:, 1:] = rtts
+            f.write((row_format * len(rows)) % tuple(values.ravel().tolist()))
+
+    return num_rows
+
+
+def generate_dataset(output_dir, config: SyntheticConfig = None, chunk_rows=GENERATOR_CHUNK_ROWS) -> int:
+    """
+    Write a synthetic dataset (all the input files, including solution.csv) to output_dir.
+
+    return: number of measurement rows (of each measurements file).
+    """
+    config = config or SyntheticConfig()
+    config.validate()
+    rng = np.random.default_rng(config.seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    datacenters, probe_clients, frontend_servers, data_files = generate_entities(config, rng)
+
+    with open(os.path.join(output_dir, FILE_DATACENTERS), 'w') as f:
+        for datacenter in datacenters:
+            f.write(f'{datacenter.name},{datacenter.coordinates[0]},{datacenter.coordinates[1]},'
+                    f'{datacenter.continent},\n')
+
+    _write_servers(os.path.join(output_dir, FILE_SERVERS_1PARTY), probe_clients, frontend_servers, data_files, True)
+    _write_servers(os.path.join(output_dir, FILE_SERVERS_3PARTY), probe_clients, frontend_servers, data_files, False)
+
+    with open(os.path.join(output_dir, FILE_SOLUTION), 'w') as f:
+        for data_file in data_files:
+            f.write(f'{data_file.name},{data_file.datacenter.name},\n')
+
+    measurements_path = os.path.join(output_dir, FILE_MEASUREMENTS_1PARTY)
+    num_rows = _write_measurements(measurements_path, config, rng, probe_clients, frontend_servers, data_files,
+                                   chunk_rows)
+    shutil.copyfile(measurements_path, os.path.join(output_dir, FILE_MEASUREMENTS_3PARTY))
+    return num_rows
+
+
+def parse_backbone_rate(value) -> tuple[tuple[Continent, Continent], float]:
+    """
+    <front-end continent>:<file continent>:<rate>, continents by Continent member name, e.g. EU:AS:80000.
+    """
+    try:
+        src_continent, dst_continent, rate = value.split(':')
+        return (Continent[src_continent.upper()], Continent[dst_continent.upper()]), float(rate)
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError(f"Invalid backbone rate: {value} (expected e.g. EU:AS:80000, continents: "
+                                         f"{', '.join(continent.name for continent in Continent)})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic CDG dataset.")
+    parser.add_argument('output_dir')
+    parser.add_argument('--datacenters', type=int, default=10)
+    parser.add_argument('--probes', type=int, default=10)
+    parser.add_argument('--frontends', type=int, default=None, help="Default: one per datacenter")
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--samples', type=int, default=MEASUREMENT_SAMPLES_COUNT, help="RTT samples per row")
+    parser.add_argument('--backbone-rate', type=parse_backbone_rate, action='append', default=list(),
+                        help="Backbone rate of a continent pair, e.g. EU:AS:80000 [km/s]. Repeatable")
+    parser.add_argument('--default-backbone-rate', type=float, default=DEFAULT_BACKBONE_RATE, help="km/s")
+    parser.add_argument('--access-rate', type=float, default=DEFAULT_ACCESS_RATE, help="km/s")
+    parser.add_argument('--access-delay', type=float, default=DEFAULT_ACCESS_DELAY, help="Seconds")
+    parser.add_argument('--noise', type=float, default=DEFAULT_NOISE_SCALE, help="Mean noise per sample [s]")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = SyntheticConfig(datacenters=args.datacenters, probes=args.probes,
+                             frontends=args.frontends or args.datacenters, files=args.files, samples=args.samples,
+                             backbone_rates=dict(args.backbone_rate), default_backbone_rate=args.default_backbone_rate,
+                             access_rate=args.access_rate, access_delay=args.access_delay,
+                             noise_scale=args.noise, seed=args.seed)
+
+    start_time = time.perf_counter()
+    rows = generate_dataset(args.output_dir, config)
+    elapsed_time = time.perf_counter() - start_time
+    print(f"[DEBUG] Wrote {rows} measurement rows to {args.output_dir} in {elapsed_time:.3f} s "
+          f"({rows / max(elapsed_time, 1e-9):.0f} rows/s)")